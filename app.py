@@ -1,15 +1,47 @@
 import os
-from datetime import datetime, timedelta
-from flask import Flask, render_template, redirect, url_for, flash, request
+import io
+import re
+import csv
+import json
+import math
+import gzip
+import hmac
+import time
+import signal
+import socket
+import hashlib
+import zipfile
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, date
+from functools import lru_cache
+
+import click
+import qrcode
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_file, abort, Response, stream_with_context, g, has_app_context, has_request_context
 from flask_login import UserMixin, LoginManager, login_user, logout_user, current_user, login_required
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import secure_filename
+from werkzeug.datastructures import MultiDict
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
-from sqlalchemy import func
+from sqlalchemy import func, or_, and_, update, insert, literal, union_all, true, event, text, column, inspect, MetaData, Table
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, deferred, Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
 
-import qrcode
-import io
-import base64
+try:
+    import fcntl
+except ImportError: # Windows: los turnos de login quedan limitados por proceso
+    fcntl = None
+try:
+    import brotli # opcional (pip install brotli): la API usa gzip si no está
+except ImportError:
+    brotli = None
 
 # =========================================================================
 # 1. INICIALIZACIÓN Y CONFIGURACIÓN DE FLASK
@@ -30,17 +62,364 @@ else:
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+def _env_bool(nombre, defecto):
+    valor = os.environ.get(nombre)
+    if valor is None:
+        return defecto
+    return valor.strip().lower() in ('1', 'true', 'si', 'sí', 'yes', 'on')
+
+# Pool de conexiones (por worker de gunicorn: el total es workers x (tamaño + desborde))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Render cierra las conexiones inactivas: se reciclan antes y se validan al tomarlas
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 280))
+app.config['DB_POOL_PRE_PING'] = _env_bool('DB_POOL_PRE_PING', True)
+app.config['DB_CONNECT_TIMEOUT'] = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+# Detrás de PgBouncer (modo transacción): sin pool propio ni sentencias preparadas
+app.config['DB_PGBOUNCER'] = _env_bool('DB_PGBOUNCER', False)
+# statement_timeout por transacción en Postgres (0 = sin límite). Las exportaciones
+# y reportes usan el límite largo.
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))
+app.config['DB_STATEMENT_TIMEOUT_LARGO_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_LARGO_MS', 120000))
+
+def opciones_motor(url, config):
+    """
+    Arma SQLALCHEMY_ENGINE_OPTIONS para Postgres según la configuración.
+    SQLite (desarrollo local) conserva el pool por defecto del dialecto.
+    """
+    url = make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return {}
+
+    opciones = {'connect_args': {'connect_timeout': config['DB_CONNECT_TIMEOUT']}}
+    if config['DB_PGBOUNCER']:
+        # PgBouncer ya agrupa las conexiones; psycopg (v3) no debe preparar sentencias
+        opciones['poolclass'] = NullPool
+        if url.get_driver_name() == 'psycopg':
+            opciones['connect_args']['prepare_threshold'] = None
+        return opciones
+
+    opciones.update({
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    })
+    return opciones
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones_motor(db_url, app.config)
+
+# Instrumentación: consultas por petición antes de registrar una advertencia, y
+# token para /metrics (Authorization: Bearer <token>). Sin token, /metrics solo
+# responde en modo debug/testing o con METRICAS_PUBLICAS=1 (p. ej. red privada)
+app.config['CONSULTAS_POR_PETICION_MAX'] = int(os.environ.get('CONSULTAS_POR_PETICION_MAX', 30))
+app.config['METRICAS_TOKEN'] = os.environ.get('METRICAS_TOKEN')
+app.config['METRICAS_PUBLICAS'] = _env_bool('METRICAS_PUBLICAS', False)
+
+# Paginación de la lista de pedidos (keyset sobre fecha_solicitud/id)
+app.config['PEDIDOS_POR_PAGINA'] = int(os.environ.get('PEDIDOS_POR_PAGINA', 50))
+app.config['ASIGNACIONES_POR_PAGINA'] = int(os.environ.get('ASIGNACIONES_POR_PAGINA', 50))
+# Listados de productos, escuelas, supervisores y bodegas (búsqueda y paginación keyset)
+app.config['LISTADOS_POR_PAGINA'] = int(os.environ.get('LISTADOS_POR_PAGINA', 50))
+# Segundos que cada worker recuerda qué tablas FTS5 existen (las migraciones pueden crearlas después)
+app.config['BUSQUEDA_FTS_TTL'] = int(os.environ.get('BUSQUEDA_FTS_TTL', 60))
+
+# API JSON para clientes móviles: tamaño mínimo (bytes) para comprimir la respuesta
+# y días que se guardan las claves de idempotencia de los pedidos
+app.config['API_COMPRESION_MINIMO'] = int(os.environ.get('API_COMPRESION_MINIMO', 500))
+app.config['API_IDEMPOTENCIA_DIAS'] = int(os.environ.get('API_IDEMPOTENCIA_DIAS', 7))
+# Filas leídas del cursor del servidor por cada bloque en las exportaciones
+app.config['EXPORTACION_FILAS_POR_BLOQUE'] = int(os.environ.get('EXPORTACION_FILAS_POR_BLOQUE', 1000))
+
+# Caché de imágenes QR: LRU en memoria respaldado por archivos PNG en disco
+app.config['QR_CACHE_TAMANO'] = int(os.environ.get('QR_CACHE_TAMANO', 512))
+app.config['QR_CACHE_DIR'] = os.environ.get('QR_CACHE_DIR', os.path.join(app.instance_path, 'qr_cache'))
+app.config['QR_CACHE_MAX_AGE'] = int(os.environ.get('QR_CACHE_MAX_AGE', 3600))
+# Tope del almacén en disco (MB): al superarlo se borran los PNG usados hace más tiempo
+app.config['QR_CACHE_DISCO_MB'] = int(os.environ.get('QR_CACHE_DISCO_MB', 100))
+# Exportación masiva de QR: hasta QR_LOTE_EN_LINEA códigos se generan en la misma
+# petición (sin pool); lotes mayores pasan a la cola de trabajos, donde el proceso
+# worker reparte el render entre QR_LOTE_PROCESOS procesos (1 = sin pool)
+app.config['QR_LOTE_EN_LINEA'] = int(os.environ.get('QR_LOTE_EN_LINEA', 200))
+app.config['QR_LOTE_PROCESOS'] = int(os.environ.get('QR_LOTE_PROCESOS', os.cpu_count() or 1))
+
+# Límite de pedidos públicos por escuela en una ventana móvil (configurable por escuela)
+app.config['PEDIDOS_POR_SEMANA'] = int(os.environ.get('PEDIDOS_POR_SEMANA', 2))
+app.config['VENTANA_PEDIDOS_DIAS'] = int(os.environ.get('VENTANA_PEDIDOS_DIAS', 7))
+
+# Caché de usuarios autenticados (evita consultar la tabla user en cada petición)
+app.config['USUARIOS_CACHE_TTL'] = int(os.environ.get('USUARIOS_CACHE_TTL', 60))
+app.config['USUARIOS_CACHE_TAMANO'] = int(os.environ.get('USUARIOS_CACHE_TAMANO', 1024))
+
+# Hash de contraseñas: método y costo configurables (formato de Werkzeug, p. ej.
+# 'pbkdf2:sha256:600000' o 'scrypt:32768:8:1'). Los hashes con otros parámetros
+# se regeneran automáticamente en el siguiente inicio de sesión correcto.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+# Verificaciones de contraseña simultáneas entre todos los workers, y espera máxima por un turno
+app.config['LOGIN_CONCURRENCIA'] = int(os.environ.get('LOGIN_CONCURRENCIA', max(1, (os.cpu_count() or 2) // 2)))
+app.config['LOGIN_ESPERA_MAX'] = float(os.environ.get('LOGIN_ESPERA_MAX', 3))
+
+# Cola de trabajos en segundo plano (tabla job, procesada por `flask worker`)
+app.config['TRABAJOS_MAX_INTENTOS'] = int(os.environ.get('TRABAJOS_MAX_INTENTOS', 3))
+# Espera antes del primer reintento; se duplica en cada intento fallido
+app.config['TRABAJOS_REINTENTO_SEGUNDOS'] = int(os.environ.get('TRABAJOS_REINTENTO_SEGUNDOS', 30))
+# Mientras ejecuta un trabajo el worker renueva su latido cada TRABAJOS_LATIDO_SEGUNDOS.
+# Un trabajo en proceso sin latido por TRABAJOS_LATIDO_VENCIDO segundos se considera
+# abandonado (worker caído) y se reintenta; uno largo con latido al día no se toca.
+app.config['TRABAJOS_LATIDO_SEGUNDOS'] = int(os.environ.get('TRABAJOS_LATIDO_SEGUNDOS', 30))
+app.config['TRABAJOS_LATIDO_VENCIDO'] = int(os.environ.get('TRABAJOS_LATIDO_VENCIDO', 300))
+app.config['TRABAJOS_INTERVALO'] = float(os.environ.get('TRABAJOS_INTERVALO', 2))
+# Mantenimiento de la cola y tareas programadas: cada tantos segundos, no en cada consulta
+app.config['TRABAJOS_MANTENIMIENTO_SEGUNDOS'] = int(os.environ.get('TRABAJOS_MANTENIMIENTO_SEGUNDOS', 60))
+app.config['TRABAJOS_RETENCION_DIAS'] = int(os.environ.get('TRABAJOS_RETENCION_DIAS', 7))
+
+# Pronóstico de demanda (tarea programada pronostico_demanda, ver `flask worker`)
+# Días del promedio móvil de consumo y de historia para los índices estacionales por mes
+app.config['PRONOSTICO_VENTANA_DIAS'] = int(os.environ.get('PRONOSTICO_VENTANA_DIAS', 28))
+app.config['PRONOSTICO_HISTORIA_DIAS'] = int(os.environ.get('PRONOSTICO_HISTORIA_DIAS', 730))
+# Días que tarda una reposición y factor del stock de seguridad (1.65 ≈ 95 % de servicio)
+app.config['PRONOSTICO_PLAZO_DIAS'] = int(os.environ.get('PRONOSTICO_PLAZO_DIAS', 14))
+app.config['PRONOSTICO_FACTOR_SEGURIDAD'] = float(os.environ.get('PRONOSTICO_FACTOR_SEGURIDAD', 1.65))
+# Cada cuántas horas se recalcula (0 = solo a mano con `flask pronosticar`)
+app.config['PRONOSTICO_INTERVALO_HORAS'] = float(os.environ.get('PRONOSTICO_INTERVALO_HORAS', 24))
+
 # Inicializa la base de datos
 db = SQLAlchemy(app)
 
+# Métricas del pool de este proceso (cada worker tiene su propio pool)
+_metricas_pool = defaultdict(int)
+_metricas_pool_lock = threading.Lock()
+
+def _contar_evento_pool(nombre):
+    def contar(*args):
+        with _metricas_pool_lock:
+            _metricas_pool[nombre] += 1
+    return contar
+
+with app.app_context():
+    for _evento in ('connect', 'checkout', 'checkin', 'invalidate', 'soft_invalidate'):
+        event.listen(db.engine, _evento, _contar_evento_pool(_evento))
+
+def metricas_pool():
+    pool = db.engine.pool
+    estado = {'pid': os.getpid(), 'pool': type(pool).__name__}
+    # QueuePool expone su ocupación; NullPool (modo PgBouncer) no mantiene conexiones
+    for nombre in ('size', 'checkedin', 'checkedout', 'overflow'):
+        metodo = getattr(pool, nombre, None)
+        if callable(metodo):
+            estado[nombre] = metodo()
+    with _metricas_pool_lock:
+        estado['eventos'] = dict(_metricas_pool)
+    return estado
+
+def limite_sentencias_largo():
+    # Para exportaciones y reportes: aplica a la transacción en curso y a las siguientes
+    g.statement_timeout_ms = app.config['DB_STATEMENT_TIMEOUT_LARGO_MS']
+    if db.engine.dialect.name == 'postgresql' and db.session().in_transaction():
+        db.session.execute(text(f"SET LOCAL statement_timeout = {int(g.statement_timeout_ms)}"))
+
+def abrir_transaccion_escritura():
+    """
+    Garantiza que la transacción de la sesión esté abierta en la base antes
+    de usar begin_nested(). pysqlite no emite BEGIN hasta el primer INSERT o
+    UPDATE: un SAVEPOINT anterior abriría la transacción y al liberarlo se
+    confirmaría todo. En SQLite se abre con BEGIN IMMEDIATE (toma el bloqueo
+    de escritura); en PostgreSQL la transacción ya existe y no se hace nada.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    if not db.session.connection().connection.dbapi_connection.in_transaction:
+        db.session.execute(text('BEGIN IMMEDIATE'))
+
+@event.listens_for(Session, 'after_begin')
+def _aplicar_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    limite = app.config['DB_STATEMENT_TIMEOUT_MS']
+    if has_app_context():
+        limite = g.get('statement_timeout_ms', limite)
+    if limite:
+        # SET LOCAL dura solo la transacción: compatible con PgBouncer en modo transacción
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(limite)}")
+
+# -------------------------------------------------------------------------
+# Instrumentación de peticiones y consultas SQL (por proceso, expuesta en /metrics)
+# -------------------------------------------------------------------------
+
+LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _MetricasEndpoint:
+    def __init__(self):
+        self.buckets = [0] * len(LIMITES_LATENCIA)
+        self.peticiones = 0
+        self.segundos = 0.0
+        self.consultas = 0
+        self.segundos_db = 0.0
+        self.sobre_presupuesto = 0
+        self.estados = defaultdict(int)
+
+_metricas_endpoints = defaultdict(_MetricasEndpoint)
+_metricas_endpoints_lock = threading.Lock()
+
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    # En el contexto de ejecución y no en la conexión: si la sentencia falla, el
+    # contexto se descarta con ella y no queda un inicio huérfano
+    context._inicio_consulta = time.perf_counter()
+
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    duracion = time.perf_counter() - context._inicio_consulta
+    # Fuera de una petición (CLI, hilos de benchmark sin contexto) no se contabiliza
+    if has_request_context() and 'inicio_peticion' in g:
+        g.consultas += 1
+        g.segundos_db += duracion
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _antes_de_consulta)
+    event.listen(db.engine, 'after_cursor_execute', _despues_de_consulta)
+
+@app.before_request
+def _iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.consultas = 0
+    g.segundos_db = 0.0
+
+def _registrar_peticion(estado):
+    duracion = time.perf_counter() - g.pop('inicio_peticion')
+    # Rutas inexistentes se agrupan para no crear una serie por URL
+    endpoint = request.endpoint or 'sin_ruta'
+    presupuesto = app.config['CONSULTAS_POR_PETICION_MAX']
+    excedido = presupuesto and g.consultas > presupuesto
+
+    with _metricas_endpoints_lock:
+        metricas = _metricas_endpoints[(endpoint, request.method)]
+        metricas.peticiones += 1
+        metricas.segundos += duracion
+        metricas.consultas += g.consultas
+        metricas.segundos_db += g.segundos_db
+        metricas.estados[estado] += 1
+        if excedido:
+            metricas.sobre_presupuesto += 1
+        for i, limite in enumerate(LIMITES_LATENCIA):
+            if duracion <= limite:
+                metricas.buckets[i] += 1
+
+    if excedido:
+        app.logger.warning("%s %s ejecutó %d consultas (presupuesto %d) en %.1f ms",
+                           request.method, request.path, g.consultas, presupuesto, duracion * 1000)
+    return duracion
+
+@app.after_request
+def _finalizar_medicion(response):
+    if 'inicio_peticion' not in g:
+        return response
+    consultas, segundos_db = g.consultas, g.segundos_db
+    duracion = _registrar_peticion(response.status_code)
+    response.headers.add('Server-Timing', f'db;dur={segundos_db * 1000:.1f};desc="{consultas} consultas"')
+    response.headers.add('Server-Timing', f'app;dur={duracion * 1000:.1f}')
+    return response
+
+@app.teardown_request
+def _medicion_con_error(error):
+    # after_request no corre si la vista lanzó una excepción no controlada
+    if error is not None and 'inicio_peticion' in g:
+        _registrar_peticion(500)
+
+def _etiquetas(**valores):
+    return ','.join(f'{k}="{v}"' for k, v in valores.items())
+
+def metricas_prometheus():
+    """Texto en formato de exposición de Prometheus con las métricas de este proceso."""
+    with _metricas_endpoints_lock:
+        datos = [(clave, m.buckets[:], m.peticiones, m.segundos, m.consultas, m.segundos_db,
+                  m.sobre_presupuesto, dict(m.estados))
+                 for clave, m in sorted(_metricas_endpoints.items())]
+
+    lineas = [
+        '# HELP http_request_duration_seconds Latencia de las peticiones por endpoint.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (endpoint, metodo), buckets, peticiones, segundos, *_ in datos:
+        # Los buckets ya son acumulativos: cada petición cuenta en todos los límites >= su duración
+        for limite, cantidad in zip(LIMITES_LATENCIA, buckets):
+            lineas.append(f'http_request_duration_seconds_bucket{{{_etiquetas(endpoint=endpoint, method=metodo, le=limite)}}} {cantidad}')
+        lineas.append(f'http_request_duration_seconds_bucket{{{_etiquetas(endpoint=endpoint, method=metodo, le="+Inf")}}} {peticiones}')
+        lineas.append(f'http_request_duration_seconds_sum{{{_etiquetas(endpoint=endpoint, method=metodo)}}} {segundos:.6f}')
+        lineas.append(f'http_request_duration_seconds_count{{{_etiquetas(endpoint=endpoint, method=metodo)}}} {peticiones}')
+
+    lineas += ['# HELP http_requests_total Peticiones por endpoint y código de estado.',
+               '# TYPE http_requests_total counter']
+    for (endpoint, metodo), *_, estados in datos:
+        for estado, cantidad in sorted(estados.items()):
+            lineas.append(f'http_requests_total{{{_etiquetas(endpoint=endpoint, method=metodo, status=estado)}}} {cantidad}')
+
+    series = (
+        ('db_queries_total', 'counter', 'Consultas SQL ejecutadas por endpoint.', 4, '{}'),
+        ('db_query_duration_seconds_total', 'counter', 'Tiempo total en la base de datos por endpoint.', 5, '{:.6f}'),
+        ('http_requests_over_query_budget_total', 'counter', 'Peticiones que superaron CONSULTAS_POR_PETICION_MAX.', 6, '{}'),
+    )
+    for nombre, tipo, ayuda, indice, formato in series:
+        lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} {tipo}']
+        for fila in datos:
+            endpoint, metodo = fila[0]
+            lineas.append(f'{nombre}{{{_etiquetas(endpoint=endpoint, method=metodo)}}} {formato.format(fila[indice])}')
+
+    pool = metricas_pool()
+    for nombre in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if nombre in pool:
+            lineas += [f'# TYPE db_pool_{nombre} gauge', f'db_pool_{nombre} {pool[nombre]}']
+    lineas.append('# TYPE db_pool_events_total counter')
+    for evento, cantidad in sorted(pool['eventos'].items()):
+        lineas.append(f'db_pool_events_total{{{_etiquetas(event=evento)}}} {cantidad}')
+    return '\n'.join(lineas) + '\n'
+
 # Inicializa Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+class UsuarioSesion(UserMixin):
+    # Datos del usuario autenticado que se guardan en caché (no es una instancia ORM)
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.is_admin = user.is_admin
+
+_usuarios_cache = OrderedDict()
+_usuarios_cache_lock = threading.Lock()
+
+def invalidar_usuario(user_id):
+    # Los demás workers lo verán como máximo tras USUARIOS_CACHE_TTL segundos
+    with _usuarios_cache_lock:
+        _usuarios_cache.pop(user_id, None)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    ttl = app.config['USUARIOS_CACHE_TTL']
+    ahora = time.monotonic()
+
+    with _usuarios_cache_lock:
+        entrada = _usuarios_cache.get(user_id)
+        if entrada is not None and ahora - entrada[0] < ttl:
+            _usuarios_cache.move_to_end(user_id)
+            return entrada[1]
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        invalidar_usuario(user_id)
+        return None
+
+    usuario = UsuarioSesion(user)
+    if ttl > 0:
+        with _usuarios_cache_lock:
+            _usuarios_cache[user_id] = (ahora, usuario)
+            _usuarios_cache.move_to_end(user_id)
+            while len(_usuarios_cache) > app.config['USUARIOS_CACHE_TAMANO']:
+                _usuarios_cache.popitem(last=False)
+    return usuario
 
 # =========================================================================
 # 2. DEFINICIÓN DE MODELOS
@@ -54,18 +433,48 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def necesita_rehash(self):
+        # El prefijo del hash guarda método y parámetros (p. ej. pbkdf2:sha256:600000)
+        actual = (self.password_hash or '').split('$', 1)[0]
+        return actual != _metodo_hash_canonico(app.config['PASSWORD_HASH_METHOD'])
+
+@lru_cache(maxsize=8)
+def _metodo_hash_canonico(metodo):
+    # Werkzeug completa los parámetros omitidos; se calcula una vez por proceso
+    return generate_password_hash('', method=metodo).split('$', 1)[0]
+
+# Cambios de contraseña, permisos o borrado invalidan el usuario en caché
+@event.listens_for(User.password_hash, 'set')
+@event.listens_for(User.is_admin, 'set')
+def _invalidar_usuario_modificado(user, valor, anterior, iniciador):
+    if user.id is not None:
+        invalidar_usuario(user.id)
+
+@event.listens_for(User, 'after_delete')
+def _invalidar_usuario_eliminado(mapper, conexion, user):
+    invalidar_usuario(user.id)
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     code = db.Column(db.String(50), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     stock = db.Column(db.Integer, default=0)
-    
+    # Versión del catálogo en la que cambió por última vez (cambios de la API desde una versión).
+    # None = cambió en la transacción actual; al confirmar, invalidar_catalogo() le asigna la nueva versión.
+    version_catalogo = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        # Orden alfabético de los listados
+        db.Index('ix_product_name', 'name', 'id'),
+        db.Index('ix_product_version_catalogo', 'version_catalogo'),
+    )
+
 class Bodega(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -78,11 +487,19 @@ class Supervisor(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False) 
     qr_code_data = db.Column(db.String(255), unique=True, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_supervisor_apellido', 'apellido', 'id'),
+    )
+
 class Escuela(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     qr_code_data = db.Column(db.String(255), unique=True, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_escuela_name', 'name', 'id'),
+    )
+
 # Relación Supervisor-Escuela
 class SupervisorEscuela(db.Model):
     __tablename__ = 'supervisor_escuela'
@@ -90,7 +507,11 @@ class SupervisorEscuela(db.Model):
     supervisor_id = db.Column(db.Integer, db.ForeignKey('supervisor.id'), nullable=False)
     escuela_id = db.Column(db.Integer, db.ForeignKey('escuela.id'), nullable=False)
     
-    __table_args__ = (db.UniqueConstraint('supervisor_id', 'escuela_id', name='_supervisor_escuela_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('supervisor_id', 'escuela_id', name='_supervisor_escuela_uc'),
+        # La restricción única empieza por supervisor_id; las búsquedas por escuela necesitan su propio índice
+        db.Index('ix_supervisor_escuela_escuela_id', 'escuela_id'),
+    )
 
     supervisor = db.relationship('Supervisor', backref='asignaciones')
     escuela = db.relationship('Escuela', backref='asignaciones')
@@ -104,6 +525,15 @@ class Solicitud(db.Model):
     fecha_solicitud = db.Column(db.DateTime, default=datetime.utcnow)
     fecha_aprobacion = db.Column(db.DateTime, nullable=True)
     estado = db.Column(db.String(50), default='Pendiente', nullable=False) # Pendiente, Aprobada, Rechazada
+
+    __table_args__ = (
+        # Límite semanal por escuela y pedidos de las escuelas de un supervisor
+        db.Index('ix_solicitud_escuela_fecha', 'escuela_id', 'fecha_solicitud'),
+        # Lista de pedidos paginada por (fecha_solicitud, id) y aprobación por supervisor
+        db.Index('ix_solicitud_fecha_id', 'fecha_solicitud', 'id'),
+        db.Index('ix_solicitud_supervisor_estado_fecha', 'supervisor_id', 'estado', 'fecha_solicitud'),
+        db.Index('ix_solicitud_estado_fecha', 'estado', 'fecha_solicitud'),
+    )
     
     supervisor = db.relationship('Supervisor', backref='solicitudes')
     escuela = db.relationship('Escuela', backref='solicitudes')
@@ -115,20 +545,412 @@ class DetalleSolicitud(db.Model):
     solicitud_id = db.Column(db.Integer, db.ForeignKey('solicitud.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     cantidad_solicitada = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        # Detalle de una solicitud y demanda agregada por (solicitud, producto)
+        db.Index('ix_detalle_solicitud_solicitud_producto', 'solicitud_id', 'product_id'),
+    )
     
     solicitud = db.relationship('Solicitud', backref='detalles')
     producto = db.relationship('Product', backref='solicitud_detalles')
 
+# Cupo de pedidos por escuela: fechas de los últimos pedidos aceptados dentro de la ventana
+class LimitePedidoEscuela(db.Model):
+    __tablename__ = 'limite_pedido_escuela'
+    escuela_id = db.Column(db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False)
+    limite = db.Column(db.Integer, nullable=True) # None = PEDIDOS_POR_SEMANA
+    marcas = db.Column(db.Text, nullable=False, default='[]') # Lista JSON de fechas ISO
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    escuela = db.relationship('Escuela', backref=db.backref('limite_pedidos', uselist=False))
+
+# Consumo diario acumulado (fecha x escuela x producto), mantenido en las mismas transacciones
+# que crean y aprueban pedidos. Las solicitadas cuentan en la fecha del pedido y las
+# aprobadas en la fecha de aprobación.
+class ConsumoDiario(db.Model):
+    __tablename__ = 'consumo_diario'
+    fecha = db.Column(db.Date, primary_key=True)
+    escuela_id = db.Column(db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True, autoincrement=False)
+    unidades_solicitadas = db.Column(db.Integer, nullable=False, default=0)
+    unidades_aprobadas = db.Column(db.Integer, nullable=False, default=0)
+    pedidos = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Consultas por producto en un rango de fechas (reportes y dashboard)
+        db.Index('ix_consumo_diario_producto_fecha', 'product_id', 'fecha'),
+    )
+
+# Libro de inventario por bodega: solo se agregan filas (auditable). Cada movimiento
+# guarda su efecto sobre la existencia física y sobre lo reservado por pedidos aprobados.
+class MovimientoStock(db.Model):
+    __tablename__ = 'movimiento_stock'
+    id = db.Column(db.Integer, primary_key=True)
+    bodega_id = db.Column(db.Integer, db.ForeignKey('bodega.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    tipo = db.Column(db.String(20), nullable=False) # recepcion, reserva, despacho, ajuste
+    existencia = db.Column(db.Integer, nullable=False, default=0) # variación de la existencia
+    reservado = db.Column(db.Integer, nullable=False, default=0) # variación de lo reservado
+    solicitud_id = db.Column(db.Integer, db.ForeignKey('solicitud.id'), nullable=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    nota = db.Column(db.String(200))
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Historial de un producto en una bodega
+        db.Index('ix_movimiento_stock_bodega_producto', 'bodega_id', 'product_id', 'id'),
+        # Una reserva y un despacho por (solicitud, bodega, producto): evita despachar dos veces
+        db.UniqueConstraint('solicitud_id', 'tipo', 'bodega_id', 'product_id', name='uq_movimiento_stock_solicitud'),
+    )
+
+# Saldo actual por (bodega, producto), mantenido en la misma transacción que cada movimiento
+class SaldoBodega(db.Model):
+    __tablename__ = 'saldo_bodega'
+    bodega_id = db.Column(db.Integer, db.ForeignKey('bodega.id'), primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True, autoincrement=False)
+    existencia = db.Column(db.Integer, nullable=False, default=0)
+    reservado = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.CheckConstraint('existencia >= reservado AND reservado >= 0', name='ck_saldo_bodega_no_negativo'),
+        # Asignación: bodegas con stock de un producto
+        db.Index('ix_saldo_bodega_producto', 'product_id'),
+    )
+
+# Saldos acumulados hasta un movimiento: punto de partida para reconstruir saldo_bodega
+class SaldoSnapshot(db.Model):
+    __tablename__ = 'saldo_snapshot'
+    bodega_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    existencia = db.Column(db.Integer, nullable=False)
+    reservado = db.Column(db.Integer, nullable=False)
+    hasta_movimiento_id = db.Column(db.Integer, nullable=False)
+
+# Pronóstico de demanda y punto de reorden por producto (bodega_id NULL = total del producto)
+# y por bodega. La tarea pronostico_demanda reemplaza todas las filas en cada cálculo.
+class PronosticoDemanda(db.Model):
+    __tablename__ = 'pronostico_demanda'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    bodega_id = db.Column(db.Integer, db.ForeignKey('bodega.id'), nullable=True)
+    consumo_diario = db.Column(db.Float, nullable=False) # promedio móvil (unidades por día)
+    demanda_diaria = db.Column(db.Float, nullable=False) # pronóstico para el plazo de reposición, con estacionalidad
+    punto_reorden = db.Column(db.Integer, nullable=False)
+    disponible = db.Column(db.Integer, nullable=False) # al momento del cálculo
+    dias_cobertura = db.Column(db.Float) # None = sin demanda
+    reponer = db.Column(db.Boolean, nullable=False, default=False)
+    calculado_en = db.Column(db.DateTime, nullable=False)
+
+    product = db.relationship('Product')
+    bodega = db.relationship('Bodega')
+
+    __table_args__ = (
+        db.Index('ix_pronostico_demanda_producto', 'product_id', 'bodega_id'),
+    )
+
+# Versión del catálogo de productos: invalida la caché del formulario público en todos los workers
+class CatalogoVersion(db.Model):
+    __tablename__ = 'catalogo_version'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+# Clave de idempotencia de un pedido enviado por la API: un reintento con la misma
+# clave devuelve la solicitud ya creada en lugar de crear otra
+class ClaveIdempotencia(db.Model):
+    __tablename__ = 'clave_idempotencia'
+    clave = db.Column(db.String(100), primary_key=True)
+    escuela_id = db.Column(db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False)
+    huella = db.Column(db.String(64), nullable=False) # sha256 del cuerpo del pedido
+    solicitud_id = db.Column(db.Integer, db.ForeignKey('solicitud.id'), nullable=False)
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Limpieza de claves antiguas
+        db.Index('ix_clave_idempotencia_creado_en', 'creado_en'),
+    )
+
+# Trabajo en segundo plano: lo encola la web y lo ejecuta `flask worker`
+class Trabajo(db.Model):
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    parametros = db.Column(db.Text, nullable=False, default='{}') # JSON
+    estado = db.Column(db.String(20), nullable=False, default='pendiente') # pendiente, en_proceso, completado, fallido
+    progreso = db.Column(db.Integer, nullable=False, default=0)
+    mensaje = db.Column(db.String(500))
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=3)
+    disponible_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    iniciado_en = db.Column(db.DateTime)
+    # Último latido del worker que lo ejecuta (ver TRABAJOS_LATIDO_VENCIDO)
+    latido_en = db.Column(db.DateTime)
+    terminado_en = db.Column(db.DateTime)
+    trabajador = db.Column(db.String(100))
+    usuario_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # El resultado se guarda en la base: la web y el worker no comparten disco en Render
+    resultado_nombre = db.Column(db.String(200))
+    resultado_tipo = db.Column(db.String(100))
+    resultado = deferred(db.Column(db.LargeBinary))
+
+    __table_args__ = (
+        # Búsqueda del siguiente trabajo pendiente
+        db.Index('ix_job_estado_disponible', 'estado', 'disponible_en'),
+    )
+
+# Archivo subido para un trabajo (el CSV de una importación): los parámetros del
+# trabajo guardan solo su id. Se borra junto con los trabajos antiguos.
+class ArchivoTrabajo(db.Model):
+    __tablename__ = 'job_archivo'
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(200), nullable=False)
+    contenido = deferred(db.Column(db.LargeBinary, nullable=False))
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# Versión del esquema aplicada (ver sección de migraciones)
+class VersionEsquema(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    descripcion = db.Column(db.String(200), nullable=False)
+    aplicada_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+# =========================================================================
+# 3. CÓDIGOS QR (GENERACIÓN Y CACHÉ)
+# =========================================================================
+
+_qr_cache = OrderedDict()
+_qr_cache_lock = threading.Lock()
+# Bytes escritos en disco por este proceso desde la última poda
+_qr_disco_escrito = 0
+_qr_poda_lock = threading.Lock()
+
+def _clave_qr(payload, box_size, border, error_correction):
+    # Clave de contenido: la misma combinación siempre produce el mismo PNG
+    datos = f"{payload}|{box_size}|{border}|{error_correction}"
+    return hashlib.sha256(datos.encode('utf-8')).hexdigest()
+
+def renderizar_qr_png(payload, box_size=10, border=4, error_correction=qrcode.constants.ERROR_CORRECT_L):
+    qr = qrcode.QRCode(version=1, error_correction=error_correction, box_size=box_size, border=border)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def obtener_qr_png(payload, box_size=10, border=4, error_correction=qrcode.constants.ERROR_CORRECT_L):
+    """
+    Devuelve (clave, png) para el payload indicado. Busca primero en el LRU
+    del proceso, luego en el almacén en disco y solo si no existe renderiza.
+    """
+    clave = _clave_qr(payload, box_size, border, error_correction)
+
+    with _qr_cache_lock:
+        png = _qr_cache.get(clave)
+        if png is not None:
+            _qr_cache.move_to_end(clave)
+            return clave, png
+
+    ruta = os.path.join(app.config['QR_CACHE_DIR'], clave[:2], f"{clave}.png")
+    try:
+        with open(ruta, 'rb') as archivo:
+            png = archivo.read()
+        # La fecha de modificación marca el último uso: la poda borra primero los más antiguos
+        os.utime(ruta)
+    except OSError:
+        png = renderizar_qr_png(payload, box_size, border, error_correction)
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            # Escritura atómica para que otro worker nunca lea un archivo a medias
+            temporal = f"{ruta}.{os.getpid()}.tmp"
+            with open(temporal, 'wb') as archivo:
+                archivo.write(png)
+            os.replace(temporal, ruta)
+            _contar_escritura_qr(len(png))
+        except OSError:
+            # Sin disco escribible el caché sigue funcionando en memoria
+            pass
+
+    with _qr_cache_lock:
+        _qr_cache[clave] = png
+        _qr_cache.move_to_end(clave)
+        while len(_qr_cache) > app.config['QR_CACHE_TAMANO']:
+            _qr_cache.popitem(last=False)
+    return clave, png
+
+def _contar_escritura_qr(tamano):
+    # Cada proceso poda tras escribir una décima parte del tope, sin recorrer el disco en cada PNG
+    global _qr_disco_escrito
+    with _qr_cache_lock:
+        _qr_disco_escrito += tamano
+        if _qr_disco_escrito * 10 < app.config['QR_CACHE_DISCO_MB'] * 1024 * 1024:
+            return
+        _qr_disco_escrito = 0
+    podar_cache_qr()
+
+def podar_cache_qr():
+    """
+    Deja el almacén de QR en disco por debajo de QR_CACHE_DISCO_MB borrando
+    los archivos usados hace más tiempo. Devuelve cuántos borró.
+    """
+    if not _qr_poda_lock.acquire(blocking=False):
+        return 0  # otro hilo de este proceso ya está podando
+    try:
+        archivos = []
+        for raiz, _, nombres in os.walk(app.config['QR_CACHE_DIR']):
+            for nombre in nombres:
+                ruta = os.path.join(raiz, nombre)
+                try:
+                    estado = os.stat(ruta)
+                except OSError:
+                    continue  # otro worker lo borró o reemplazó
+                archivos.append((estado.st_mtime, estado.st_size, ruta))
+
+        sobrante = sum(tamano for _, tamano, _ in archivos) - app.config['QR_CACHE_DISCO_MB'] * 1024 * 1024
+        borrados = 0
+        for _, tamano, ruta in sorted(archivos):
+            if sobrante <= 0:
+                break
+            try:
+                os.remove(ruta)
+            except OSError:
+                continue
+            sobrante -= tamano
+            borrados += 1
+        return borrados
+    finally:
+        _qr_poda_lock.release()
+
+def respuesta_qr_png(payload):
+    # PNG real con ETag y Cache-Control para que navegadores y proxies lo cacheen
+    clave, png = obtener_qr_png(payload)
+    return send_file(io.BytesIO(png), mimetype='image/png', etag=clave,
+                     max_age=app.config['QR_CACHE_MAX_AGE'], conditional=True)
+
+def renderizar_qr_en_paralelo(payloads, procesos):
+    """
+    Genera los PNG de los payloads en el mismo orden, repartiendo el trabajo
+    (CPU pura) entre un pool de procesos. Es un generador: cada PNG se entrega
+    en cuanto está listo para no acumular todo el lote en memoria.
+    """
+    if procesos <= 1 or len(payloads) < 2:
+        for payload in payloads:
+            yield renderizar_qr_png(payload)
+        return
+
+    with ProcessPoolExecutor(max_workers=procesos) as executor:
+        yield from executor.map(renderizar_qr_png, payloads, chunksize=32)
+
+class _SalidaZip(io.RawIOBase):
+    # Destino no seekable para zipfile: acumula los bytes escritos hasta que se extraen
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def extraer(self):
+        datos = b''.join(self._partes)
+        self._partes.clear()
+        return datos
+
+def generar_zip_qr(items, procesos):
+    """Genera un ZIP de PNGs por partes a partir de una lista de (nombre_archivo, payload)."""
+    salida = _SalidaZip()
+    with zipfile.ZipFile(salida, 'w', compression=zipfile.ZIP_STORED) as archivo_zip:
+        pngs = renderizar_qr_en_paralelo([payload for _, payload in items], procesos)
+        for (nombre, _), png in zip(items, pngs):
+            archivo_zip.writestr(nombre, png)
+            yield salida.extraer()
+    yield salida.extraer()
+
+def _qr_data_supervisor(supervisor):
+    # Supervisores antiguos pueden no tener qr_code_data guardado
+    return supervisor.qr_code_data or f"SUPERVISOR_EMAIL:{supervisor.email}"
+
 # =========================================================================
-# 3. RUTAS DE ACCESO Y DASHBOARD
+# 4. RUTAS DE ACCESO Y DASHBOARD
 # =========================================================================
 
+_login_semaforo = threading.BoundedSemaphore(app.config['LOGIN_CONCURRENCIA'])
+
+@contextmanager
+def turno_de_login():
+    """
+    Reserva uno de LOGIN_CONCURRENCIA turnos para verificar una contraseña.
+    Los turnos son archivos bloqueados con flock, compartidos por todos los
+    workers de gunicorn, así una ráfaga de logins no ocupa toda la CPU.
+    Entrega False si no hubo turno libre en LOGIN_ESPERA_MAX segundos.
+    """
+    espera = app.config['LOGIN_ESPERA_MAX']
+    directorio = os.path.join(app.instance_path, 'login_turnos')
+    if fcntl is not None:
+        try:
+            os.makedirs(directorio, exist_ok=True)
+        except OSError:
+            directorio = None
+
+    if fcntl is None or directorio is None:
+        adquirido = _login_semaforo.acquire(timeout=espera)
+        try:
+            yield adquirido
+        finally:
+            if adquirido:
+                _login_semaforo.release()
+        return
+
+    limite_tiempo = time.monotonic() + espera
+    while True:
+        for numero in range(app.config['LOGIN_CONCURRENCIA']):
+            archivo = open(os.path.join(directorio, f'turno_{numero}.lock'), 'a')
+            try:
+                fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                archivo.close()
+                continue
+            try:
+                yield True
+            finally:
+                fcntl.flock(archivo, fcntl.LOCK_UN)
+                archivo.close()
+            return
+        if time.monotonic() >= limite_tiempo:
+            yield False
+            return
+        time.sleep(0.05)
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
     return redirect(url_for('login'))
 
+@app.route('/salud')
+def salud():
+    # Chequeo para Render y el monitoreo: conexión a la base y estado del pool del worker
+    try:
+        db.session.execute(text('SELECT 1'))
+        base_ok = True
+    except SQLAlchemyError:
+        db.session.rollback()
+        base_ok = False
+    return jsonify({'db': base_ok, 'pool': metricas_pool()}), 200 if base_ok else 503
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICAS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+    elif not (app.debug or app.testing or app.config['METRICAS_PUBLICAS']):
+        # Sin token configurado no se exponen las métricas en producción
+        abort(404)
+    return Response(metricas_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -138,8 +960,22 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
+
+        # La verificación del hash es CPU pura: se limita cuántas corren a la vez
+        with turno_de_login() as turno:
+            if not turno:
+                flash('Hay muchos inicios de sesión en este momento. Intente de nuevo en unos segundos.', 'warning')
+                return render_template('login.html'), 503
+
+            valido = user is not None and user.check_password(password)
+            if valido and user.necesita_rehash():
+                try:
+                    user.set_password(password)
+                    db.session.commit()
+                except SQLAlchemyError:
+                    db.session.rollback()
         
-        if user and user.check_password(password):
+        if valido:
             login_user(user)
             return redirect(url_for('dashboard'))
         else:
@@ -157,7 +993,152 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    return render_template('dashboard.html')
+    # Consumo de los últimos 30 días leído del acumulado diario (no de detalle_solicitud)
+    desde = datetime.utcnow().date() - timedelta(days=30)
+    solicitadas = func.sum(ConsumoDiario.unidades_solicitadas)
+    consumo = db.session.query(
+        Product.name.label('nombre'),
+        solicitadas.label('solicitadas'),
+        func.sum(ConsumoDiario.unidades_aprobadas).label('aprobadas')
+    ).join(ConsumoDiario, ConsumoDiario.product_id == Product.id
+    ).filter(ConsumoDiario.fecha >= desde
+    ).group_by(Product.id, Product.name
+    ).order_by(solicitadas.desc()).limit(10).all()
+    return render_template('dashboard.html', consumo=consumo)
+
+
+# -------------------------------------------------------------------------
+# LISTADOS CON BÚSQUEDA, ORDEN Y PAGINACIÓN KEYSET
+# -------------------------------------------------------------------------
+# ?q= busca cada palabra, sin distinguir mayúsculas, en las columnas de
+# CAMPOS_BUSQUEDA. En SQLite usa una tabla FTS5 <tabla>_fts por modelo
+# (palabras por prefijo, sincronizada con triggers); en Postgres LIKE sobre
+# lower(columna) con índices trigram (pg_trgm), que cubren prefijos y texto
+# intermedio como códigos o emails. Las tablas e índices los crea la migración 9.
+# ?orden= campo o -campo (descendente), ?cursor= continúa después de la última
+# fila de la página anterior. Con ?formato=json (o Accept: application/json)
+# responden JSON, para los campos con autocompletado.
+
+CAMPOS_BUSQUEDA = {
+    Product: ('name', 'code'),
+    Escuela: ('name',),
+    Supervisor: ('name', 'apellido', 'email'),
+    Bodega: ('name', 'location'),
+}
+
+ORDENES_LISTADO = {
+    Product: {'nombre': Product.name, 'codigo': Product.code, 'stock': func.coalesce(Product.stock, 0)},
+    Escuela: {'nombre': Escuela.name, 'id': Escuela.id},
+    Supervisor: {'apellido': Supervisor.apellido, 'nombre': Supervisor.name, 'email': Supervisor.email},
+    Bodega: {'nombre': Bodega.name},
+}
+
+def _item_listado(fila):
+    # Representación JSON de una fila; 'texto' es la etiqueta para el autocompletado
+    if isinstance(fila, Product):
+        return {'id': fila.id, 'code': fila.code, 'name': fila.name, 'stock': fila.stock,
+                'texto': f'{fila.code} - {fila.name}'}
+    if isinstance(fila, Supervisor):
+        return {'id': fila.id, 'name': fila.name, 'apellido': fila.apellido, 'email': fila.email,
+                'texto': f'{fila.name} {fila.apellido} ({fila.email})'}
+    if isinstance(fila, Bodega):
+        return {'id': fila.id, 'name': fila.name, 'location': fila.location, 'texto': fila.name}
+    return {'id': fila.id, 'name': fila.name, 'texto': fila.name}
+
+# Caché de las tablas FTS5 por worker: (instante de la consulta, nombres)
+_tablas_fts_cache = (None, frozenset())
+
+def olvidar_tablas_fts():
+    # Los demás workers lo verán como máximo tras BUSQUEDA_FTS_TTL segundos
+    global _tablas_fts_cache
+    _tablas_fts_cache = (None, frozenset())
+
+def _tablas_fts():
+    # Tablas FTS5 presentes (la compilación de SQLite puede no incluir FTS5)
+    global _tablas_fts_cache
+    consultado_en, tablas = _tablas_fts_cache
+    ahora = time.monotonic()
+    if consultado_en is None or ahora - consultado_en >= app.config['BUSQUEDA_FTS_TTL']:
+        with db.engine.connect() as conexion:
+            tablas = frozenset(conexion.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%\\_fts' ESCAPE '\\'"
+            )).scalars())
+        _tablas_fts_cache = (ahora, tablas)
+    return tablas
+
+def filtro_busqueda(modelo, texto):
+    """Condición SQL: cada palabra del texto aparece en alguna columna de búsqueda del modelo."""
+    palabras = re.findall(r'\w+', texto.lower())
+    if not palabras:
+        return true()
+    tabla = modelo.__tablename__
+    if db.engine.dialect.name == 'sqlite' and f'{tabla}_fts' in _tablas_fts():
+        consulta = ' '.join(f'"{palabra}"*' for palabra in palabras)
+        coincidencias = text(f"SELECT rowid FROM {tabla}_fts WHERE {tabla}_fts MATCH :consulta"
+                             ).bindparams(consulta=consulta).columns(column('rowid'))
+        return modelo.id.in_(coincidencias)
+    columnas = [getattr(modelo, campo) for campo in CAMPOS_BUSQUEDA[modelo]]
+    return and_(*(
+        or_(*(func.lower(columna).contains(palabra, autoescape=True) for columna in columnas))
+        for palabra in palabras
+    ))
+
+def _decodificar_cursor_listado(cursor, columna):
+    # Cursor "valor,id" con el valor de la columna de orden de la última fila mostrada
+    try:
+        valor, fila_id = cursor.rsplit(',', 1)
+        return columna.type.python_type(valor), int(fila_id)
+    except (AttributeError, ValueError, NotImplementedError):
+        return None
+
+def consulta_listado(modelo, args, orden_por_defecto):
+    """
+    Aplica búsqueda, orden y paginación keyset a un listado.
+    Devuelve (filas, siguiente_cursor, filtros activos sin el cursor).
+    """
+    ordenes = ORDENES_LISTADO[modelo]
+    orden = args.get('orden') or orden_por_defecto
+    if orden.lstrip('-') not in ordenes:
+        orden = orden_por_defecto
+    descendente = orden.startswith('-')
+    columna = ordenes[orden.lstrip('-')]
+    por_pagina = min(max(args.get('por_pagina', type=int) or app.config['LISTADOS_POR_PAGINA'], 1),
+                     app.config['LISTADOS_POR_PAGINA'])
+
+    query = db.session.query(modelo, columna)
+    q = (args.get('q') or '').strip()
+    if q:
+        query = query.filter(filtro_busqueda(modelo, q))
+    cursor = _decodificar_cursor_listado(args.get('cursor'), columna)
+    if cursor:
+        valor, fila_id = cursor
+        if descendente:
+            query = query.filter(or_(columna < valor, and_(columna == valor, modelo.id < fila_id)))
+        else:
+            query = query.filter(or_(columna > valor, and_(columna == valor, modelo.id > fila_id)))
+    if descendente:
+        query = query.order_by(columna.desc(), modelo.id.desc())
+    else:
+        query = query.order_by(columna, modelo.id)
+    resultado = query.limit(por_pagina + 1).all()
+
+    siguiente_cursor = None
+    if len(resultado) > por_pagina:
+        resultado = resultado[:por_pagina]
+        fila, valor = resultado[-1]
+        siguiente_cursor = f'{valor},{fila.id}'
+    filtros = {k: v for k, v in args.items() if k != 'cursor' and v}
+    return [fila for fila, valor in resultado], siguiente_cursor, filtros
+
+def _quiere_json():
+    return request.args.get('formato') == 'json' or request.accept_mimetypes.best == 'application/json'
+
+def responder_listado(modelo, plantilla, nombre, orden_por_defecto, **contexto):
+    filas, siguiente_cursor, filtros = consulta_listado(modelo, request.args, orden_por_defecto)
+    if _quiere_json():
+        return jsonify({'resultados': [_item_listado(fila) for fila in filas], 'siguiente': siguiente_cursor})
+    return render_template(plantilla, siguiente_cursor=siguiente_cursor, filtros=filtros,
+                           ordenes=list(ORDENES_LISTADO[modelo]), **{nombre: filas}, **contexto)
 
 
 # -------------------------------------------------------------------------
@@ -167,8 +1148,7 @@ def dashboard():
 @app.route('/bodegas')
 @login_required
 def list_bodegas():
-    bodegas = Bodega.query.all()
-    return render_template('bodegas.html', bodegas=bodegas)
+    return responder_listado(Bodega, 'bodegas.html', 'bodegas', 'nombre')
 
 @app.route('/bodegas/crear', methods=['GET', 'POST'])
 @login_required
@@ -229,7 +1209,10 @@ def edit_bodega(id):
 @login_required
 def delete_bodega(id):
     bodega = db.session.get(Bodega, id) or None
-    if bodega:
+    if bodega and db.session.query(MovimientoStock.id).filter_by(bodega_id=id).first() is not None:
+        # El libro de inventario es auditable: no se borran bodegas con movimientos
+        flash('No se puede eliminar una bodega con movimientos de inventario.', 'error')
+    elif bodega:
         try:
             db.session.delete(bodega)
             db.session.commit()
@@ -242,6 +1225,249 @@ def delete_bodega(id):
     return redirect(url_for('list_bodegas'))
 
 
+# -------------------------------------------------------------------------
+# INVENTARIO POR BODEGA (LIBRO DE MOVIMIENTOS)
+# -------------------------------------------------------------------------
+# movimiento_stock es el historial completo (solo se agregan filas);
+# saldo_bodega guarda el saldo actual de cada (bodega, producto) y se actualiza
+# en la misma transacción que cada movimiento. Product.stock es el total
+# disponible (existencia - reservado) de todas las bodegas, para el catálogo.
+
+BODEGA_PRINCIPAL = 'Bodega principal'
+
+# Efecto por unidad de cada tipo de movimiento sobre (existencia, reservado)
+TIPOS_MOVIMIENTO = {
+    'recepcion': (1, 0),
+    'reserva': (0, 1),   # pedido aprobado: sigue en la bodega pero ya no está disponible
+    'despacho': (-1, -1), # sale de la bodega lo que estaba reservado
+    'ajuste': (1, 0),    # la cantidad puede ser negativa (conteo físico, mermas)
+}
+
+def bodega_por_defecto():
+    # Destino del stock que no indica bodega (alta de productos, importación)
+    bodega_id = db.session.query(func.min(Bodega.id)).scalar()
+    if bodega_id is None:
+        bodega = Bodega(name=BODEGA_PRINCIPAL)
+        db.session.add(bodega)
+        db.session.flush()
+        bodega_id = bodega.id
+    return bodega_id
+
+def registrar_movimiento(bodega_id, product_id, tipo, cantidad, solicitud_id=None, nota=None):
+    """
+    Agrega un movimiento al libro y actualiza saldo_bodega y Product.stock en
+    la transacción actual. El UPDATE del saldo es condicional, así nunca queda
+    existencia negativa ni más reservado que existencia, aun con aprobaciones
+    concurrentes. Devuelve False (sin escribir nada) si el saldo no alcanza.
+
+    El llamador confirma o revierte; al confirmar se incrementa la versión del catálogo.
+    """
+    por_existencia, por_reservado = TIPOS_MOVIMIENTO[tipo]
+    existencia, reservado = por_existencia * cantidad, por_reservado * cantidad
+    disponible = existencia - reservado
+
+    if existencia > 0:
+        # Primera entrada de este producto en la bodega
+        insertar = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+        db.session.execute(insertar(SaldoBodega).values(
+            bodega_id=bodega_id, product_id=product_id, existencia=0, reservado=0
+        ).on_conflict_do_nothing(index_elements=['bodega_id', 'product_id']))
+
+    actualizado = db.session.execute(
+        update(SaldoBodega)
+        .where(SaldoBodega.bodega_id == bodega_id,
+               SaldoBodega.product_id == product_id,
+               SaldoBodega.reservado + reservado >= 0,
+               SaldoBodega.existencia - SaldoBodega.reservado + disponible >= 0)
+        .values(existencia=SaldoBodega.existencia + existencia,
+                reservado=SaldoBodega.reservado + reservado)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if actualizado != 1:
+        return False
+
+    db.session.execute(insert(MovimientoStock).values(
+        bodega_id=bodega_id, product_id=product_id, tipo=tipo,
+        existencia=existencia, reservado=reservado, solicitud_id=solicitud_id,
+        usuario_id=current_user.id if has_request_context() and current_user.is_authenticated else None,
+        nota=nota, creado_en=datetime.utcnow()
+    ))
+    if disponible:
+        db.session.execute(
+            update(Product).where(Product.id == product_id)
+            .values(stock=Product.stock + disponible, version_catalogo=None)
+            .execution_options(synchronize_session=False)
+        )
+    return True
+
+def _asignar_bodegas(product_id, cantidad):
+    """
+    Reparte una cantidad entre las bodegas con disponible, empezando por la más
+    llena (menos divisiones del pedido y se vacían menos bodegas pequeñas).
+    Devuelve [(bodega_id, cantidad)] o None si el total disponible no alcanza.
+    """
+    disponibles = db.session.query(
+        SaldoBodega.bodega_id, SaldoBodega.existencia - SaldoBodega.reservado
+    ).filter(
+        SaldoBodega.product_id == product_id,
+        SaldoBodega.existencia > SaldoBodega.reservado
+    ).order_by((SaldoBodega.existencia - SaldoBodega.reservado).desc(), SaldoBodega.bodega_id).all()
+
+    asignacion = []
+    for bodega_id, disponible in disponibles:
+        tomar = min(cantidad, disponible)
+        asignacion.append((bodega_id, tomar))
+        cantidad -= tomar
+        if cantidad == 0:
+            return asignacion
+    return None
+
+def pendiente_de_despacho(solicitud_id):
+    # Reservado por la solicitud y aún no despachado, por (bodega, producto)
+    filas = db.session.query(
+        MovimientoStock.bodega_id, MovimientoStock.product_id, func.sum(MovimientoStock.reservado)
+    ).filter(
+        MovimientoStock.solicitud_id == solicitud_id,
+        MovimientoStock.tipo.in_(('reserva', 'despacho'))
+    ).group_by(MovimientoStock.bodega_id, MovimientoStock.product_id).all()
+    return [(bodega_id, product_id, int(cantidad)) for bodega_id, product_id, cantidad in filas if cantidad > 0]
+
+def _bloquear_movimientos():
+    # Espera a que confirmen las transacciones con movimientos en curso y frena las nuevas
+    # hasta el commit. registrar_movimiento escribe saldo_bodega antes que el libro, así que
+    # toda transacción con un movimiento sin confirmar ya tiene tomado saldo_bodega.
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('LOCK TABLE saldo_bodega IN EXCLUSIVE MODE'))
+    else:
+        # SQLite admite un solo escritor: BEGIN IMMEDIATE espera al que esté escribiendo
+        abrir_transaccion_escritura()
+
+def tomar_snapshot_saldos():
+    """
+    Guarda en saldo_snapshot los saldos acumulados hasta el último movimiento
+    confirmado. Los ids se asignan al insertar y no al confirmar, por eso el
+    corte se lee bajo el mismo bloqueo que toman los movimientos: ningún id
+    menor puede confirmarse después. Solo suma los movimientos posteriores al
+    snapshot anterior. Devuelve el id del último movimiento incluido.
+    """
+    _bloquear_movimientos()
+    hasta = db.session.query(func.max(MovimientoStock.id)).scalar() or 0
+    # El bloqueo se libera enseguida: los movimientos nuevos tendrán ids mayores que el corte
+    db.session.commit()
+    saldos, desde = _saldos_desde_snapshot(hasta)
+    if hasta <= desde:
+        db.session.rollback()
+        return desde
+
+    db.session.query(SaldoSnapshot).delete(synchronize_session=False)
+    filas = [{'bodega_id': b, 'product_id': p, 'existencia': e, 'reservado': r, 'hasta_movimiento_id': hasta}
+             for (b, p), (e, r) in saldos.items()]
+    if filas:
+        db.session.execute(insert(SaldoSnapshot), filas)
+    db.session.commit()
+    return hasta
+
+def _saldos_desde_snapshot(hasta=None):
+    # Snapshot + suma de los movimientos posteriores (hasta el id indicado, o todos)
+    snapshot = db.session.query(SaldoSnapshot).all()
+    desde = snapshot[0].hasta_movimiento_id if snapshot else 0
+    saldos = {(s.bodega_id, s.product_id): (s.existencia, s.reservado) for s in snapshot}
+
+    nuevos = db.session.query(
+        MovimientoStock.bodega_id, MovimientoStock.product_id,
+        func.sum(MovimientoStock.existencia), func.sum(MovimientoStock.reservado)
+    ).filter(MovimientoStock.id > desde)
+    if hasta is not None:
+        nuevos = nuevos.filter(MovimientoStock.id <= hasta)
+    for bodega_id, product_id, existencia, reservado in nuevos.group_by(MovimientoStock.bodega_id, MovimientoStock.product_id):
+        anterior = saldos.get((bodega_id, product_id), (0, 0))
+        saldos[(bodega_id, product_id)] = (anterior[0] + int(existencia), anterior[1] + int(reservado))
+    return saldos, desde
+
+def reconstruir_saldos(verificar=False):
+    """
+    Recalcula saldo_bodega y Product.stock desde el libro (snapshot + repetición
+    de los movimientos posteriores). Con verificar=True no escribe y devuelve
+    las diferencias encontradas [(bodega_id, product_id, guardado, calculado)].
+    """
+    if not verificar:
+        # Sin movimientos nuevos mientras se reescriben los saldos
+        _bloquear_movimientos()
+    saldos, _ = _saldos_desde_snapshot()
+    saldos = {clave: valor for clave, valor in saldos.items() if valor != (0, 0)}
+
+    if verificar:
+        guardados = {(s.bodega_id, s.product_id): (s.existencia, s.reservado)
+                     for s in db.session.query(SaldoBodega).filter(
+                         or_(SaldoBodega.existencia != 0, SaldoBodega.reservado != 0))}
+        diferencias = [(b, p, guardados.get((b, p)), saldos.get((b, p)))
+                       for b, p in sorted(set(guardados) | set(saldos))
+                       if guardados.get((b, p)) != saldos.get((b, p))]
+        db.session.rollback()
+        return diferencias
+
+    db.session.query(SaldoBodega).delete(synchronize_session=False)
+    if saldos:
+        db.session.execute(insert(SaldoBodega), [
+            {'bodega_id': b, 'product_id': p, 'existencia': e, 'reservado': r} for (b, p), (e, r) in saldos.items()
+        ])
+    disponible = defaultdict(int)
+    for (_, product_id), (existencia, reservado) in saldos.items():
+        disponible[product_id] += existencia - reservado
+    productos = [product_id for product_id, in db.session.query(Product.id)]
+    if productos:
+        db.session.execute(update(Product), [{'id': pid, 'stock': disponible.get(pid, 0), 'version_catalogo': None}
+                                             for pid in productos])
+    db.session.commit()
+    return len(saldos)
+
+@app.route('/bodegas/<int:id>/inventario', methods=['GET', 'POST'])
+@login_required
+def inventario_bodega(id):
+    bodega = db.get_or_404(Bodega, id)
+
+    if request.method == 'POST':
+        tipo = request.form.get('tipo')
+        code = (request.form.get('code') or '').strip()
+        cantidad = request.form.get('cantidad', type=int)
+        producto = Product.query.filter_by(code=code).first() if code else None
+        if tipo not in ('recepcion', 'ajuste') or not producto or not cantidad \
+                or (tipo == 'recepcion' and cantidad < 0):
+            flash('Indique un tipo válido, un código de producto existente y una cantidad.', 'error')
+            return redirect(url_for('inventario_bodega', id=id))
+        try:
+            if registrar_movimiento(id, producto.id, tipo, cantidad, nota=request.form.get('nota') or None):
+                db.session.commit()
+                flash(f'Movimiento registrado: {tipo} de {cantidad} x {producto.name}.', 'success')
+            else:
+                db.session.rollback()
+                flash('El ajuste dejaría la existencia por debajo de lo reservado.', 'error')
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            flash(f'Error al registrar el movimiento: {e}', 'error')
+        return redirect(url_for('inventario_bodega', id=id))
+
+    saldos = db.session.query(
+        Product.code, Product.name, SaldoBodega.existencia, SaldoBodega.reservado
+    ).join(Product, Product.id == SaldoBodega.product_id).filter(
+        SaldoBodega.bodega_id == id
+    ).order_by(Product.name).all()
+
+    # Historial paginado por id descendente (?antes=<id>)
+    por_pagina = 100
+    historial = db.session.query(MovimientoStock, Product.code).join(
+        Product, Product.id == MovimientoStock.product_id
+    ).filter(MovimientoStock.bodega_id == id)
+    antes = request.args.get('antes', type=int)
+    if antes:
+        historial = historial.filter(MovimientoStock.id < antes)
+    movimientos = historial.order_by(MovimientoStock.id.desc()).limit(por_pagina + 1).all()
+    siguiente = movimientos[por_pagina - 1][0].id if len(movimientos) > por_pagina else None
+
+    return render_template('inventario_bodega.html', bodega=bodega, saldos=saldos,
+                           movimientos=movimientos[:por_pagina], siguiente=siguiente)
+
+
 # -------------------------------------------------------------------------
 # RUTAS DE PRODUCTOS (CRUD)
 # -------------------------------------------------------------------------
@@ -249,8 +1475,31 @@ def delete_bodega(id):
 @app.route('/productos')
 @login_required
 def list_products():
-    productos = Product.query.all()
-    return render_template('productos.html', productos=productos)
+    if _quiere_json():
+        return responder_listado(Product, 'productos.html', 'productos', 'nombre')
+    productos, siguiente_cursor, filtros = consulta_listado(Product, request.args, 'nombre')
+    # Pronóstico ya calculado por la tarea programada: aquí solo se compara con el stock actual
+    pronosticos = {p.product_id: p for p in PronosticoDemanda.query.filter(
+        PronosticoDemanda.bodega_id.is_(None), PronosticoDemanda.product_id.in_([p.id for p in productos]))}
+    return render_template('productos.html', productos=productos, pronosticos=pronosticos,
+                           siguiente_cursor=siguiente_cursor, filtros=filtros,
+                           ordenes=list(ORDENES_LISTADO[Product]))
+
+@app.route('/productos/reposicion')
+@login_required
+def reposicion():
+    filas = (PronosticoDemanda.query
+             .options(joinedload(PronosticoDemanda.product), joinedload(PronosticoDemanda.bodega))
+             .order_by(PronosticoDemanda.reponer.desc(),
+                       PronosticoDemanda.dias_cobertura.is_(None),
+                       PronosticoDemanda.dias_cobertura,
+                       PronosticoDemanda.product_id,
+                       PronosticoDemanda.bodega_id.isnot(None),
+                       PronosticoDemanda.bodega_id)
+             .all())
+    return render_template('reposicion.html', filas=filas,
+                           calculado_en=filas[0].calculado_en if filas else None,
+                           plazo=app.config['PRONOSTICO_PLAZO_DIAS'])
 
 @app.route('/productos/agregar', methods=['GET', 'POST'])
 @login_required
@@ -264,9 +1513,12 @@ def add_product():
             flash('Nombre y Código del producto son obligatorios.', 'error')
             return render_template('crear_producto.html')
 
-        new_product = Product(name=name, code=code, stock=stock)
+        new_product = Product(name=name, code=code, stock=0)
         try:
             db.session.add(new_product)
+            db.session.flush()
+            if stock > 0:
+                registrar_movimiento(bodega_por_defecto(), new_product.id, 'recepcion', stock, nota='Stock inicial')
             db.session.commit()
             flash('Producto agregado correctamente.', 'success')
             return redirect(url_for('list_products'))
@@ -287,15 +1539,52 @@ def redirect_to_add_product():
 @app.route('/product/qr/<code>')
 @login_required
 def generate_qr(code):
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-    qr.add_data(code)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode()
     product = Product.query.filter_by(code=code).first_or_404()
-    return render_template('qr_code.html', qr_base64=qr_base64, item=product, item_type='Producto')
+    return render_template('qr_code.html', qr_url=url_for('product_qr_png', code=product.code), item=product, item_type='Producto')
+
+# Ruta propia para la imagen: un código que termina en ".png" sigue llegando a generate_qr
+@app.route('/product/qr/<code>/imagen.png')
+@login_required
+def product_qr_png(code):
+    # Solo productos existentes: el almacén en disco no crece con códigos arbitrarios
+    product = Product.query.filter_by(code=code).first_or_404()
+    return respuesta_qr_png(product.code)
+
+@app.route('/qr/lote.zip')
+@login_required
+def exportar_qr_lote():
+    # Exportación masiva de QR para imprimir etiquetas: tipo = escuelas, productos o todos
+    tipo = request.args.get('tipo', 'todos')
+    if tipo not in TIPOS_QR_LOTE:
+        abort(400)
+
+    # Los payloads se calculan antes de transmitir (url_for necesita el contexto de la petición)
+    items = _items_qr_lote(tipo)
+    if len(items) > app.config['QR_LOTE_EN_LINEA']:
+        # Un pool de procesos dentro de un worker web con hilos o greenlets no es seguro
+        # (fork con hilos activos) y ocuparía el worker: el lote grande va a la cola
+        trabajo = encolar_trabajo('qr_lote', {'tipo': tipo})
+        flash(f'{len(items)} códigos QR: el ZIP se generará en segundo plano.', 'info')
+        return redirect(url_for('ver_trabajo', trabajo_id=trabajo.id))
+    return Response(generar_zip_qr(items, 1),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=qr_{tipo}.zip'})
+
+TIPOS_QR_LOTE = ('escuelas', 'productos', 'todos')
+
+def _items_qr_lote(tipo):
+    # (nombre dentro del ZIP, payload) de cada código QR del lote
+    items = []
+    if tipo in ('escuelas', 'todos'):
+        for escuela_id, name in db.session.query(Escuela.id, Escuela.name).order_by(Escuela.id):
+            url_pedido = url_for('hacer_pedido_escuela', escuela_id=escuela_id, _external=True)
+            nombre = secure_filename(f"escuela_{escuela_id}_{name}") or f"escuela_{escuela_id}"
+            items.append((f"escuelas/{nombre}.png", url_pedido))
+    if tipo in ('productos', 'todos'):
+        for product_id, code in db.session.query(Product.id, Product.code).order_by(Product.id):
+            nombre = secure_filename(code) or f"producto_{product_id}"
+            items.append((f"productos/{nombre}.png", code))
+    return items
 
 
 # -------------------------------------------------------------------------
@@ -305,8 +1594,7 @@ def generate_qr(code):
 @app.route('/supervisores')
 @login_required
 def list_supervisores():
-    supervisores = Supervisor.query.all()
-    return render_template('supervisores.html', supervisores=supervisores)
+    return responder_listado(Supervisor, 'supervisores.html', 'supervisores', 'apellido')
 
 @app.route('/supervisores/crear', methods=['GET', 'POST'])
 @login_required
@@ -354,42 +1642,34 @@ def view_supervisor_qr(id):
         flash('Supervisor no encontrado.', 'error')
         return redirect(url_for('list_supervisores'))
 
-    # 1. Obtener los IDs de las escuelas asignadas
-    asignaciones = SupervisorEscuela.query.filter_by(supervisor_id=id).all()
-    escuela_ids = [a.escuela_id for a in asignaciones]
-    
-    # 2. Obtener los pedidos de las escuelas ASIGNADAS
-    if escuela_ids:
-        solicitudes = Solicitud.query.filter(
-            Solicitud.escuela_id.in_(escuela_ids)
-        ).order_by(Solicitud.fecha_solicitud.desc()).all()
-    else:
-        solicitudes = []
+    # 1. Pedidos de las escuelas ASIGNADAS, en una sola consulta (subconsulta sobre supervisor_escuela)
+    escuelas_asignadas = db.select(SupervisorEscuela.escuela_id).where(SupervisorEscuela.supervisor_id == id)
+    solicitudes = Solicitud.query.options(joinedload(Solicitud.escuela)).filter(
+        Solicitud.escuela_id.in_(escuelas_asignadas)
+    ).order_by(Solicitud.fecha_solicitud.desc()).all()
+
+    # 2. Sin pedidos: revisar si es porque no tiene escuelas asignadas
+    if not solicitudes and not db.session.query(escuelas_asignadas.exists()).scalar():
         flash('Este supervisor no tiene escuelas asignadas. Por favor, asigne una escuela.', 'warning')
         
-    # 3. Lógica para generar QR (usando el campo qr_code_data)
-    qr_data = supervisor.qr_code_data
-    
-    # Manejar caso si el QR data es None (supervisores antiguos)
-    if not qr_data:
+    # 3. Manejar caso si el QR data es None (supervisores antiguos)
+    if not supervisor.qr_code_data:
         flash('El QR del supervisor estaba vacío. Intente editar y guardar para regenerarlo permanentemente.', 'warning')
-        qr_data = f"SUPERVISOR_EMAIL:{supervisor.email}" 
-    
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode()
-    
-    # 4. Renderizamos la plantilla con el QR y las Solicitudes filtradas
+
+    # 4. Renderizamos la plantilla con la URL del QR y las Solicitudes filtradas
     return render_template('qr_supervisor_pedidos.html', 
-                           qr_base64=qr_base64, 
+                           qr_url=url_for('supervisor_qr_png', id=supervisor.id), 
                            supervisor=supervisor, 
                            solicitudes=solicitudes) 
 
+@app.route('/supervisores/qr/<int:id>.png')
+@login_required
+def supervisor_qr_png(id):
+    supervisor = db.session.get(Supervisor, id)
+    if not supervisor:
+        abort(404)
+    return respuesta_qr_png(_qr_data_supervisor(supervisor))
+
 @app.route('/supervisores/editar/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_supervisor(id):
@@ -456,8 +1736,7 @@ def delete_supervisor(id):
 @app.route('/escuelas')
 @login_required
 def list_escuelas():
-    escuelas = Escuela.query.all()
-    return render_template('escuelas.html', escuelas=escuelas)
+    return responder_listado(Escuela, 'escuelas.html', 'escuelas', 'nombre')
 
 @app.route('/escuelas/crear', methods=['GET', 'POST'])
 @login_required
@@ -492,26 +1771,233 @@ def create_escuela():
 # RUTAS DE PEDIDOS (Admin y Público)
 # -------------------------------------------------------------------------
 
+def _codificar_cursor(solicitud):
+    # El cursor identifica la última fila mostrada: "fecha_iso,id"
+    return f"{solicitud.fecha_solicitud.isoformat()},{solicitud.id}"
+
+def _decodificar_cursor(cursor):
+    try:
+        fecha, solicitud_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(fecha), int(solicitud_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _filtrar_solicitudes(query, args):
+    # Filtros comunes de la lista de pedidos: estado, escuela y supervisor
+    estado = args.get('estado')
+    escuela_id = args.get('escuela_id', type=int)
+    supervisor_id = args.get('supervisor_id', type=int)
+
+    if estado:
+        query = query.filter(Solicitud.estado == estado)
+    if escuela_id:
+        query = query.filter(Solicitud.escuela_id == escuela_id)
+    if supervisor_id:
+        query = query.filter(Solicitud.supervisor_id == supervisor_id)
+    return query
+
 @app.route('/pedidos')
 @login_required
 def pedidos_page():
-    # Obtener todas las solicitudes para que el administrador las revise
-    solicitudes = Solicitud.query.order_by(Solicitud.fecha_solicitud.desc()).all()
-    return render_template('pedidos.html', solicitudes=solicitudes)
+    por_pagina = app.config['PEDIDOS_POR_PAGINA']
+
+    # Escuela y supervisor se cargan en la misma consulta (sin N+1)
+    query = _filtrar_solicitudes(
+        Solicitud.query.options(
+            joinedload(Solicitud.escuela),
+            joinedload(Solicitud.supervisor)
+        ),
+        request.args
+    )
+
+    # Paginación keyset: continuar después de la última fila de la página anterior
+    cursor = _decodificar_cursor(request.args.get('cursor'))
+    if cursor:
+        fecha, solicitud_id = cursor
+        query = query.filter(or_(
+            Solicitud.fecha_solicitud < fecha,
+            and_(Solicitud.fecha_solicitud == fecha, Solicitud.id < solicitud_id)
+        ))
+
+    solicitudes = query.order_by(
+        Solicitud.fecha_solicitud.desc(), Solicitud.id.desc()
+    ).limit(por_pagina + 1).all()
+
+    siguiente_cursor = None
+    if len(solicitudes) > por_pagina:
+        solicitudes = solicitudes[:por_pagina]
+        siguiente_cursor = _codificar_cursor(solicitudes[-1])
+
+    # Filtros activos (sin el cursor) para construir los enlaces de navegación
+    filtros = {k: v for k, v in request.args.items() if k != 'cursor' and v}
+
+    return render_template('pedidos.html',
+                           solicitudes=solicitudes,
+                           siguiente_cursor=siguiente_cursor,
+                           filtros=filtros,
+                           # Solo la escuela/supervisor del filtro activo; el resto se busca
+                           # con el autocompletado (/escuelas y /supervisores en JSON)
+                           escuela=_registro_filtrado(Escuela, 'escuela_id'),
+                           supervisor=_registro_filtrado(Supervisor, 'supervisor_id'))
+
+def _registro_filtrado(modelo, parametro):
+    registro_id = request.args.get(parametro, type=int)
+    return db.session.get(modelo, registro_id) if registro_id else None
+
+
+def _generar_csv(encabezados, filas, filas_por_bloque):
+    # Escribe el CSV por bloques; el BOM inicial hace que Excel reconozca UTF-8
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff')
+    escritor.writerow(encabezados)
+    for numero, fila in enumerate(filas, start=1):
+        escritor.writerow(fila)
+        if numero % filas_por_bloque == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@app.route('/pedidos/exportar.csv')
+@login_required
+def exportar_pedidos():
+    """
+    Exporta el historial completo de pedidos (una fila por línea de detalle)
+    con los mismos filtros de la lista de pedidos. Las filas se leen con un
+    cursor del lado del servidor (yield_per) y se envían por bloques, así la
+    memoria es constante sin importar el tamaño del historial.
+    """
+    limite_sentencias_largo()
+    filas_por_bloque = app.config['EXPORTACION_FILAS_POR_BLOQUE']
+    encabezados, filas = filas_exportacion_pedidos(request.args, filas_por_bloque)
+    nombre = f"pedidos_{datetime.utcnow().strftime('%Y%m%d_%H%M')}.csv"
+    return Response(stream_with_context(_generar_csv(encabezados, filas, filas_por_bloque)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={nombre}'})
+
+def filas_exportacion_pedidos(filtros, filas_por_bloque):
+    # Encabezados y generador de filas de la exportación (también lo usa la cola de trabajos)
+    consulta = _filtrar_solicitudes(
+        db.select(
+            Solicitud.id,
+            Solicitud.fecha_solicitud,
+            Solicitud.estado,
+            Solicitud.fecha_aprobacion,
+            Escuela.name,
+            Supervisor.name,
+            Supervisor.apellido,
+            Supervisor.email,
+            Product.code,
+            Product.name,
+            DetalleSolicitud.cantidad_solicitada
+        ).select_from(Solicitud
+        ).join(Escuela, Escuela.id == Solicitud.escuela_id
+        ).join(Supervisor, Supervisor.id == Solicitud.supervisor_id
+        ).join(DetalleSolicitud, DetalleSolicitud.solicitud_id == Solicitud.id
+        ).join(Product, Product.id == DetalleSolicitud.product_id),
+        filtros
+    ).order_by(Solicitud.fecha_solicitud, Solicitud.id, DetalleSolicitud.id
+    ).execution_options(yield_per=filas_por_bloque)
+
+    def filas():
+        for fila in db.session.execute(consulta):
+            solicitud_id, fecha, estado, fecha_aprobacion = fila[:4]
+            yield (
+                solicitud_id,
+                fecha.strftime('%Y-%m-%d %H:%M:%S') if fecha else '',
+                estado,
+                fecha_aprobacion.strftime('%Y-%m-%d %H:%M:%S') if fecha_aprobacion else '',
+                *fila[4:]
+            )
+
+    encabezados = ['solicitud_id', 'fecha_solicitud', 'estado', 'fecha_aprobacion', 'escuela',
+                   'supervisor_nombre', 'supervisor_apellido', 'supervisor_email',
+                   'producto_codigo', 'producto_nombre', 'cantidad_solicitada']
+    return encabezados, filas()
 
 
 @app.route('/pedidos/<int:solicitud_id>')
 @login_required
 def view_solicitud(solicitud_id):
-    solicitud = db.session.get(Solicitud, solicitud_id)
+    # Escuela, supervisor y productos se cargan con su solicitud/detalle (sin una consulta por fila)
+    solicitud = db.session.get(Solicitud, solicitud_id,
+                               options=[joinedload(Solicitud.escuela), joinedload(Solicitud.supervisor)])
     if not solicitud:
         flash('Solicitud no encontrada.', 'error')
         return redirect(url_for('pedidos_page'))
 
-    detalles = DetalleSolicitud.query.filter_by(solicitud_id=solicitud_id).all()
+    detalles = DetalleSolicitud.query.options(
+        joinedload(DetalleSolicitud.producto)
+    ).filter_by(solicitud_id=solicitud_id).order_by(DetalleSolicitud.id).all()
+    por_despachar = pendiente_de_despacho(solicitud_id) if solicitud.estado == 'Aprobada' else []
+
+    return render_template('detalle_solicitud.html', solicitud=solicitud, detalles=detalles,
+                           por_despachar=por_despachar)
+
+
+def acumular_consumo(filas):
+    """
+    Suma filas {fecha, escuela_id, product_id, unidades_solicitadas,
+    unidades_aprobadas, pedidos} a consumo_diario con un solo upsert
+    (INSERT ... ON CONFLICT DO UPDATE) ejecutado como executemany,
+    dentro de la transacción actual.
+    """
+    if not filas:
+        return
+    insertar = pg_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    sentencia = insertar(ConsumoDiario)
+    sentencia = sentencia.on_conflict_do_update(
+        index_elements=['fecha', 'escuela_id', 'product_id'],
+        set_={
+            'unidades_solicitadas': ConsumoDiario.unidades_solicitadas + sentencia.excluded.unidades_solicitadas,
+            'unidades_aprobadas': ConsumoDiario.unidades_aprobadas + sentencia.excluded.unidades_aprobadas,
+            'pedidos': ConsumoDiario.pedidos + sentencia.excluded.pedidos,
+        }
+    )
+    db.session.execute(sentencia, filas)
 
-    return render_template('detalle_solicitud.html', solicitud=solicitud, detalles=detalles)
+def _filas_consumo_aprobado(escuela_id, cantidades, fecha):
+    return [
+        {'fecha': fecha, 'escuela_id': escuela_id, 'product_id': product_id,
+         'unidades_solicitadas': 0, 'unidades_aprobadas': cantidad, 'pedidos': 0}
+        for product_id, cantidad in cantidades.items()
+    ]
 
+def _demanda_por_solicitud(solicitud_ids):
+    # Una sola consulta agregada: {solicitud_id: {product_id: cantidad_total}}
+    filas = db.session.query(
+        DetalleSolicitud.solicitud_id,
+        DetalleSolicitud.product_id,
+        func.sum(DetalleSolicitud.cantidad_solicitada)
+    ).filter(
+        DetalleSolicitud.solicitud_id.in_(solicitud_ids)
+    ).group_by(DetalleSolicitud.solicitud_id, DetalleSolicitud.product_id).all()
+
+    demanda = {solicitud_id: {} for solicitud_id in solicitud_ids}
+    for solicitud_id, product_id, cantidad in filas:
+        demanda[solicitud_id][product_id] = int(cantidad)
+    return demanda
+
+def _reservar_stock(cantidades, solicitud_id):
+    """
+    Reserva en las bodegas (de la más llena a la menos llena) las cantidades
+    de una solicitud, con movimientos de tipo reserva. Cada saldo se descuenta
+    con un UPDATE condicional, de modo que dos aprobaciones concurrentes nunca
+    dejen el stock en negativo.
+
+    Devuelve el product_id sin stock suficiente, o None si todo se reservó.
+    El llamador debe hacer rollback de la transacción si hubo faltante.
+    """
+    # Orden fijo por id para evitar interbloqueos entre transacciones
+    for product_id in sorted(cantidades):
+        asignacion = _asignar_bodegas(product_id, cantidades[product_id])
+        if asignacion is None:
+            return product_id
+        for bodega_id, cantidad in asignacion:
+            if not registrar_movimiento(bodega_id, product_id, 'reserva', cantidad, solicitud_id=solicitud_id):
+                return product_id
+    return None
 
 @app.route('/pedidos/aprobar/<int:solicitud_id>', methods=['POST'])
 @login_required
@@ -524,23 +2010,34 @@ def aprobar_solicitud(solicitud_id):
     if solicitud.estado != 'Pendiente':
         flash('Esta solicitud ya ha sido procesada.', 'warning')
         return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
-        
-    detalles = DetalleSolicitud.query.filter_by(solicitud_id=solicitud_id).all()
+
+    cantidades = _demanda_por_solicitud([solicitud_id])[solicitud_id]
+    ahora = datetime.utcnow()
     try:
-        # Verificar y actualizar stock
-        for detalle in detalles:
-            producto = db.session.get(Product, detalle.product_id)
-            if producto and producto.stock >= detalle.cantidad_solicitada:
-                producto.stock -= detalle.cantidad_solicitada
-            else:
-                flash(f'ERROR: Stock insuficiente para {producto.name}. Solicitud no aprobada.', 'error')
-                return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
+        # Marcar como aprobada solo si sigue Pendiente (evita aprobar dos veces en paralelo)
+        resultado = db.session.execute(
+            update(Solicitud)
+            .where(Solicitud.id == solicitud_id, Solicitud.estado == 'Pendiente')
+            .values(estado='Aprobada', fecha_aprobacion=ahora)
+            .execution_options(synchronize_session=False)
+        )
+        if resultado.rowcount != 1:
+            db.session.rollback()
+            flash('Esta solicitud ya ha sido procesada.', 'warning')
+            return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
+
+        # Verificar y descontar stock en la misma transacción
+        faltante = _reservar_stock(cantidades, solicitud_id)
+        if faltante is not None:
+            db.session.rollback()
+            producto = db.session.get(Product, faltante)
+            flash(f'ERROR: Stock insuficiente para {producto.name}. Solicitud no aprobada.', 'error')
+            return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
 
-        solicitud.estado = 'Aprobada'
-        solicitud.fecha_aprobacion = datetime.utcnow()
+        acumular_consumo(_filas_consumo_aprobado(solicitud.escuela_id, cantidades, ahora.date()))
         db.session.commit()
         flash('Solicitud Aprobada y Stock Actualizado exitosamente.', 'success')
-        
+
     except SQLAlchemyError as e:
         db.session.rollback()
         flash(f'Error al procesar la aprobación: {e}', 'error')
@@ -548,6 +2045,354 @@ def aprobar_solicitud(solicitud_id):
     return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
 
 
+@app.route('/pedidos/despachar/<int:solicitud_id>', methods=['POST'])
+@login_required
+def despachar_solicitud(solicitud_id):
+    # Registra la salida de lo reservado en cada bodega al aprobar la solicitud
+    solicitud = db.session.get(Solicitud, solicitud_id)
+    if not solicitud or solicitud.estado != 'Aprobada':
+        flash('Solo se pueden despachar solicitudes aprobadas.', 'error')
+        return redirect(url_for('pedidos_page'))
+
+    pendientes = pendiente_de_despacho(solicitud_id)
+    if not pendientes:
+        flash('Esta solicitud ya fue despachada.', 'warning')
+        return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
+    try:
+        for bodega_id, product_id, cantidad in pendientes:
+            if not registrar_movimiento(bodega_id, product_id, 'despacho', cantidad, solicitud_id=solicitud_id):
+                # La reserva ya no cubre la salida (p. ej. un ajuste posterior): no se despacha nada
+                db.session.rollback()
+                flash('El saldo reservado de la bodega no alcanza para despachar esta solicitud. '
+                      'Revise el inventario de la bodega.', 'error')
+                return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
+        db.session.commit()
+        flash('Despacho registrado en el inventario de las bodegas.', 'success')
+    except IntegrityError:
+        # uq_movimiento_stock_solicitud: otro usuario la despachó en paralelo
+        db.session.rollback()
+        flash('Esta solicitud ya fue despachada.', 'warning')
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f'Error al registrar el despacho: {e}', 'error')
+    return redirect(url_for('view_solicitud', solicitud_id=solicitud_id))
+
+
+@app.route('/pedidos/aprobar-lote', methods=['POST'])
+@login_required
+def aprobar_solicitudes_lote():
+    """
+    Aprueba varias solicitudes Pendientes en una sola transacción, de la más
+    antigua a la más reciente, reservando cada una en las bodegas; las que no
+    alcanzan stock quedan Pendientes sin afectar al resto. Acepta una lista de
+    ids (solicitud_ids) o un supervisor_id para tomar todas sus pendientes.
+    Responde JSON si la petición es JSON; si no, muestra un resumen y redirige.
+    """
+    if request.is_json:
+        datos = request.get_json(silent=True)
+        if not isinstance(datos, dict):
+            return jsonify({'error': 'El cuerpo debe ser un objeto JSON.'}), 400
+        solicitud_ids = datos.get('solicitud_ids') or []
+        supervisor_id = datos.get('supervisor_id')
+        # bool es subclase de int: true/false no son ids válidos
+        if not isinstance(solicitud_ids, list) or not all(
+                isinstance(i, int) and not isinstance(i, bool) and i > 0 for i in solicitud_ids):
+            return jsonify({'error': 'solicitud_ids debe ser una lista de ids enteros.'}), 400
+        if supervisor_id is not None and (
+                not isinstance(supervisor_id, int) or isinstance(supervisor_id, bool) or supervisor_id <= 0):
+            return jsonify({'error': 'supervisor_id debe ser un id entero.'}), 400
+    else:
+        solicitud_ids = request.form.getlist('solicitud_ids', type=int)
+        supervisor_id = request.form.get('supervisor_id', type=int)
+
+    if not solicitud_ids and not supervisor_id:
+        mensaje = 'Debe indicar las solicitudes a aprobar o un supervisor.'
+        if request.is_json:
+            return jsonify({'error': mensaje}), 400
+        flash(mensaje, 'error')
+        return redirect(url_for('pedidos_page'))
+
+    query = Solicitud.query.filter(Solicitud.estado == 'Pendiente')
+    if solicitud_ids:
+        query = query.filter(Solicitud.id.in_(solicitud_ids))
+    else:
+        query = query.filter(Solicitud.supervisor_id == supervisor_id)
+    # Prioridad: primero las solicitudes más antiguas
+    pendientes = query.order_by(Solicitud.fecha_solicitud.asc(), Solicitud.id.asc()).all()
+
+    resultados = []
+    pendientes_ids = {s.id for s in pendientes}
+    for solicitud_id in solicitud_ids:
+        if solicitud_id not in pendientes_ids:
+            resultados.append({'solicitud_id': solicitud_id, 'resultado': 'Ya procesada o no encontrada'})
+
+    aprobadas = []
+    try:
+        demanda = _demanda_por_solicitud(list(pendientes_ids))
+        ahora = datetime.utcnow()
+        consumo = defaultdict(lambda: defaultdict(int))
+        abrir_transaccion_escritura()
+
+        # Cada solicitud en su propio SAVEPOINT: si su reserva falla en alguna bodega
+        # se deshace solo esa, y las demás del lote siguen su curso
+        for solicitud in pendientes:
+            cantidades = demanda[solicitud.id]
+            punto = db.session.begin_nested()
+            # Marcar como aprobada solo si sigue Pendiente (otro usuario pudo procesarla)
+            actualizada = db.session.execute(
+                update(Solicitud)
+                .where(Solicitud.id == solicitud.id, Solicitud.estado == 'Pendiente')
+                .values(estado='Aprobada', fecha_aprobacion=ahora)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if actualizada != 1:
+                # Otro usuario la procesó en paralelo: se descarta el lote para no aprobar con datos viejos
+                db.session.rollback()
+                mensaje = 'Las solicitudes cambiaron durante la aprobación. Intente de nuevo.'
+                if request.is_json:
+                    return jsonify({'error': mensaje}), 409
+                flash(mensaje, 'error')
+                return redirect(url_for('pedidos_page'))
+            if _reservar_stock(cantidades, solicitud.id) is not None:
+                punto.rollback()
+                resultados.append({'solicitud_id': solicitud.id, 'resultado': 'Stock insuficiente'})
+                continue
+            punto.commit()
+            aprobadas.append(solicitud.id)
+            resultados.append({'solicitud_id': solicitud.id, 'resultado': 'Aprobada'})
+            for pid, n in cantidades.items():
+                consumo[solicitud.escuela_id][pid] += n
+
+        acumular_consumo([
+            fila
+            for escuela_id, cantidades in consumo.items()
+            for fila in _filas_consumo_aprobado(escuela_id, cantidades, ahora.date())
+        ])
+        db.session.commit()
+
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify({'error': f'Error al procesar la aprobación: {e}'}), 500
+        flash(f'Error al procesar la aprobación: {e}', 'error')
+        return redirect(url_for('pedidos_page'))
+
+    if request.is_json:
+        return jsonify({'aprobadas': len(aprobadas), 'resultados': resultados})
+
+    rechazadas = len(resultados) - len(aprobadas)
+    flash(f'{len(aprobadas)} solicitud(es) aprobada(s) y stock actualizado.', 'success')
+    if rechazadas:
+        flash(f'{rechazadas} solicitud(es) no se aprobaron (stock insuficiente o ya procesadas).', 'warning')
+    return redirect(url_for('pedidos_page'))
+
+
+def _crear_limite_pedido(escuela_id, inicio_ventana):
+    # Primera vez para esta escuela: sembrar con los pedidos ya existentes en la ventana
+    recientes = db.session.query(Solicitud.fecha_solicitud).filter(
+        Solicitud.escuela_id == escuela_id,
+        Solicitud.fecha_solicitud >= inicio_ventana
+    ).order_by(Solicitud.fecha_solicitud).all()
+    try:
+        with db.session.begin_nested():
+            db.session.add(LimitePedidoEscuela(
+                escuela_id=escuela_id,
+                marcas=json.dumps([fecha.isoformat() for (fecha,) in recientes]),
+                version=0
+            ))
+    except IntegrityError:
+        pass # Otro proceso la creó al mismo tiempo
+
+def _consumir_cupo_pedido(escuela_id, ahora):
+    """
+    Reserva un cupo de pedido para la escuela en la transacción actual.
+    La fila de la escuela guarda solo las fechas de los últimos pedidos
+    aceptados, así que la verificación es O(límite) y no un COUNT sobre
+    Solicitud. La escritura es un compare-and-swap sobre `version`: dos
+    envíos simultáneos nunca consumen el mismo cupo. Si la transacción se
+    revierte, el cupo vuelve a quedar libre.
+
+    Devuelve (aceptado, limite).
+    """
+    inicio_ventana = ahora - timedelta(days=app.config['VENTANA_PEDIDOS_DIAS'])
+    limite = app.config['PEDIDOS_POR_SEMANA']
+
+    for _ in range(5):
+        fila = db.session.execute(
+            db.select(LimitePedidoEscuela.limite, LimitePedidoEscuela.marcas, LimitePedidoEscuela.version)
+            .where(LimitePedidoEscuela.escuela_id == escuela_id)
+        ).first()
+        if fila is None:
+            _crear_limite_pedido(escuela_id, inicio_ventana)
+            continue
+
+        if fila.limite is not None:
+            limite = fila.limite
+        marcas = [m for m in json.loads(fila.marcas) if datetime.fromisoformat(m) >= inicio_ventana]
+        if len(marcas) >= limite:
+            return False, limite
+
+        marcas.append(ahora.isoformat())
+        resultado = db.session.execute(
+            update(LimitePedidoEscuela)
+            .where(LimitePedidoEscuela.escuela_id == escuela_id,
+                   LimitePedidoEscuela.version == fila.version)
+            .values(marcas=json.dumps(marcas), version=fila.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if resultado.rowcount == 1:
+            return True, limite
+
+    # Demasiada contención sobre la misma escuela: se rechaza por seguridad
+    return False, limite
+
+def _cantidades_del_formulario(formulario):
+    # Solo las claves cantidad_<id> enviadas con valor positivo: {product_id: cantidad}
+    cantidades = {}
+    for clave, valor in formulario.items():
+        if not clave.startswith('cantidad_'):
+            continue
+        try:
+            product_id = int(clave[len('cantidad_'):])
+            cantidad = int(valor or 0)
+        except ValueError:
+            continue
+        if cantidad > 0:
+            cantidades[product_id] = cantidad
+    return cantidades
+
+# Caché del catálogo del formulario público, por worker: (version, html de las filas)
+_catalogo_cache = (None, None)
+
+def invalidar_catalogo(session=None):
+    """
+    Incrementa la versión del catálogo dentro de la transacción actual.
+    Se llama sola al confirmar toda transacción que cambió la tabla product
+    (ver _invalidar_catalogo_al_confirmar); al confirmarse, cada worker detecta
+    la nueva versión y re-renderiza. Los productos cambiados (version_catalogo
+    NULL) quedan con la nueva versión.
+    """
+    session = session or db.session
+    session.execute(
+        update(CatalogoVersion)
+        .where(CatalogoVersion.id == 1)
+        .values(version=CatalogoVersion.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    # La fila de versión queda bloqueada hasta el commit: otra transacción no puede leer la misma versión
+    version = session.scalar(db.select(CatalogoVersion.version).where(CatalogoVersion.id == 1))
+    if version is not None:
+        session.execute(
+            update(Product).where(Product.version_catalogo.is_(None)).values(version_catalogo=version)
+            .execution_options(synchronize_session=False)
+        )
+
+# Cambios al catálogo: toda escritura sobre product (ORM o sentencias insert/update/delete
+# ejecutadas en la sesión) marca la transacción, y al confirmarla se incrementa la versión
+
+@event.listens_for(Product, 'before_update')
+def _marcar_producto_cambiado(mapper, conexion, producto):
+    # Ediciones por ORM: invalidar_catalogo() le asigna la nueva versión
+    if any(atributo.history.has_changes() for atributo in inspect(producto).attrs):
+        producto.version_catalogo = None
+
+@event.listens_for(Session, 'do_orm_execute')
+def _registrar_cambio_catalogo(estado):
+    if (estado.is_insert or estado.is_update or estado.is_delete) and \
+            any(mapper.class_ is Product for mapper in estado.all_mappers):
+        estado.session.info['catalogo_cambiado'] = True
+
+@event.listens_for(Session, 'after_flush')
+def _registrar_productos_guardados(session, contexto):
+    if any(isinstance(objeto, Product) for objeto in (*session.new, *session.dirty, *session.deleted)):
+        session.info['catalogo_cambiado'] = True
+
+@event.listens_for(Session, 'before_commit')
+def _invalidar_catalogo_al_confirmar(session):
+    session.flush()
+    if session.info.pop('catalogo_cambiado', False):
+        invalidar_catalogo(session)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _olvidar_cambio_catalogo(session, transaccion):
+    # Solo al terminar la transacción externa: un SAVEPOINT revertido no borra las marcas anteriores
+    if transaccion.parent is None:
+        session.info.pop('catalogo_cambiado', None)
+
+def catalogo_pedido_html():
+    # Solo se lee la fila de versión; la tabla product se consulta únicamente si cambió
+    global _catalogo_cache
+    version = db.session.execute(
+        db.select(CatalogoVersion.version).where(CatalogoVersion.id == 1)
+    ).scalar()
+    version_cache, html = _catalogo_cache
+    if html is None or version is None or version != version_cache:
+        productos = Product.query.order_by(Product.id).all()
+        html = render_template('catalogo_pedido.html', productos=productos)
+        _catalogo_cache = (version, html)
+    return html
+
+def _formulario_pedido(escuela):
+    return render_template('hacer_pedido.html', escuela=escuela, catalogo_html=catalogo_pedido_html())
+
+def crear_pedido(escuela_id, cantidades):
+    """
+    Valida y crea una solicitud con sus líneas ({product_id: cantidad}) en la
+    transacción actual, sin confirmarla. Devuelve (solicitud_id, None) o
+    (None, (estado HTTP, mensaje)); ante un error el llamador revierte.
+    """
+    # --- 1. Encontrar el Supervisor Asignado ---
+    asignacion = SupervisorEscuela.query.filter_by(escuela_id=escuela_id).first()
+    if not asignacion:
+        return None, (409, 'Error: Esta escuela no tiene un supervisor asignado para recibir pedidos.')
+    supervisor_id = asignacion.supervisor_id
+
+    # --- 2. Validar solo las líneas enviadas, con una sola consulta a Product ---
+    productos = dict(
+        db.session.query(Product.id, Product.name)
+        .filter(Product.id.in_(cantidades))
+        .all()
+    ) if cantidades else {}
+    cantidades = {pid: n for pid, n in cantidades.items() if pid in productos}
+
+    if not cantidades:
+        return None, (422, 'Debe seleccionar al menos un producto para el pedido.')
+
+    for product_id in sorted(cantidades):
+        # --- Lógica de Validación de Máximo 3 por producto ---
+        if cantidades[product_id] > 3:
+            return None, (422, f'Límite excedido para {productos[product_id]}: Solo se pueden pedir 3 unidades por producto.')
+
+    # --- 3. Lógica de Validación de pedidos por semana (cupo atómico por escuela) ---
+    ahora = datetime.utcnow()
+    aceptado, limite = _consumir_cupo_pedido(escuela_id, ahora)
+    if not aceptado:
+        return None, (429, f'Límite excedido: Solo se permiten {limite} solicitudes por escuela a la semana.')
+
+    # --- 4. Crear Solicitud y Detalles (inserción masiva de las líneas) ---
+    nueva_solicitud = Solicitud(supervisor_id=supervisor_id, escuela_id=escuela_id, fecha_solicitud=ahora)
+    db.session.add(nueva_solicitud)
+    db.session.flush() # Obtener ID antes de commit
+
+    db.session.execute(insert(DetalleSolicitud), [
+        {'solicitud_id': nueva_solicitud.id, 'product_id': product_id, 'cantidad_solicitada': cantidad}
+        for product_id, cantidad in cantidades.items()
+    ])
+    acumular_consumo([
+        {'fecha': ahora.date(), 'escuela_id': escuela_id, 'product_id': product_id,
+         'unidades_solicitadas': cantidad, 'unidades_aprobadas': 0, 'pedidos': 1}
+        for product_id, cantidad in cantidades.items()
+    ])
+    return nueva_solicitud.id, None
+
+# RUTA PÚBLICA: ids de los productos del catálogo que coinciden con ?q= (filtro del formulario)
+@app.route('/pedido/escuela/<int:escuela_id>/buscar')
+def buscar_productos_pedido(escuela_id):
+    db.get_or_404(Escuela, escuela_id)
+    q = (request.args.get('q') or '').strip()
+    ids = db.session.scalars(db.select(Product.id).where(filtro_busqueda(Product, q))).all() if q else None
+    return jsonify({'ids': ids})
+
 # RUTA PÚBLICA: Realizar un pedido desde el QR de la escuela
 @app.route('/pedido/escuela/<int:escuela_id>', methods=['GET', 'POST'])
 def hacer_pedido_escuela(escuela_id):
@@ -556,67 +2401,21 @@ def hacer_pedido_escuela(escuela_id):
         flash("Escuela no válida o no encontrada.", 'error')
         return render_template('error_page.html', message="Escuela no encontrada"), 404
 
-    productos = Product.query.all()
-    
     if request.method == 'POST':
-        # --- 1. Lógica de Validación de 2 pedidos por semana ---
-        hace_7_dias = datetime.utcnow() - timedelta(days=7)
-        pedidos_recientes = Solicitud.query.filter(
-            Solicitud.escuela_id == escuela_id,
-            Solicitud.fecha_solicitud >= hace_7_dias
-        ).count()
-        
-        if pedidos_recientes >= 2:
-            flash('Límite excedido: Solo se permiten 2 solicitudes por escuela a la semana.', 'error')
-            return render_template('hacer_pedido.html', escuela=escuela, productos=productos)
-        
-        # --- 2. Encontrar el Supervisor Asignado ---
-        asignacion = SupervisorEscuela.query.filter_by(escuela_id=escuela_id).first()
-        if not asignacion:
-            flash('Error: Esta escuela no tiene un supervisor asignado para recibir pedidos.', 'error')
-            return render_template('hacer_pedido.html', escuela=escuela, productos=productos)
-        
-        supervisor_id = asignacion.supervisor_id
-
-        # --- 3. Crear Solicitud y Detalles ---
         try:
-            nueva_solicitud = Solicitud(supervisor_id=supervisor_id, escuela_id=escuela_id)
-            db.session.add(nueva_solicitud)
-            db.session.flush() # Obtener ID antes de commit
-            
-            detalles_agregados = False
-            for product in productos:
-                cantidad = request.form.get(f'cantidad_{product.id}', type=int, default=0)
-                
-                if cantidad > 0:
-                    # --- 4. Lógica de Validación de Máximo 3 por producto ---
-                    if cantidad > 3:
-                        db.session.rollback()
-                        flash(f'Límite excedido para {product.name}: Solo se pueden pedir 3 unidades por producto.', 'error')
-                        return render_template('hacer_pedido.html', escuela=escuela, productos=productos)
-                        
-                    detalle = DetalleSolicitud(
-                        solicitud_id=nueva_solicitud.id,
-                        product_id=product.id,
-                        cantidad_solicitada=cantidad
-                    )
-                    db.session.add(detalle)
-                    detalles_agregados = True
-            
-            if not detalles_agregados:
+            solicitud_id, error = crear_pedido(escuela_id, _cantidades_del_formulario(request.form))
+            if error:
                 db.session.rollback()
-                flash('Debe seleccionar al menos un producto para el pedido.', 'error')
-                return render_template('hacer_pedido.html', escuela=escuela, productos=productos)
-                
+                flash(error[1], 'error')
+                return _formulario_pedido(escuela)
             db.session.commit()
-            return redirect(url_for('pedido_exitoso', solicitud_id=nueva_solicitud.id))
+            return redirect(url_for('pedido_exitoso', solicitud_id=solicitud_id))
             
         except SQLAlchemyError as e:
             db.session.rollback()
             flash(f'Ocurrió un error al guardar el pedido: {e}', 'error')
 
-
-    return render_template('hacer_pedido.html', escuela=escuela, productos=productos)
+    return _formulario_pedido(escuela)
 
 @app.route('/pedido/exitoso/<int:solicitud_id>')
 def pedido_exitoso(solicitud_id):
@@ -624,6 +2423,169 @@ def pedido_exitoso(solicitud_id):
     return render_template('pedido_exitoso.html', solicitud_id=solicitud_id)
 
 
+# -------------------------------------------------------------------------
+# API JSON v1 (clientes móviles que escanean el QR de la escuela)
+# -------------------------------------------------------------------------
+# Pensada para conexiones lentas: el catálogo responde 304 con If-None-Match
+# (solo se lee la fila de versión) o solo los productos cambiados con
+# ?desde=<version>; los pedidos aceptan el encabezado Idempotency-Key para que
+# un reintento no duplique la solicitud; y las respuestas /api/ se comprimen
+# con brotli o gzip según Accept-Encoding. Públicas, como el formulario del QR.
+
+# Catálogo completo ya serializado, por worker: (version, cuerpo JSON)
+_catalogo_api_cache = (None, None)
+
+def _producto_api(producto):
+    return {'id': producto.id, 'code': producto.code, 'name': producto.name, 'stock': producto.stock or 0}
+
+def _error_api(estado, mensaje):
+    return jsonify({'error': mensaje}), estado
+
+@app.route('/api/v1/catalogo')
+def api_catalogo():
+    global _catalogo_api_cache
+    version = db.session.scalar(db.select(CatalogoVersion.version).where(CatalogoVersion.id == 1)) or 0
+    desde = request.args.get('desde', type=int)
+    etag = f'catalogo-{version}' if desde is None else f'catalogo-{version}-desde-{desde}'
+    if request.if_none_match.contains_weak(etag):
+        respuesta = Response(status=304)
+    elif desde is not None and 0 <= desde <= version:
+        productos = Product.query.filter(Product.version_catalogo > desde).order_by(Product.id).all()
+        respuesta = jsonify({'version': version, 'completo': False, 'productos': [_producto_api(p) for p in productos]})
+    else:
+        version_cache, cuerpo = _catalogo_api_cache
+        if cuerpo is None or version_cache != version:
+            productos = Product.query.order_by(Product.id).all()
+            cuerpo = json.dumps({'version': version, 'completo': True,
+                                 'productos': [_producto_api(p) for p in productos]},
+                                ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            _catalogo_api_cache = (version, cuerpo)
+        respuesta = Response(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag, weak=True)
+    # El cliente puede guardar la copia pero debe revalidarla en cada uso
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+def _pedido_api(solicitud_id):
+    solicitud = db.session.get(Solicitud, solicitud_id)
+    lineas = db.session.execute(
+        db.select(DetalleSolicitud.product_id, DetalleSolicitud.cantidad_solicitada)
+        .where(DetalleSolicitud.solicitud_id == solicitud_id).order_by(DetalleSolicitud.product_id)
+    ).all()
+    return {
+        'id': solicitud.id,
+        'escuela_id': solicitud.escuela_id,
+        'estado': solicitud.estado,
+        'fecha_solicitud': solicitud.fecha_solicitud.isoformat(),
+        'fecha_aprobacion': solicitud.fecha_aprobacion.isoformat() if solicitud.fecha_aprobacion else None,
+        'lineas': [{'product_id': product_id, 'cantidad': cantidad} for product_id, cantidad in lineas],
+    }
+
+def _cantidades_api(datos):
+    # {"lineas": [{"product_id": 1, "cantidad": 2}, ...]} -> {product_id: cantidad}; None si es inválido
+    try:
+        cantidades = defaultdict(int)
+        for linea in datos['lineas']:
+            cantidad = int(linea['cantidad'])
+            if cantidad < 0:
+                return None
+            if cantidad:
+                cantidades[int(linea['product_id'])] += cantidad
+        return dict(cantidades)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+@app.route('/api/v1/escuelas/<int:escuela_id>/pedidos', methods=['POST'])
+def api_crear_pedido(escuela_id):
+    db.get_or_404(Escuela, escuela_id)
+    datos = request.get_json(silent=True)
+    cantidades = _cantidades_api(datos) if isinstance(datos, dict) else None
+    if cantidades is None:
+        return _error_api(400, 'Cuerpo inválido: se espera {"lineas": [{"product_id": ..., "cantidad": ...}]}.')
+
+    clave = (request.headers.get('Idempotency-Key') or '').strip()[:100]
+    huella = hashlib.sha256(json.dumps(sorted(cantidades.items())).encode()).hexdigest()
+
+    def repeticion():
+        # Reintento de un pedido ya creado con la misma clave
+        registro = db.session.get(ClaveIdempotencia, (clave, escuela_id))
+        if registro is None:
+            return None
+        if registro.huella != huella:
+            return _error_api(422, 'La clave de idempotencia ya se usó con otro pedido.')
+        respuesta = jsonify(_pedido_api(registro.solicitud_id))
+        respuesta.headers['Idempotent-Replayed'] = 'true'
+        return respuesta
+
+    if clave:
+        anterior = repeticion()
+        if anterior is not None:
+            return anterior
+
+    try:
+        solicitud_id, error = crear_pedido(escuela_id, cantidades)
+        if error:
+            db.session.rollback()
+            return _error_api(*error)
+        if clave:
+            # Misma transacción: si otro reintento ganó la carrera, el commit falla y se devuelve el suyo
+            db.session.add(ClaveIdempotencia(clave=clave, escuela_id=escuela_id, huella=huella,
+                                             solicitud_id=solicitud_id))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        anterior = repeticion() if clave else None
+        if anterior is not None:
+            return anterior
+        return _error_api(409, 'No se pudo registrar el pedido, intente nuevamente.')
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return _error_api(503, f'Ocurrió un error al guardar el pedido: {e}')
+
+    respuesta = jsonify(_pedido_api(solicitud_id))
+    respuesta.status_code = 201
+    respuesta.headers['Location'] = url_for('api_ver_pedido', escuela_id=escuela_id, solicitud_id=solicitud_id)
+    return respuesta
+
+@app.route('/api/v1/escuelas/<int:escuela_id>/pedidos/<int:solicitud_id>')
+def api_ver_pedido(escuela_id, solicitud_id):
+    # Solo los pedidos de la escuela del QR
+    solicitud = db.session.get(Solicitud, solicitud_id)
+    if solicitud is None or solicitud.escuela_id != escuela_id:
+        return _error_api(404, 'Pedido no encontrado.')
+    respuesta = jsonify(_pedido_api(solicitud_id))
+    respuesta.add_etag(weak=True)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta.make_conditional(request)
+
+def limpiar_claves_idempotencia():
+    """Borra las claves de idempotencia más antiguas que API_IDEMPOTENCIA_DIAS."""
+    limite = datetime.utcnow() - timedelta(days=app.config['API_IDEMPOTENCIA_DIAS'])
+    db.session.execute(db.delete(ClaveIdempotencia).where(ClaveIdempotencia.creado_en < limite)
+                       .execution_options(synchronize_session=False))
+
+@app.after_request
+def _comprimir_api(response):
+    # Brotli si el cliente lo acepta y el módulo está instalado; si no, gzip
+    if not request.path.startswith('/api/'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+    cuerpo = response.get_data()
+    if len(cuerpo) < app.config['API_COMPRESION_MINIMO']:
+        return response
+    aceptadas = request.accept_encodings
+    if brotli is not None and aceptadas['br']:
+        response.set_data(brotli.compress(cuerpo, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif aceptadas['gzip']:
+        response.set_data(gzip.compress(cuerpo, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
 # -------------------------------------------------------------------------
 # RUTAS DE ASIGNACIÓN (Supervisor-Escuela)
 # -------------------------------------------------------------------------
@@ -631,10 +2593,6 @@ def pedido_exitoso(solicitud_id):
 @app.route('/asignaciones', methods=['GET', 'POST'])
 @login_required
 def administrar_asignaciones():
-    supervisores = Supervisor.query.all()
-    escuelas = Escuela.query.all()
-    asignaciones_existentes = SupervisorEscuela.query.all()
-    
     if request.method == 'POST':
         supervisor_id = request.form.get('supervisor_id', type=int)
         escuela_id = request.form.get('escuela_id', type=int)
@@ -658,10 +2616,25 @@ def administrar_asignaciones():
             
         return redirect(url_for('administrar_asignaciones'))
 
+    # Los selectores muestran la primera página; el resto se busca con autocompletado
+    # (/supervisores y /escuelas con formato=json)
+    limite = app.config['LISTADOS_POR_PAGINA']
+    supervisores = db.session.query(Supervisor.id, Supervisor.name, Supervisor.apellido, Supervisor.email
+                                    ).order_by(Supervisor.name, Supervisor.apellido).limit(limite).all()
+    escuelas = db.session.query(Escuela.id, Escuela.name).order_by(Escuela.name).limit(limite).all()
+    # Tabla paginada; supervisor y escuela en el mismo SELECT (sin carga perezosa por fila)
+    asignaciones = db.paginate(
+        db.select(SupervisorEscuela).options(
+            joinedload(SupervisorEscuela.supervisor), joinedload(SupervisorEscuela.escuela)
+        ).order_by(SupervisorEscuela.id),
+        per_page=app.config['ASIGNACIONES_POR_PAGINA'],
+        error_out=False
+    )
+
     return render_template('asignaciones.html', 
                            supervisores=supervisores, 
                            escuelas=escuelas, 
-                           asignaciones=asignaciones_existentes)
+                           asignaciones=asignaciones)
 
 @app.route('/asignaciones/eliminar/<int:id>', methods=['POST'])
 @login_required
@@ -682,6 +2655,261 @@ def eliminar_asignacion(id):
     return redirect(url_for('administrar_asignaciones'))
 
 
+# -------------------------------------------------------------------------
+# IMPORTACIÓN MASIVA (CSV)
+# -------------------------------------------------------------------------
+# Columnas esperadas por tipo:
+#   productos:    code, name, stock (opcional)
+#   escuelas:     name
+#   supervisores: email, name, apellido
+#   asignaciones: supervisor_email, escuela
+
+COLUMNAS_IMPORTACION = {
+    'productos': ['code', 'name'],
+    'escuelas': ['name'],
+    'supervisores': ['email', 'name', 'apellido'],
+    'asignaciones': ['supervisor_email', 'escuela'],
+}
+
+def _lotes(iterable, tamano):
+    lote = []
+    for elemento in iterable:
+        lote.append(elemento)
+        if len(lote) >= tamano:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def _importar_productos(filas, resultado):
+    datos = {}
+    for linea, fila in filas:
+        code, name = fila.get('code', '').strip(), fila.get('name', '').strip()
+        if not code or not name:
+            resultado['errores'].append((linea, 'Código y nombre son obligatorios.'))
+            continue
+        stock = (fila.get('stock') or '').strip()
+        try:
+            datos[code] = {'code': code, 'name': name, 'stock': int(stock) if stock else None, 'linea': linea}
+            if stock and int(stock) < 0:
+                raise ValueError
+        except ValueError:
+            datos.pop(code, None)
+            resultado['errores'].append((linea, f'Stock inválido: {stock}'))
+    if not datos:
+        return
+
+    existentes = dict(db.session.query(Product.code, Product.id).filter(Product.code.in_(datos)))
+    bodega_id = bodega_por_defecto()
+    # El stock pasa por el libro de inventario de la bodega por defecto: recepción para
+    # los productos nuevos y ajuste por diferencia para los existentes, todo en bloque
+    con_ajuste = [existentes[code] for code, d in datos.items() if code in existentes and d['stock'] is not None]
+    stock_actual, saldos = {}, {}
+    if con_ajuste:
+        # Bajo el bloqueo de los movimientos los saldos leídos no cambian hasta el commit del lote
+        _bloquear_movimientos()
+        stock_actual = dict(db.session.query(Product.id, Product.stock).filter(Product.id.in_(con_ajuste)))
+        saldos = {product_id: (existencia, reservado) for product_id, existencia, reservado in
+                  db.session.query(SaldoBodega.product_id, SaldoBodega.existencia, SaldoBodega.reservado)
+                  .filter(SaldoBodega.bodega_id == bodega_id, SaldoBodega.product_id.in_(con_ajuste))}
+
+    nuevos = [{'code': code, 'name': d['name'], 'stock': d['stock'] or 0}
+              for code, d in datos.items() if code not in existentes]
+    cambios, ajustes = [], {}
+    for code, d in datos.items():
+        if code not in existentes:
+            continue
+        product_id = existentes[code]
+        cambio = {'id': product_id, 'name': d['name'], 'version_catalogo': None}
+        diferencia = d['stock'] - stock_actual[product_id] if d['stock'] is not None else 0
+        if diferencia:
+            existencia, reservado = saldos.get(product_id, (0, 0))
+            if existencia - reservado + diferencia < 0:
+                # La fila se descarta completa: ni el nombre ni el stock quedan a medias
+                resultado['errores'].append((d['linea'], f'No se puede ajustar el stock de {code}: '
+                                                         f'la bodega por defecto no tiene suficiente disponible.'))
+                continue
+            ajustes[product_id] = diferencia
+            cambio['stock'] = d['stock']
+        cambios.append(cambio)
+
+    if nuevos:
+        db.session.execute(insert(Product), nuevos)
+    # Actualización masiva por clave primaria
+    if cambios:
+        db.session.execute(update(Product), cambios)
+
+    ahora = datetime.utcnow()
+    con_stock = {d['code']: d['stock'] for d in nuevos if d['stock'] > 0}
+    if con_stock:
+        ids = dict(db.session.query(Product.code, Product.id).filter(Product.code.in_(con_stock)))
+        ajustes.update({ids[code]: stock for code, stock in con_stock.items()})
+    if ajustes:
+        # Saldos antes que el libro, igual que registrar_movimiento (ver _bloquear_movimientos)
+        saldos_nuevos = [{'bodega_id': bodega_id, 'product_id': product_id, 'existencia': cantidad, 'reservado': 0}
+                         for product_id, cantidad in ajustes.items() if product_id not in saldos]
+        if saldos_nuevos:
+            db.session.execute(insert(SaldoBodega), saldos_nuevos)
+        saldos_cambiados = [{'bodega_id': bodega_id, 'product_id': product_id,
+                             'existencia': saldos[product_id][0] + cantidad}
+                            for product_id, cantidad in ajustes.items() if product_id in saldos]
+        if saldos_cambiados:
+            db.session.execute(update(SaldoBodega), saldos_cambiados)
+        usuario_id = current_user.id if has_request_context() and current_user.is_authenticated else None
+        db.session.execute(insert(MovimientoStock), [
+            {'bodega_id': bodega_id, 'product_id': product_id,
+             'tipo': 'ajuste' if product_id in stock_actual else 'recepcion', 'existencia': cantidad,
+             'reservado': 0, 'usuario_id': usuario_id, 'nota': 'Importación CSV', 'creado_en': ahora}
+            for product_id, cantidad in ajustes.items()
+        ])
+    resultado['insertadas'] += len(nuevos)
+    resultado['actualizadas'] += len(cambios)
+
+def _importar_escuelas(filas, resultado):
+    nombres = {}
+    for linea, fila in filas:
+        name = fila.get('name', '').strip()
+        if not name:
+            resultado['errores'].append((linea, 'El nombre de la escuela es obligatorio.'))
+            continue
+        nombres[name] = linea
+    if not nombres:
+        return
+
+    existentes = {n for (n,) in db.session.query(Escuela.name).filter(Escuela.name.in_(nombres))}
+    marca = datetime.now().timestamp()
+    nuevas = [
+        {'name': name, 'qr_code_data': f"ESCUELA_NAME:{name}-{marca}"}
+        for name in nombres if name not in existentes
+    ]
+    if nuevas:
+        db.session.execute(insert(Escuela), nuevas)
+    resultado['insertadas'] += len(nuevas)
+    resultado['sin_cambios'] += len(existentes)
+
+def _importar_supervisores(filas, resultado):
+    datos = {}
+    for linea, fila in filas:
+        email = fila.get('email', '').strip()
+        name, apellido = fila.get('name', '').strip(), fila.get('apellido', '').strip()
+        if not email or not name or not apellido:
+            resultado['errores'].append((linea, 'Todos los campos (Nombre, Apellido, Email) son obligatorios.'))
+            continue
+        datos[email] = {'email': email, 'name': name, 'apellido': apellido,
+                        'qr_code_data': f"SUPERVISOR_EMAIL:{email}"}
+    if not datos:
+        return
+
+    existentes = dict(db.session.query(Supervisor.email, Supervisor.id).filter(Supervisor.email.in_(datos)))
+    nuevos = [d for email, d in datos.items() if email not in existentes]
+    cambios = [{'id': existentes[email], 'name': d['name'], 'apellido': d['apellido']}
+               for email, d in datos.items() if email in existentes]
+    if nuevos:
+        db.session.execute(insert(Supervisor), nuevos)
+    if cambios:
+        db.session.execute(update(Supervisor), cambios)
+    resultado['insertadas'] += len(nuevos)
+    resultado['actualizadas'] += len(cambios)
+
+def _importar_asignaciones(filas, resultado):
+    pares = {}
+    for linea, fila in filas:
+        email, escuela = fila.get('supervisor_email', '').strip(), fila.get('escuela', '').strip()
+        if not email or not escuela:
+            resultado['errores'].append((linea, 'Debe indicar supervisor_email y escuela.'))
+            continue
+        pares[(email, escuela)] = linea
+    if not pares:
+        return
+
+    supervisores = dict(db.session.query(Supervisor.email, Supervisor.id)
+                        .filter(Supervisor.email.in_({e for e, _ in pares})))
+    escuelas = {}
+    for escuela_id, name in db.session.query(Escuela.id, Escuela.name).filter(
+            Escuela.name.in_({n for _, n in pares})).order_by(Escuela.id):
+        escuelas.setdefault(name, escuela_id)
+
+    candidatas = {}
+    for (email, escuela), linea in pares.items():
+        if email not in supervisores:
+            resultado['errores'].append((linea, f'Supervisor no encontrado: {email}'))
+        elif escuela not in escuelas:
+            resultado['errores'].append((linea, f'Escuela no encontrada: {escuela}'))
+        else:
+            candidatas[(supervisores[email], escuelas[escuela])] = linea
+
+    existentes = set(db.session.query(SupervisorEscuela.supervisor_id, SupervisorEscuela.escuela_id).filter(
+        SupervisorEscuela.escuela_id.in_({e for _, e in candidatas})))
+    nuevas = [{'supervisor_id': s, 'escuela_id': e} for (s, e) in candidatas if (s, e) not in existentes]
+    if nuevas:
+        db.session.execute(insert(SupervisorEscuela), nuevas)
+    resultado['insertadas'] += len(nuevas)
+    resultado['sin_cambios'] += len(candidatas) - len(nuevas)
+
+IMPORTADORES = {
+    'productos': _importar_productos,
+    'escuelas': _importar_escuelas,
+    'supervisores': _importar_supervisores,
+    'asignaciones': _importar_asignaciones,
+}
+
+def importar_csv(tipo, archivo_texto, filas_por_lote=1000, al_terminar_lote=None):
+    """
+    Importa un CSV (objeto de texto) leyéndolo fila a fila. Cada lote se
+    valida, se resuelve contra la base con una consulta IN y se escribe con
+    executemany en su propia transacción. Un lote que falla en la base se
+    revierte y se informa; los demás se conservan.
+
+    al_terminar_lote(última_línea) se llama después de cada lote (avance).
+
+    Devuelve {'insertadas', 'actualizadas', 'sin_cambios', 'errores': [(línea, mensaje)]}.
+    """
+    resultado = {'insertadas': 0, 'actualizadas': 0, 'sin_cambios': 0, 'errores': []}
+    lector = csv.DictReader(archivo_texto)
+    faltantes = [c for c in COLUMNAS_IMPORTACION[tipo] if c not in (lector.fieldnames or [])]
+    if faltantes:
+        resultado['errores'].append((1, f"Faltan columnas: {', '.join(faltantes)}"))
+        return resultado
+
+    filas = ((numero, fila) for numero, fila in enumerate(lector, start=2))
+    for lote in _lotes(filas, filas_por_lote):
+        try:
+            IMPORTADORES[tipo](lote, resultado)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            resultado['errores'].append((lote[0][0], f'Lote hasta la línea {lote[-1][0]} no importado: {e}'))
+        if al_terminar_lote:
+            al_terminar_lote(lote[-1][0])
+    return resultado
+
+@app.route('/importar', methods=['GET', 'POST'])
+@login_required
+def importar_datos():
+    resultado = None
+    tipo = request.form.get('tipo')
+    if request.method == 'POST':
+        archivo = request.files.get('archivo')
+        if tipo not in IMPORTADORES or not archivo or not archivo.filename:
+            flash('Debe seleccionar el tipo de datos y un archivo CSV.', 'error')
+        elif request.form.get('en_segundo_plano'):
+            # El CSV queda en la base (la web y el worker no comparten disco); el trabajo lleva su id
+            entrada = ArchivoTrabajo(nombre=archivo.filename[:200], contenido=archivo.read())
+            db.session.add(entrada)
+            db.session.flush()
+            trabajo = encolar_trabajo('importar', {'tipo': tipo, 'archivo_id': entrada.id})
+            flash('La importación se procesará en segundo plano.', 'info')
+            return redirect(url_for('ver_trabajo', trabajo_id=trabajo.id))
+        else:
+            texto = io.TextIOWrapper(archivo.stream, encoding='utf-8-sig', newline='')
+            resultado = importar_csv(tipo, texto)
+            flash(f"Importación terminada: {resultado['insertadas']} nuevas, "
+                  f"{resultado['actualizadas']} actualizadas, {len(resultado['errores'])} errores.",
+                  'success' if not resultado['errores'] else 'warning')
+
+    return render_template('importar.html', tipos=COLUMNAS_IMPORTACION, tipo=tipo, resultado=resultado)
+
+
 # -------------------------------------------------------------------------
 # RUTAS ADICIONALES DEL DASHBOARD
 # -------------------------------------------------------------------------
@@ -692,12 +2920,1188 @@ def reportes_page():
     return render_template('reportes.html')
 
 
+# -------------------------------------------------------------------------
+# REPORTES (agregados calculados en SQL)
+# -------------------------------------------------------------------------
+
+def calcular_reporte(inicio, fin):
+    """
+    Calcula en SQL los agregados del período [inicio, fin): pedidos con sus
+    unidades, y totales por escuela, por producto y por supervisor. Las
+    plantillas solo recorren filas ya calculadas (sin consultas por pedido).
+    Por escuela y por producto se usa consumo_diario si sus totales coinciden
+    con el historial del período; si no, se agrega el historial directamente.
+    """
+    en_periodo = and_(Solicitud.fecha_solicitud >= inicio, Solicitud.fecha_solicitud < fin)
+    unidades = func.coalesce(func.sum(DetalleSolicitud.cantidad_solicitada), 0)
+    pedidos_distintos = func.count(func.distinct(Solicitud.id))
+
+    pedidos = db.session.query(
+        Solicitud.id,
+        Solicitud.fecha_solicitud,
+        Solicitud.estado,
+        Escuela.name.label('escuela'),
+        (Supervisor.name + ' ' + Supervisor.apellido).label('supervisor'),
+        unidades.label('unidades')
+    ).join(Escuela, Escuela.id == Solicitud.escuela_id
+    ).join(Supervisor, Supervisor.id == Solicitud.supervisor_id
+    ).outerjoin(DetalleSolicitud, DetalleSolicitud.solicitud_id == Solicitud.id
+    ).filter(en_periodo
+    ).group_by(Solicitud.id, Solicitud.fecha_solicitud, Solicitud.estado,
+               Escuela.name, Supervisor.name, Supervisor.apellido
+    ).order_by(Solicitud.fecha_solicitud, Solicitud.id).all()
+
+    # Unidades por escuela y por producto desde el acumulado diario (períodos alineados a días),
+    # solo si cubre el período: sus totales deben coincidir con los del historial
+    unidades_pedidos = sum(p.unidades for p in pedidos)
+    unidades_aprobadas = db.session.query(func.coalesce(func.sum(DetalleSolicitud.cantidad_solicitada), 0)
+    ).join(Solicitud, Solicitud.id == DetalleSolicitud.solicitud_id
+    ).filter(Solicitud.estado == 'Aprobada', Solicitud.fecha_aprobacion >= inicio, Solicitud.fecha_aprobacion < fin
+    ).scalar()
+    acumulado = db.session.query(
+        func.coalesce(func.sum(ConsumoDiario.unidades_solicitadas), 0),
+        func.coalesce(func.sum(ConsumoDiario.unidades_aprobadas), 0)
+    ).filter(ConsumoDiario.fecha >= inicio.date(), ConsumoDiario.fecha < fin.date()).one()
+    if tuple(map(int, acumulado)) == (int(unidades_pedidos), int(unidades_aprobadas)):
+        consumo = db.select(ConsumoDiario).where(
+            ConsumoDiario.fecha >= inicio.date(), ConsumoDiario.fecha < fin.date()).subquery()
+    else:
+        # Pedidos cargados o cambiados sin pasar por acumular_consumo: se agrega el historial
+        app.logger.warning("consumo_diario no coincide con el historial entre %s y %s; "
+                           "ejecute `flask reconstruir-consumo`", inicio.date(), fin.date())
+        consumo = _consulta_consumo(inicio, fin).subquery()
+
+    unidades_por_escuela = dict(
+        db.session.query(consumo.c.escuela_id, func.sum(consumo.c.unidades_solicitadas))
+        .group_by(consumo.c.escuela_id)
+        .all()
+    )
+    por_escuela = [
+        {'nombre': nombre, 'pedidos': pedidos, 'unidades': int(unidades_por_escuela.get(escuela_id) or 0)}
+        for escuela_id, nombre, pedidos in db.session.query(
+            Escuela.id, Escuela.name, func.count(Solicitud.id)
+        ).join(Solicitud, Solicitud.escuela_id == Escuela.id
+        ).filter(en_periodo
+        ).group_by(Escuela.id, Escuela.name).all()
+    ]
+    por_escuela.sort(key=lambda fila: (-fila['unidades'], fila['nombre']))
+
+    por_supervisor = db.session.query(
+        (Supervisor.name + ' ' + Supervisor.apellido).label('nombre'),
+        pedidos_distintos.label('pedidos'),
+        unidades.label('unidades')
+    ).join(Solicitud, Solicitud.supervisor_id == Supervisor.id
+    ).outerjoin(DetalleSolicitud, DetalleSolicitud.solicitud_id == Solicitud.id
+    ).filter(en_periodo
+    ).group_by(Supervisor.id, Supervisor.name, Supervisor.apellido
+    ).order_by(unidades.desc(), Supervisor.name).all()
+
+    solicitadas = func.sum(consumo.c.unidades_solicitadas)
+    por_producto = db.session.query(
+        Product.name.label('nombre'),
+        Product.code.label('codigo'),
+        func.sum(consumo.c.pedidos).label('pedidos'),
+        solicitadas.label('unidades'),
+        func.sum(consumo.c.unidades_aprobadas).label('aprobadas')
+    ).join(consumo, consumo.c.product_id == Product.id
+    ).group_by(Product.id, Product.name, Product.code
+    ).having(solicitadas > 0
+    ).order_by(solicitadas.desc(), Product.name).all()
+
+    totales = {
+        'pedidos': len(pedidos),
+        'aprobados': sum(1 for p in pedidos if p.estado == 'Aprobada'),
+        'unidades': unidades_pedidos,
+        'escuelas': len(por_escuela),
+        'supervisores': len(por_supervisor),
+    }
+    return {
+        'pedidos': pedidos,
+        'por_escuela': por_escuela,
+        'por_supervisor': por_supervisor,
+        'por_producto': por_producto,
+        'totales': totales,
+    }
+
+def _fecha_param(nombre, formato):
+    try:
+        return datetime.strptime(request.args.get(nombre, ''), formato)
+    except ValueError:
+        return None
+
+@app.route('/reportes/semanal')
+@login_required
+def reporte_semanal():
+    # Semana (lunes a domingo) que contiene ?fecha=AAAA-MM-DD, por defecto la actual
+    fecha = _fecha_param('fecha', '%Y-%m-%d') or datetime.utcnow()
+    inicio_semana = datetime(fecha.year, fecha.month, fecha.day) - timedelta(days=fecha.weekday())
+    fin_semana = inicio_semana + timedelta(days=6)
+
+    limite_sentencias_largo()
+    reporte = calcular_reporte(inicio_semana, inicio_semana + timedelta(days=7))
+    return render_template('reporte_semanal.html',
+                           inicio_semana=inicio_semana,
+                           fin_semana=fin_semana,
+                           semana_anterior=(inicio_semana - timedelta(days=7)).strftime('%Y-%m-%d'),
+                           semana_siguiente=(inicio_semana + timedelta(days=7)).strftime('%Y-%m-%d'),
+                           **reporte)
+
+@app.route('/reportes/mensual')
+@login_required
+def reporte_mensual():
+    # Mes indicado con ?mes=AAAA-MM, por defecto el actual
+    fecha = _fecha_param('mes', '%Y-%m') or datetime.utcnow()
+    inicio_mes = datetime(fecha.year, fecha.month, 1)
+    siguiente_mes = (inicio_mes + timedelta(days=32)).replace(day=1)
+    mes_anterior = (inicio_mes - timedelta(days=1)).replace(day=1)
+
+    limite_sentencias_largo()
+    reporte = calcular_reporte(inicio_mes, siguiente_mes)
+    return render_template('reporte_mensual.html',
+                           inicio_mes=inicio_mes,
+                           mes_anterior=mes_anterior.strftime('%Y-%m'),
+                           mes_siguiente=siguiente_mes.strftime('%Y-%m'),
+                           **reporte)
+
+
+# -------------------------------------------------------------------------
+# CONSUMO DIARIO (acumulado para reportes y dashboard)
+# -------------------------------------------------------------------------
+
+def _consulta_consumo(desde=None, hasta=None):
+    """
+    SELECT agregado del historial con la forma de consumo_diario: unidades
+    solicitadas por fecha del pedido y aprobadas por fecha de aprobación,
+    opcionalmente limitado al rango [desde, hasta).
+    """
+    def en_rango(columna):
+        condiciones = []
+        if desde is not None:
+            condiciones.append(columna >= desde)
+        if hasta is not None:
+            condiciones.append(columna < hasta)
+        return and_(true(), *condiciones)
+
+    solicitadas = db.select(
+        func.date(Solicitud.fecha_solicitud).label('fecha'),
+        Solicitud.escuela_id.label('escuela_id'),
+        DetalleSolicitud.product_id.label('product_id'),
+        DetalleSolicitud.cantidad_solicitada.label('unidades_solicitadas'),
+        literal(0).label('unidades_aprobadas'),
+        literal(1).label('pedidos')
+    ).join(Solicitud, Solicitud.id == DetalleSolicitud.solicitud_id
+    ).where(en_rango(Solicitud.fecha_solicitud))
+
+    aprobadas = db.select(
+        func.date(Solicitud.fecha_aprobacion),
+        Solicitud.escuela_id,
+        DetalleSolicitud.product_id,
+        literal(0),
+        DetalleSolicitud.cantidad_solicitada,
+        literal(0)
+    ).join(Solicitud, Solicitud.id == DetalleSolicitud.solicitud_id
+    ).where(Solicitud.estado == 'Aprobada', Solicitud.fecha_aprobacion.isnot(None),
+            en_rango(Solicitud.fecha_aprobacion))
+
+    movimientos = union_all(solicitadas, aprobadas).subquery()
+    return db.select(
+        movimientos.c.fecha,
+        movimientos.c.escuela_id,
+        movimientos.c.product_id,
+        func.sum(movimientos.c.unidades_solicitadas).label('unidades_solicitadas'),
+        func.sum(movimientos.c.unidades_aprobadas).label('unidades_aprobadas'),
+        func.sum(movimientos.c.pedidos).label('pedidos')
+    ).group_by(movimientos.c.fecha, movimientos.c.escuela_id, movimientos.c.product_id)
+
+def _como_fecha(valor):
+    # func.date() devuelve date en PostgreSQL y texto AAAA-MM-DD en SQLite
+    return valor if isinstance(valor, date) else date.fromisoformat(valor)
+
+def verificar_consumo(desde=None):
+    """
+    Compara consumo_diario con el historial de pedidos, día por día, desde la
+    fecha indicada (o todo). Detecta los pedidos cargados o cambiados sin pasar
+    por acumular_consumo. Devuelve [(fecha, guardado, historial)], cada lado
+    como (unidades_solicitadas, unidades_aprobadas, pedidos) o None.
+    """
+    inicio = datetime(desde.year, desde.month, desde.day) if desde else None
+    historial = _consulta_consumo(inicio).subquery()
+    calculado = {
+        _como_fecha(fecha): (int(solicitadas), int(aprobadas), int(pedidos))
+        for fecha, solicitadas, aprobadas, pedidos in db.session.execute(
+            db.select(historial.c.fecha, func.sum(historial.c.unidades_solicitadas),
+                      func.sum(historial.c.unidades_aprobadas), func.sum(historial.c.pedidos))
+            .group_by(historial.c.fecha))
+    }
+    acumulado = db.session.query(
+        ConsumoDiario.fecha, func.sum(ConsumoDiario.unidades_solicitadas),
+        func.sum(ConsumoDiario.unidades_aprobadas), func.sum(ConsumoDiario.pedidos)
+    ).group_by(ConsumoDiario.fecha)
+    if desde is not None:
+        acumulado = acumulado.filter(ConsumoDiario.fecha >= desde)
+    guardado = {fecha: (int(solicitadas), int(aprobadas), int(pedidos))
+                for fecha, solicitadas, aprobadas, pedidos in acumulado}
+
+    # Un día sin movimientos equivale a un día sin filas
+    sin_datos = (0, 0, 0)
+    return [(fecha, guardado.get(fecha), calculado.get(fecha))
+            for fecha in sorted(set(guardado) | set(calculado))
+            if guardado.get(fecha, sin_datos) != calculado.get(fecha, sin_datos)]
+
+def reconstruir_consumo(desde=None, dias_por_lote=31, avance=None):
+    """
+    Reconstruye consumo_diario desde el historial, por ventanas de días.
+    Cada ventana se agrega en SQL, se escribe con un upsert masivo y se
+    confirma por separado, así la memoria usada no crece con el historial.
+    avance(porcentaje) se llama después de cada ventana.
+    Devuelve la cantidad de filas escritas.
+    """
+    primera = db.session.query(func.min(Solicitud.fecha_solicitud)).scalar()
+    if desde is None:
+        db.session.query(ConsumoDiario).delete(synchronize_session=False)
+        inicio = datetime(primera.year, primera.month, primera.day) if primera else None
+    else:
+        db.session.query(ConsumoDiario).filter(ConsumoDiario.fecha >= desde).delete(synchronize_session=False)
+        inicio = datetime(desde.year, desde.month, desde.day)
+    db.session.commit()
+
+    escritas = 0
+    fin = datetime.utcnow() + timedelta(days=1)
+    primer_dia = inicio
+    while inicio is not None and inicio < fin:
+        siguiente = inicio + timedelta(days=dias_por_lote)
+        filas = [
+            {'fecha': _como_fecha(fila.fecha), 'escuela_id': fila.escuela_id, 'product_id': fila.product_id,
+             'unidades_solicitadas': int(fila.unidades_solicitadas), 'unidades_aprobadas': int(fila.unidades_aprobadas),
+             'pedidos': int(fila.pedidos)}
+            for fila in db.session.execute(_consulta_consumo(inicio, siguiente))
+        ]
+        acumular_consumo(filas)
+        db.session.commit()
+        escritas += len(filas)
+        inicio = siguiente
+        if avance:
+            avance((min(inicio, fin) - primer_dia) / (fin - primer_dia) * 100)
+    return escritas
+
+
+# -------------------------------------------------------------------------
+# PRONÓSTICO DE DEMANDA Y REPOSICIÓN
+# -------------------------------------------------------------------------
+# Se calcula en lote sobre consumo_diario (unidades solicitadas, que miden la
+# demanda aunque el pedido no se haya aprobado por falta de stock):
+#   - consumo_diario: promedio móvil de los últimos PRONOSTICO_VENTANA_DIAS.
+#   - índice estacional por mes del calendario escolar (demanda del mes sobre la
+#     demanda media), si hay al menos un año de historia.
+#   - demanda_diaria: el promedio móvil desestacionalizado y proyectado a los
+#     meses del plazo de reposición.
+#   - punto_reorden: demanda del plazo + factor * desviación diaria * √plazo.
+# Las agregaciones se hacen en SQL (una consulta por medida para todos los
+# productos); en Python solo se combinan los vectores de 12 meses.
+
+def _dias_por_mes(desde, hasta):
+    # Cantidad de días de cada mes (1-12) en el rango [desde, hasta)
+    dias = [0] * 13
+    dia = desde
+    while dia < hasta:
+        dias[dia.month] += 1
+        dia += timedelta(days=1)
+    return dias
+
+def _indice_medio(indices, dias):
+    total = sum(dias)
+    return sum(indices[mes] * dias[mes] for mes in range(1, 13)) / total if total else 1.0
+
+def calcular_pronostico(hoy=None):
+    """
+    Recalcula pronostico_demanda para todos los productos y sus bodegas en una
+    sola transacción (las páginas ven el cálculo anterior o el nuevo completo).
+    Devuelve la cantidad de filas escritas.
+    """
+    hoy = hoy or datetime.utcnow().date()
+    ventana = app.config['PRONOSTICO_VENTANA_DIAS']
+    plazo = app.config['PRONOSTICO_PLAZO_DIAS']
+    factor = app.config['PRONOSTICO_FACTOR_SEGURIDAD']
+    inicio_ventana = hoy - timedelta(days=ventana)
+    primera = db.session.scalar(db.select(func.min(ConsumoDiario.fecha)))
+    inicio_historia = max(hoy - timedelta(days=app.config['PRONOSTICO_HISTORIA_DIAS']),
+                          _como_fecha(primera) if primera else hoy)
+
+    # 1. Promedio móvil y desviación: suma y suma de cuadrados de la demanda diaria por producto
+    por_dia = db.select(
+        ConsumoDiario.product_id,
+        func.sum(ConsumoDiario.unidades_solicitadas).label('unidades')
+    ).where(ConsumoDiario.fecha >= inicio_ventana, ConsumoDiario.fecha < hoy
+    ).group_by(ConsumoDiario.product_id, ConsumoDiario.fecha).subquery()
+    recientes = {
+        product_id: (float(suma), float(cuadrados))
+        for product_id, suma, cuadrados in db.session.execute(db.select(
+            por_dia.c.product_id, func.sum(por_dia.c.unidades), func.sum(por_dia.c.unidades * por_dia.c.unidades)
+        ).group_by(por_dia.c.product_id))
+    }
+
+    # 2. Demanda por mes del calendario en toda la historia
+    mes = func.extract('month', ConsumoDiario.fecha)
+    por_mes = defaultdict(lambda: [0.0] * 13)
+    for product_id, numero_mes, unidades in db.session.execute(db.select(
+        ConsumoDiario.product_id, mes, func.sum(ConsumoDiario.unidades_solicitadas)
+    ).where(ConsumoDiario.fecha >= inicio_historia, ConsumoDiario.fecha < hoy
+    ).group_by(ConsumoDiario.product_id, mes)):
+        por_mes[product_id][int(numero_mes)] += float(unidades)
+
+    dias_historia = _dias_por_mes(inicio_historia, hoy)
+    dias_ventana = _dias_por_mes(inicio_ventana, hoy)
+    dias_plazo = _dias_por_mes(hoy, hoy + timedelta(days=plazo))
+    con_estacionalidad = (hoy - inicio_historia).days >= 365
+
+    # 3. Reparto entre bodegas: según las reservas de la historia, o según lo disponible
+    reservas = defaultdict(dict)
+    for product_id, bodega_id, unidades in db.session.execute(db.select(
+        MovimientoStock.product_id, MovimientoStock.bodega_id, func.sum(MovimientoStock.reservado)
+    ).where(MovimientoStock.tipo == 'reserva', MovimientoStock.creado_en >= inicio_historia
+    ).group_by(MovimientoStock.product_id, MovimientoStock.bodega_id)):
+        reservas[product_id][bodega_id] = float(unidades)
+    saldos = defaultdict(dict)
+    for bodega_id, product_id, disponible in db.session.execute(db.select(
+        SaldoBodega.bodega_id, SaldoBodega.product_id, SaldoBodega.existencia - SaldoBodega.reservado
+    )):
+        saldos[product_id][bodega_id] = disponible
+
+    ahora = datetime.utcnow()
+    filas = []
+
+    def recomendacion(product_id, bodega_id, consumo, demanda, desviacion, disponible):
+        punto_reorden = math.ceil(demanda * plazo + factor * desviacion * math.sqrt(plazo))
+        filas.append({
+            'product_id': product_id, 'bodega_id': bodega_id,
+            'consumo_diario': round(consumo, 4), 'demanda_diaria': round(demanda, 4),
+            'punto_reorden': punto_reorden, 'disponible': disponible,
+            'dias_cobertura': round(max(disponible, 0) / demanda, 1) if demanda > 0 else None,
+            'reponer': demanda > 0 and disponible <= punto_reorden,
+            'calculado_en': ahora,
+        })
+
+    for product_id, stock in db.session.execute(db.select(Product.id, Product.stock)):
+        suma, cuadrados = recientes.get(product_id, (0.0, 0.0))
+        consumo = suma / ventana
+        desviacion = math.sqrt(max(cuadrados / ventana - consumo * consumo, 0.0))
+
+        demanda = consumo
+        meses = por_mes.get(product_id)
+        if con_estacionalidad and meses and sum(meses):
+            media = sum(meses) / sum(dias_historia)
+            indices = [1.0] + [meses[m] / dias_historia[m] / media if dias_historia[m] else 1.0 for m in range(1, 13)]
+            indice_ventana = _indice_medio(indices, dias_ventana)
+            # Si la ventana cae en vacaciones el promedio móvil no sirve de base: se usa la media histórica
+            base = consumo / indice_ventana if indice_ventana >= 0.1 else media
+            demanda = base * _indice_medio(indices, dias_plazo)
+        recomendacion(product_id, None, consumo, demanda, desviacion, stock)
+
+        bodegas = saldos.get(product_id, {})
+        pesos = reservas.get(product_id) or {b: max(d, 0) for b, d in bodegas.items()}
+        total = sum(pesos.values())
+        for bodega_id, disponible in bodegas.items():
+            parte = pesos.get(bodega_id, 0) / total if total else 1 / len(bodegas)
+            recomendacion(product_id, bodega_id, consumo * parte, demanda * parte, desviacion * parte, disponible)
+
+    db.session.query(PronosticoDemanda).delete(synchronize_session=False)
+    if filas:
+        db.session.execute(insert(PronosticoDemanda), filas)
+    db.session.commit()
+    return len(filas)
+
+
+# -------------------------------------------------------------------------
+# TRABAJOS EN SEGUNDO PLANO (cola en la tabla job)
+# -------------------------------------------------------------------------
+# Las acciones largas se encolan desde la web y las ejecuta `flask worker`
+# (entrada worker del Procfile). En Postgres cada worker toma el siguiente
+# trabajo con SELECT ... FOR UPDATE SKIP LOCKED; en SQLite con un UPDATE
+# condicional. Un trabajo que falla se reintenta con espera exponencial.
+
+TAREAS = {}
+
+def tarea(nombre, descripcion):
+    """Registra una tarea: funcion(parametros, avance) -> (mensaje, (archivo, mimetype, bytes) o None)."""
+    def registrar(funcion):
+        TAREAS[nombre] = (descripcion, funcion)
+        return funcion
+    return registrar
+
+@tarea('qr_lote', 'Códigos QR en ZIP')
+def _tarea_qr_lote(parametros, avance):
+    tipo = parametros.get('tipo', 'todos')
+    items = _items_qr_lote(tipo)
+    # Termina la transacción de lectura antes de los avances (SQLite bloquea escrituras)
+    db.session.commit()
+    partes = []
+    for numero, parte in enumerate(generar_zip_qr(items, app.config['QR_LOTE_PROCESOS'])):
+        partes.append(parte)
+        avance(numero * 100 / (len(items) + 1))
+    return f'{len(items)} códigos QR', (f'qr_{tipo}.zip', 'application/zip', b''.join(partes))
+
+@tarea('exportar_pedidos', 'Exportación de pedidos (CSV)')
+def _tarea_exportar_pedidos(parametros, avance):
+    filas_por_bloque = app.config['EXPORTACION_FILAS_POR_BLOQUE']
+    encabezados, filas = filas_exportacion_pedidos(MultiDict(parametros), filas_por_bloque)
+    contenido = ''.join(_generar_csv(encabezados, filas, filas_por_bloque)).encode('utf-8')
+    nombre = f"pedidos_{datetime.utcnow().strftime('%Y%m%d_%H%M')}.csv"
+    return 'Exportación lista', (nombre, 'text/csv', contenido)
+
+@tarea('importar', 'Importación CSV')
+def _tarea_importar(parametros, avance):
+    entrada = db.session.get(ArchivoTrabajo, parametros['archivo_id'])
+    if entrada is None:
+        raise ValueError('El archivo de la importación ya no existe.')
+    contenido = entrada.contenido
+    total_lineas = max(1, contenido.count(b'\n'))
+    texto = io.TextIOWrapper(io.BytesIO(contenido), encoding='utf-8-sig', newline='')
+    resultado = importar_csv(parametros['tipo'], texto,
+                             al_terminar_lote=lambda linea: avance(linea * 100 / total_lineas))
+    mensaje = (f"{resultado['insertadas']} nuevas, {resultado['actualizadas']} actualizadas, "
+               f"{resultado['sin_cambios']} sin cambios, {len(resultado['errores'])} errores")
+    if not resultado['errores']:
+        return mensaje, None
+    errores = ''.join(_generar_csv(['linea', 'error'], resultado['errores'], 1000)).encode('utf-8')
+    return mensaje, (f"errores_{parametros['tipo']}.csv", 'text/csv', errores)
+
+@tarea('reconstruir_consumo', 'Reconstrucción del consumo diario')
+def _tarea_reconstruir_consumo(parametros, avance):
+    desde = datetime.strptime(parametros['desde'], '%Y-%m-%d').date() if parametros.get('desde') else None
+    escritas = reconstruir_consumo(desde, avance=avance)
+    return f'{escritas} filas de consumo_diario', None
+
+@tarea('pronostico_demanda', 'Pronóstico de demanda y reposición')
+def _tarea_pronostico_demanda(parametros, avance):
+    filas = calcular_pronostico()
+    reponer = PronosticoDemanda.query.filter(PronosticoDemanda.bodega_id.is_(None), PronosticoDemanda.reponer).count()
+    return f'{filas} recomendaciones, {reponer} productos para reponer', None
+
+# Tareas periódicas: (tipo, clave de configuración con el intervalo en horas).
+# El worker encola una cuando no hay otra en la cola y la última terminó hace
+# más del intervalo. Con varios workers puede encolarse dos veces; el cálculo
+# es idempotente.
+TAREAS_PROGRAMADAS = [('pronostico_demanda', 'PRONOSTICO_INTERVALO_HORAS')]
+
+def programar_tareas():
+    ahora = datetime.utcnow()
+    for tipo, clave in TAREAS_PROGRAMADAS:
+        horas = app.config[clave]
+        if horas <= 0:
+            continue
+        # Un trabajo sin terminar cuenta como reciente
+        ultimo = db.session.scalar(db.select(func.max(func.coalesce(Trabajo.terminado_en, ahora)))
+                                   .where(Trabajo.tipo == tipo))
+        if ultimo is None or ultimo < ahora - timedelta(hours=horas):
+            encolar_trabajo(tipo, {})
+    db.session.commit()
+
+def encolar_trabajo(tipo, parametros):
+    """Crea un trabajo pendiente y lo confirma. Guarda la URL base para url_for(_external=True)."""
+    parametros = dict(parametros)
+    if has_request_context():
+        parametros.setdefault('_base_url', request.host_url)
+    trabajo = Trabajo(
+        tipo=tipo,
+        parametros=json.dumps(parametros),
+        max_intentos=app.config['TRABAJOS_MAX_INTENTOS'],
+        usuario_id=current_user.id if has_request_context() and current_user.is_authenticated else None
+    )
+    db.session.add(trabajo)
+    db.session.commit()
+    return trabajo
+
+def tomar_trabajo(trabajador):
+    """Marca como en_proceso el siguiente trabajo disponible y lo devuelve (None si no hay)."""
+    ahora = datetime.utcnow()
+    disponibles = db.select(Trabajo).where(
+        Trabajo.estado == 'pendiente', Trabajo.disponible_en <= ahora
+    ).order_by(Trabajo.disponible_en, Trabajo.id).limit(1)
+
+    if db.engine.dialect.name == 'postgresql':
+        # Los workers concurrentes saltan las filas que otro ya bloqueó
+        trabajo = db.session.scalars(disponibles.with_for_update(skip_locked=True)).first()
+        if trabajo is None:
+            db.session.rollback()
+            return None
+        trabajo.estado = 'en_proceso'
+        trabajo.intentos += 1
+        trabajo.iniciado_en = trabajo.latido_en = ahora
+        trabajo.trabajador = trabajador
+        db.session.commit()
+        return trabajo
+
+    # SQLite no tiene SKIP LOCKED: se reclama con compare-and-swap sobre el estado
+    while True:
+        trabajo_id = db.session.scalar(disponibles.with_only_columns(Trabajo.id))
+        if trabajo_id is None:
+            db.session.rollback()
+            return None
+        reclamado = db.session.execute(
+            update(Trabajo)
+            .where(Trabajo.id == trabajo_id, Trabajo.estado == 'pendiente')
+            .values(estado='en_proceso', intentos=Trabajo.intentos + 1,
+                    iniciado_en=ahora, latido_en=ahora, trabajador=trabajador)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if reclamado:
+            return db.session.get(Trabajo, trabajo_id)
+
+def _avance_trabajo(trabajo_id):
+    # El avance se escribe en su propia transacción; si la base está ocupada se omite
+    ultimo = [-1]
+    def avance(porcentaje):
+        porcentaje = max(0, min(99, int(porcentaje)))
+        if porcentaje == ultimo[0]:
+            return
+        ultimo[0] = porcentaje
+        try:
+            with db.engine.begin() as conexion:
+                conexion.execute(update(Trabajo).where(Trabajo.id == trabajo_id).values(
+                    progreso=porcentaje, latido_en=datetime.utcnow()))
+        except SQLAlchemyError:
+            pass
+    return avance
+
+@contextmanager
+def _latido_trabajo(trabajo_id):
+    """
+    Renueva latido_en en un hilo aparte mientras dura el bloque, también cuando la
+    tarea pasa mucho tiempo en una sola consulta o render sin informar avance.
+    """
+    motor = db.engine
+    intervalo = app.config['TRABAJOS_LATIDO_SEGUNDOS']
+    detener = threading.Event()
+
+    def latir():
+        while not detener.wait(intervalo):
+            try:
+                with motor.begin() as conexion:
+                    conexion.execute(update(Trabajo).where(
+                        Trabajo.id == trabajo_id, Trabajo.estado == 'en_proceso'
+                    ).values(latido_en=datetime.utcnow()))
+            except SQLAlchemyError:
+                pass # base ocupada: se reintenta en el próximo latido
+
+    hilo = threading.Thread(target=latir, name=f'latido-trabajo-{trabajo_id}', daemon=True)
+    hilo.start()
+    try:
+        yield
+    finally:
+        detener.set()
+        hilo.join()
+
+def ejecutar_trabajo(trabajo):
+    """Ejecuta un trabajo ya tomado y registra el resultado, el reintento o el fallo."""
+    trabajo_id = trabajo.id
+    descripcion, funcion = TAREAS.get(trabajo.tipo, (None, None))
+    parametros = json.loads(trabajo.parametros or '{}')
+    try:
+        if funcion is None:
+            raise ValueError(f'Tipo de trabajo desconocido: {trabajo.tipo}')
+        # Contexto de petición para url_for(_external=True) con la URL de quien lo encoló
+        with app.test_request_context(base_url=parametros.get('_base_url')), _latido_trabajo(trabajo_id):
+            mensaje, archivo = funcion(parametros, _avance_trabajo(trabajo_id))
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception("Trabajo %s (%s) falló", trabajo_id, trabajo.tipo)
+        trabajo = db.session.get(Trabajo, trabajo_id)
+        trabajo.mensaje = f'{type(e).__name__}: {e}'[:500]
+        if funcion is not None and trabajo.intentos < trabajo.max_intentos:
+            espera = app.config['TRABAJOS_REINTENTO_SEGUNDOS'] * 2 ** (trabajo.intentos - 1)
+            trabajo.estado = 'pendiente'
+            trabajo.disponible_en = datetime.utcnow() + timedelta(seconds=espera)
+        else:
+            trabajo.estado = 'fallido'
+            trabajo.terminado_en = datetime.utcnow()
+        db.session.commit()
+        return False
+
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    trabajo.estado = 'completado'
+    trabajo.progreso = 100
+    trabajo.mensaje = mensaje[:500] if mensaje else None
+    trabajo.terminado_en = datetime.utcnow()
+    if archivo:
+        trabajo.resultado_nombre, trabajo.resultado_tipo, trabajo.resultado = archivo
+    db.session.commit()
+    return True
+
+def mantener_cola():
+    """
+    Devuelve a la cola los trabajos abandonados (sin latido reciente: el worker
+    se cayó o fue detenido) y borra los terminados antiguos. Un trabajo largo
+    cuyo worker sigue latiendo no se reintenta, así no se ejecuta dos veces.
+    """
+    ahora = datetime.utcnow()
+    vencidos = and_(Trabajo.estado == 'en_proceso',
+                    func.coalesce(Trabajo.latido_en, Trabajo.iniciado_en)
+                    < ahora - timedelta(seconds=app.config['TRABAJOS_LATIDO_VENCIDO']))
+    db.session.execute(update(Trabajo).where(vencidos, Trabajo.intentos < Trabajo.max_intentos).values(
+        estado='pendiente', disponible_en=ahora, mensaje='Reintentado: el worker dejó de responder'
+    ).execution_options(synchronize_session=False))
+    db.session.execute(update(Trabajo).where(vencidos).values(
+        estado='fallido', terminado_en=ahora, mensaje='El worker dejó de responder'
+    ).execution_options(synchronize_session=False))
+    retencion = ahora - timedelta(days=app.config['TRABAJOS_RETENCION_DIAS'])
+    db.session.execute(db.delete(Trabajo).where(
+        Trabajo.estado.in_(('completado', 'fallido')), Trabajo.terminado_en < retencion
+    ).execution_options(synchronize_session=False))
+    db.session.execute(db.delete(ArchivoTrabajo).where(ArchivoTrabajo.creado_en < retencion)
+                       .execution_options(synchronize_session=False))
+    limpiar_claves_idempotencia()
+    db.session.commit()
+
+def _trabajo_json(trabajo):
+    datos = {
+        'id': trabajo.id,
+        'tipo': trabajo.tipo,
+        'estado': trabajo.estado,
+        'progreso': trabajo.progreso,
+        'mensaje': trabajo.mensaje,
+        'intentos': trabajo.intentos,
+        'creado_en': trabajo.creado_en.isoformat(),
+        'terminado_en': trabajo.terminado_en.isoformat() if trabajo.terminado_en else None,
+        'estado_url': url_for('ver_trabajo', trabajo_id=trabajo.id),
+    }
+    if trabajo.estado == 'completado' and trabajo.resultado_nombre:
+        datos['resultado_url'] = url_for('descargar_resultado_trabajo', trabajo_id=trabajo.id)
+    return datos
+
+@app.route('/trabajos/<tipo>', methods=['POST'])
+@login_required
+def crear_trabajo(tipo):
+    if tipo not in TAREAS or tipo == 'importar': # la importación se encola desde /importar
+        abort(404)
+    parametros = request.get_json(silent=True) or request.form.to_dict()
+    if tipo == 'qr_lote' and parametros.get('tipo', 'todos') not in TIPOS_QR_LOTE:
+        abort(400)
+
+    trabajo = encolar_trabajo(tipo, parametros)
+    if request.is_json:
+        return jsonify(_trabajo_json(trabajo)), 202, {'Location': url_for('ver_trabajo', trabajo_id=trabajo.id)}
+    flash(f'{TAREAS[tipo][0]}: se procesará en segundo plano.', 'info')
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo.id))
+
+@app.route('/trabajos/<int:trabajo_id>')
+@login_required
+def ver_trabajo(trabajo_id):
+    trabajo = db.get_or_404(Trabajo, trabajo_id)
+    if request.args.get('formato') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(_trabajo_json(trabajo))
+    return render_template('trabajo.html', trabajo=trabajo, descripcion=TAREAS.get(trabajo.tipo, (trabajo.tipo,))[0])
+
+@app.route('/trabajos/<int:trabajo_id>/resultado')
+@login_required
+def descargar_resultado_trabajo(trabajo_id):
+    trabajo = db.get_or_404(Trabajo, trabajo_id)
+    if trabajo.estado != 'completado' or trabajo.resultado is None:
+        abort(404)
+    return send_file(io.BytesIO(trabajo.resultado), mimetype=trabajo.resultado_tipo,
+                     as_attachment=True, download_name=trabajo.resultado_nombre)
+
+
+# =========================================================================
+# 5. MIGRACIONES DE ESQUEMA (VERSIONADAS)
+# =========================================================================
+# Cada migración se aplica una sola vez y queda registrada en schema_version.
+# Deben ser idempotentes (checkfirst) porque la base puede venir de un
+# db.create_all() anterior. Cada una declara sus propias tablas e índices tal
+# como eran en esa versión: no usar los modelos ni db.metadata, que describen
+# el esquema final y harían fallar a las migraciones anteriores (p. ej. un
+# índice sobre una columna que agrega una migración posterior). Para cambiar
+# el esquema, agregar una nueva migración al final con el siguiente número.
+
+MIGRACIONES = []
+
+def migracion(version, descripcion):
+    def registrar(funcion):
+        MIGRACIONES.append((version, descripcion, funcion))
+        return funcion
+    return registrar
+
+def _esquema(*referencias):
+    """
+    MetaData propia de una migración. Las tablas que la migración solo referencia
+    con ForeignKey se declaran con su id (no se crean): así la migración no depende
+    de los modelos actuales, que pueden tener columnas e índices posteriores.
+    """
+    esquema = MetaData()
+    for nombre in referencias:
+        Table(nombre, esquema, db.Column('id', db.Integer, primary_key=True))
+    return esquema
+
+def _tabla(conexion, nombre):
+    # Tabla tal como está en la base al momento de la migración
+    return Table(nombre, MetaData(), autoload_with=conexion)
+
+def _crear_indice(conexion, nombre, tabla, *columnas, unique=False):
+    if isinstance(tabla, str):
+        tabla = _tabla(conexion, tabla)
+    db.Index(nombre, *(tabla.c[columna] for columna in columnas), unique=unique).create(conexion, checkfirst=True)
+
+@migracion(1, 'Esquema base')
+def _migracion_esquema_base(conexion):
+    esquema = MetaData()
+    Table('user', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('username', db.String(80), unique=True, nullable=False),
+          db.Column('email', db.String(100), unique=True, nullable=False),
+          db.Column('is_admin', db.Boolean),
+          db.Column('password_hash', db.String(128)))
+    Table('product', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('name', db.String(100), nullable=False),
+          db.Column('code', db.String(50), unique=True, nullable=False),
+          db.Column('created_at', db.DateTime),
+          db.Column('stock', db.Integer))
+    Table('bodega', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('name', db.String(100), nullable=False, unique=True),
+          db.Column('location', db.String(200)))
+    Table('supervisor', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('name', db.String(100), nullable=False),
+          db.Column('apellido', db.String(100), nullable=False),
+          db.Column('email', db.String(120), unique=True, nullable=False),
+          db.Column('qr_code_data', db.String(255), unique=True))
+    Table('escuela', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('name', db.String(100), nullable=False),
+          db.Column('qr_code_data', db.String(255), unique=True))
+    Table('supervisor_escuela', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('supervisor_id', db.Integer, db.ForeignKey('supervisor.id'), nullable=False),
+          db.Column('escuela_id', db.Integer, db.ForeignKey('escuela.id'), nullable=False),
+          db.UniqueConstraint('supervisor_id', 'escuela_id', name='_supervisor_escuela_uc'))
+    Table('solicitud', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('supervisor_id', db.Integer, db.ForeignKey('supervisor.id'), nullable=False),
+          db.Column('escuela_id', db.Integer, db.ForeignKey('escuela.id'), nullable=False),
+          db.Column('fecha_solicitud', db.DateTime),
+          db.Column('fecha_aprobacion', db.DateTime),
+          db.Column('estado', db.String(50), nullable=False))
+    Table('detalle_solicitud', esquema,
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('solicitud_id', db.Integer, db.ForeignKey('solicitud.id'), nullable=False),
+          db.Column('product_id', db.Integer, db.ForeignKey('product.id'), nullable=False),
+          db.Column('cantidad_solicitada', db.Integer, nullable=False))
+    esquema.create_all(conexion, checkfirst=True)
+
+@migracion(2, 'Índices compuestos para las consultas frecuentes')
+def _migracion_indices_consultas(conexion):
+    solicitud = _tabla(conexion, 'solicitud')
+    _crear_indice(conexion, 'ix_solicitud_escuela_fecha', solicitud, 'escuela_id', 'fecha_solicitud')
+    _crear_indice(conexion, 'ix_solicitud_fecha_id', solicitud, 'fecha_solicitud', 'id')
+    _crear_indice(conexion, 'ix_solicitud_supervisor_estado_fecha', solicitud, 'supervisor_id', 'estado', 'fecha_solicitud')
+    _crear_indice(conexion, 'ix_solicitud_estado_fecha', solicitud, 'estado', 'fecha_solicitud')
+    _crear_indice(conexion, 'ix_detalle_solicitud_solicitud_producto', 'detalle_solicitud', 'solicitud_id', 'product_id')
+    _crear_indice(conexion, 'ix_supervisor_escuela_escuela_id', 'supervisor_escuela', 'escuela_id')
+
+@migracion(3, 'Cupo de pedidos por escuela')
+def _migracion_limite_pedido_escuela(conexion):
+    Table('limite_pedido_escuela', _esquema('escuela'),
+          db.Column('escuela_id', db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False),
+          db.Column('limite', db.Integer),
+          db.Column('marcas', db.Text, nullable=False),
+          db.Column('version', db.Integer, nullable=False)
+          ).create(conexion, checkfirst=True)
+
+@migracion(4, 'Versión del catálogo de productos')
+def _migracion_catalogo_version(conexion):
+    catalogo_version = Table('catalogo_version', MetaData(),
+                             db.Column('id', db.Integer, primary_key=True, autoincrement=False),
+                             db.Column('version', db.Integer, nullable=False))
+    catalogo_version.create(conexion, checkfirst=True)
+    if conexion.execute(db.select(catalogo_version.c.id).where(catalogo_version.c.id == 1)).first() is None:
+        conexion.execute(db.insert(catalogo_version).values(id=1, version=1))
+
+@migracion(5, 'Consumo diario acumulado')
+def _migracion_consumo_diario(conexion):
+    esquema = _esquema('escuela', 'product')
+    consumo_diario = Table('consumo_diario', esquema,
+                           db.Column('fecha', db.Date, primary_key=True),
+                           db.Column('escuela_id', db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False),
+                           db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, autoincrement=False),
+                           db.Column('unidades_solicitadas', db.Integer, nullable=False),
+                           db.Column('unidades_aprobadas', db.Integer, nullable=False),
+                           db.Column('pedidos', db.Integer, nullable=False),
+                           db.Index('ix_consumo_diario_producto_fecha', 'product_id', 'fecha'))
+    consumo_diario.create(conexion, checkfirst=True)
+    if conexion.execute(db.select(consumo_diario.c.fecha).limit(1)).first() is not None:
+        return
+
+    # Carga inicial en un solo INSERT ... SELECT sobre las columnas del pedido en esta
+    # versión (para reconstrucciones posteriores usar `flask reconstruir-consumo`)
+    solicitud = Table('solicitud', esquema,
+                      db.Column('id', db.Integer, primary_key=True),
+                      db.Column('escuela_id', db.Integer),
+                      db.Column('fecha_solicitud', db.DateTime),
+                      db.Column('fecha_aprobacion', db.DateTime),
+                      db.Column('estado', db.String(50)))
+    detalle = Table('detalle_solicitud', esquema,
+                    db.Column('id', db.Integer, primary_key=True),
+                    db.Column('solicitud_id', db.Integer),
+                    db.Column('product_id', db.Integer),
+                    db.Column('cantidad_solicitada', db.Integer))
+    pedidos = detalle.join(solicitud, solicitud.c.id == detalle.c.solicitud_id)
+    solicitadas = db.select(
+        func.date(solicitud.c.fecha_solicitud).label('fecha'), solicitud.c.escuela_id, detalle.c.product_id,
+        detalle.c.cantidad_solicitada.label('unidades_solicitadas'),
+        literal(0).label('unidades_aprobadas'), literal(1).label('pedidos')
+    ).select_from(pedidos)
+    aprobadas = db.select(
+        func.date(solicitud.c.fecha_aprobacion), solicitud.c.escuela_id, detalle.c.product_id,
+        literal(0), detalle.c.cantidad_solicitada, literal(0)
+    ).select_from(pedidos).where(solicitud.c.estado == 'Aprobada', solicitud.c.fecha_aprobacion.isnot(None))
+    movimientos = union_all(solicitadas, aprobadas).subquery()
+    conexion.execute(db.insert(consumo_diario).from_select(
+        ['fecha', 'escuela_id', 'product_id', 'unidades_solicitadas', 'unidades_aprobadas', 'pedidos'],
+        db.select(
+            movimientos.c.fecha, movimientos.c.escuela_id, movimientos.c.product_id,
+            func.sum(movimientos.c.unidades_solicitadas), func.sum(movimientos.c.unidades_aprobadas),
+            func.sum(movimientos.c.pedidos)
+        ).group_by(movimientos.c.fecha, movimientos.c.escuela_id, movimientos.c.product_id)
+    ))
+
+@migracion(6, 'Cola de trabajos en segundo plano')
+def _migracion_trabajos(conexion):
+    Table('job', _esquema('user'),
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('tipo', db.String(50), nullable=False),
+          db.Column('parametros', db.Text, nullable=False),
+          db.Column('estado', db.String(20), nullable=False),
+          db.Column('progreso', db.Integer, nullable=False),
+          db.Column('mensaje', db.String(500)),
+          db.Column('intentos', db.Integer, nullable=False),
+          db.Column('max_intentos', db.Integer, nullable=False),
+          db.Column('disponible_en', db.DateTime, nullable=False),
+          db.Column('creado_en', db.DateTime, nullable=False),
+          db.Column('iniciado_en', db.DateTime),
+          db.Column('terminado_en', db.DateTime),
+          db.Column('trabajador', db.String(100)),
+          db.Column('usuario_id', db.Integer, db.ForeignKey('user.id')),
+          db.Column('resultado_nombre', db.String(200)),
+          db.Column('resultado_tipo', db.String(100)),
+          db.Column('resultado', db.LargeBinary),
+          db.Index('ix_job_estado_disponible', 'estado', 'disponible_en')
+          ).create(conexion, checkfirst=True)
+
+@migracion(7, 'Libro de inventario por bodega')
+def _migracion_inventario(conexion):
+    esquema = _esquema('bodega', 'product', 'solicitud', 'user')
+    movimiento_stock = Table('movimiento_stock', esquema,
+                             db.Column('id', db.Integer, primary_key=True),
+                             db.Column('bodega_id', db.Integer, db.ForeignKey('bodega.id'), nullable=False),
+                             db.Column('product_id', db.Integer, db.ForeignKey('product.id'), nullable=False),
+                             db.Column('tipo', db.String(20), nullable=False),
+                             db.Column('existencia', db.Integer, nullable=False),
+                             db.Column('reservado', db.Integer, nullable=False),
+                             db.Column('solicitud_id', db.Integer, db.ForeignKey('solicitud.id')),
+                             db.Column('usuario_id', db.Integer, db.ForeignKey('user.id')),
+                             db.Column('nota', db.String(200)),
+                             db.Column('creado_en', db.DateTime, nullable=False),
+                             db.Index('ix_movimiento_stock_bodega_producto', 'bodega_id', 'product_id', 'id'),
+                             db.UniqueConstraint('solicitud_id', 'tipo', 'bodega_id', 'product_id',
+                                                 name='uq_movimiento_stock_solicitud'))
+    saldo_bodega = Table('saldo_bodega', esquema,
+                         db.Column('bodega_id', db.Integer, db.ForeignKey('bodega.id'), primary_key=True, autoincrement=False),
+                         db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, autoincrement=False),
+                         db.Column('existencia', db.Integer, nullable=False),
+                         db.Column('reservado', db.Integer, nullable=False),
+                         db.CheckConstraint('existencia >= reservado AND reservado >= 0', name='ck_saldo_bodega_no_negativo'),
+                         db.Index('ix_saldo_bodega_producto', 'product_id'))
+    saldo_snapshot = Table('saldo_snapshot', esquema,
+                           db.Column('bodega_id', db.Integer, primary_key=True, autoincrement=False),
+                           db.Column('product_id', db.Integer, primary_key=True, autoincrement=False),
+                           db.Column('existencia', db.Integer, nullable=False),
+                           db.Column('reservado', db.Integer, nullable=False),
+                           db.Column('hasta_movimiento_id', db.Integer, nullable=False))
+    for tabla in (movimiento_stock, saldo_bodega, saldo_snapshot):
+        tabla.create(conexion, checkfirst=True)
+
+    # El stock existente pasa a la primera bodega (o a una nueva) como ajuste inicial
+    product, bodega = _tabla(conexion, 'product'), _tabla(conexion, 'bodega')
+    con_stock = conexion.execute(db.select(product.c.id, product.c.stock).where(product.c.stock > 0)).all()
+    if not con_stock or conexion.execute(db.select(movimiento_stock.c.id).limit(1)).first() is not None:
+        return
+    bodega_id = conexion.execute(db.select(func.min(bodega.c.id))).scalar()
+    if bodega_id is None:
+        bodega_id = conexion.execute(db.insert(bodega).values(name=BODEGA_PRINCIPAL)).inserted_primary_key[0]
+    ahora = datetime.utcnow()
+    conexion.execute(db.insert(movimiento_stock), [
+        {'bodega_id': bodega_id, 'product_id': product_id, 'tipo': 'ajuste', 'existencia': stock,
+         'reservado': 0, 'nota': 'Saldo inicial', 'creado_en': ahora}
+        for product_id, stock in con_stock
+    ])
+    conexion.execute(db.insert(saldo_bodega), [
+        {'bodega_id': bodega_id, 'product_id': product_id, 'existencia': stock, 'reservado': 0}
+        for product_id, stock in con_stock
+    ])
+
+@migracion(8, 'Pronóstico de demanda')
+def _migracion_pronostico_demanda(conexion):
+    Table('pronostico_demanda', _esquema('product', 'bodega'),
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('product_id', db.Integer, db.ForeignKey('product.id'), nullable=False),
+          db.Column('bodega_id', db.Integer, db.ForeignKey('bodega.id')),
+          db.Column('consumo_diario', db.Float, nullable=False),
+          db.Column('demanda_diaria', db.Float, nullable=False),
+          db.Column('punto_reorden', db.Integer, nullable=False),
+          db.Column('disponible', db.Integer, nullable=False),
+          db.Column('dias_cobertura', db.Float),
+          db.Column('reponer', db.Boolean, nullable=False),
+          db.Column('calculado_en', db.DateTime, nullable=False),
+          db.Index('ix_pronostico_demanda_producto', 'product_id', 'bodega_id')
+          ).create(conexion, checkfirst=True)
+
+@migracion(9, 'Índices de búsqueda para los listados')
+def _migracion_busqueda(conexion):
+    _crear_indice(conexion, 'ix_product_name', 'product', 'name', 'id')
+    _crear_indice(conexion, 'ix_escuela_name', 'escuela', 'name', 'id')
+    _crear_indice(conexion, 'ix_supervisor_apellido', 'supervisor', 'apellido', 'id')
+    # Columnas buscadas al crear esta migración (CAMPOS_BUSQUEDA puede cambiar después)
+    campos_busqueda = {
+        'product': ('name', 'code'),
+        'escuela': ('name',),
+        'supervisor': ('name', 'apellido', 'email'),
+        'bodega': ('name', 'location'),
+    }
+    if conexion.dialect.name == 'postgresql':
+        # pg_trgm puede no estar permitido para el usuario: sin él las búsquedas funcionan sin índice
+        try:
+            with conexion.begin_nested():
+                conexion.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        except SQLAlchemyError as e:
+            app.logger.warning("No se pudo crear la extensión pg_trgm: %s", e)
+            return
+        for tabla, campos in campos_busqueda.items():
+            for campo in campos:
+                conexion.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{tabla}_{campo}_trgm '
+                                      f'ON {tabla} USING gin (lower({campo}) gin_trgm_ops)'))
+    elif conexion.dialect.name == 'sqlite':
+        for tabla, campos in campos_busqueda.items():
+            columnas = ', '.join(campos)
+            nuevas = ', '.join(f'new.{campo}' for campo in campos)
+            viejas = ', '.join(f'old.{campo}' for campo in campos)
+            try:
+                with conexion.begin_nested():
+                    conexion.execute(text(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS {tabla}_fts USING fts5({columnas}, "
+                        f"content='{tabla}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"))
+            except SQLAlchemyError as e:
+                app.logger.warning("SQLite sin FTS5, búsqueda sin índice: %s", e)
+                return
+            # El índice externo se mantiene con triggers (solo cuando cambian las columnas buscadas)
+            conexion.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {tabla}_fts_ai AFTER INSERT ON {tabla} BEGIN "
+                f"INSERT INTO {tabla}_fts(rowid, {columnas}) VALUES (new.id, {nuevas}); END"))
+            conexion.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {tabla}_fts_ad AFTER DELETE ON {tabla} BEGIN "
+                f"INSERT INTO {tabla}_fts({tabla}_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejas}); END"))
+            conexion.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {tabla}_fts_au AFTER UPDATE OF {columnas} ON {tabla} BEGIN "
+                f"INSERT INTO {tabla}_fts({tabla}_fts, rowid, {columnas}) VALUES ('delete', old.id, {viejas}); "
+                f"INSERT INTO {tabla}_fts(rowid, {columnas}) VALUES (new.id, {nuevas}); END"))
+            conexion.execute(text(f"INSERT INTO {tabla}_fts({tabla}_fts) VALUES ('rebuild')"))
+
+@migracion(10, 'API móvil: versión por producto y claves de idempotencia')
+def _migracion_api_movil(conexion):
+    if 'version_catalogo' not in {c['name'] for c in inspect(conexion).get_columns('product')}:
+        conexion.execute(text('ALTER TABLE product ADD COLUMN version_catalogo INTEGER'))
+    # El índice se crea aquí, después de la columna: la migración 9 corre antes de que exista
+    _crear_indice(conexion, 'ix_product_version_catalogo', 'product', 'version_catalogo')
+    Table('clave_idempotencia', _esquema('escuela', 'solicitud'),
+          db.Column('clave', db.String(100), primary_key=True),
+          db.Column('escuela_id', db.Integer, db.ForeignKey('escuela.id'), primary_key=True, autoincrement=False),
+          db.Column('huella', db.String(64), nullable=False),
+          db.Column('solicitud_id', db.Integer, db.ForeignKey('solicitud.id'), nullable=False),
+          db.Column('creado_en', db.DateTime, nullable=False),
+          db.Index('ix_clave_idempotencia_creado_en', 'creado_en')
+          ).create(conexion, checkfirst=True)
+    catalogo_version = _tabla(conexion, 'catalogo_version')
+    version = conexion.execute(db.select(catalogo_version.c.version).where(catalogo_version.c.id == 1)).scalar() or 0
+    product = _tabla(conexion, 'product')
+    conexion.execute(update(product).where(product.c.version_catalogo.is_(None)).values(version_catalogo=version))
+
+@migracion(11, 'Latido de los trabajos en proceso')
+def _migracion_latido_trabajos(conexion):
+    if 'latido_en' not in {c['name'] for c in inspect(conexion).get_columns('job')}:
+        tipo = db.DateTime().compile(dialect=conexion.dialect)
+        conexion.execute(text(f'ALTER TABLE job ADD COLUMN latido_en {tipo}'))
+    # Los trabajos en curso durante la actualización cuentan desde su inicio
+    job = _tabla(conexion, 'job')
+    conexion.execute(update(job).where(job.c.estado == 'en_proceso', job.c.latido_en.is_(None))
+                     .values(latido_en=job.c.iniciado_en))
+
+@migracion(12, 'Archivos subidos para los trabajos')
+def _migracion_archivos_trabajo(conexion):
+    Table('job_archivo', _esquema(),
+          db.Column('id', db.Integer, primary_key=True),
+          db.Column('nombre', db.String(200), nullable=False),
+          db.Column('contenido', db.LargeBinary, nullable=False),
+          db.Column('creado_en', db.DateTime, nullable=False)
+          ).create(conexion, checkfirst=True)
+
+def aplicar_migraciones():
+    """Aplica las migraciones pendientes, cada una en su propia transacción. Devuelve las aplicadas."""
+    with db.engine.begin() as conexion:
+        VersionEsquema.__table__.create(conexion, checkfirst=True)
+        aplicadas = set(conexion.execute(db.select(VersionEsquema.version)).scalars())
+
+    nuevas = []
+    for version, descripcion, funcion in sorted(MIGRACIONES, key=lambda m: m[0]):
+        if version in aplicadas:
+            continue
+        with db.engine.begin() as conexion:
+            funcion(conexion)
+            conexion.execute(db.insert(VersionEsquema).values(
+                version=version, descripcion=descripcion, aplicada_en=datetime.utcnow()
+            ))
+        nuevas.append((version, descripcion))
+    if nuevas:
+        # Cachés que dependen del esquema: este proceso las recalcula al momento
+        olvidar_tablas_fts()
+    return nuevas
+
+@app.cli.command('migrar')
+def migrar_command():
+    """Aplica las migraciones de esquema pendientes."""
+    nuevas = aplicar_migraciones()
+    for version, descripcion in nuevas:
+        print(f">>> Migración {version} aplicada: {descripcion}")
+    if not nuevas:
+        print(">>> El esquema ya está actualizado.")
+
+
+@app.cli.command('limite-pedidos')
+@click.argument('escuela_id', type=int)
+@click.argument('limite', required=False, type=int)
+def limite_pedidos_command(escuela_id, limite):
+    """Fija el límite semanal de pedidos de una escuela (sin LIMITE vuelve al valor general)."""
+    if not db.session.get(Escuela, escuela_id):
+        raise click.ClickException('Escuela no encontrada.')
+    registro = db.session.get(LimitePedidoEscuela, escuela_id)
+    if registro is None:
+        _crear_limite_pedido(escuela_id, datetime.utcnow() - timedelta(days=app.config['VENTANA_PEDIDOS_DIAS']))
+        registro = db.session.get(LimitePedidoEscuela, escuela_id)
+    registro.limite = limite
+    db.session.commit()
+    print(f">>> Límite de la escuela {escuela_id}: {limite if limite is not None else app.config['PEDIDOS_POR_SEMANA']} pedidos por semana.")
+
+
+@app.cli.command('reconstruir-consumo')
+@click.option('--desde', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Reconstruir solo desde esta fecha (AAAA-MM-DD).')
+@click.option('--dias-por-lote', type=int, default=31)
+@click.option('--verificar', is_flag=True, help='Solo compara consumo_diario con el historial, por día, sin escribir.')
+def reconstruir_consumo_command(desde, dias_por_lote, verificar):
+    """Reconstruye la tabla consumo_diario a partir del historial de pedidos."""
+    limite_sentencias_largo()
+    if verificar:
+        inicio = time.perf_counter()
+        diferencias = verificar_consumo(desde.date() if desde else None)
+        for fecha, guardado, calculado in diferencias:
+            print(f"    {fecha}: guardado {guardado}, historial {calculado}")
+        print(f">>> {len(diferencias)} días con diferencias ({time.perf_counter() - inicio:.1f} s).")
+        return
+    escritas = reconstruir_consumo(desde.date() if desde else None, dias_por_lote)
+    print(f">>> consumo_diario reconstruido: {escritas} filas.")
+
+
+@app.cli.command('importar')
+@click.argument('tipo', type=click.Choice(sorted(IMPORTADORES)))
+@click.argument('archivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--filas-por-lote', type=int, default=1000)
+def importar_command(tipo, archivo, filas_por_lote):
+    """Importa productos, escuelas, supervisores o asignaciones desde un CSV."""
+    limite_sentencias_largo()
+    inicio = datetime.utcnow()
+    with open(archivo, encoding='utf-8-sig', newline='') as texto:
+        resultado = importar_csv(tipo, texto, filas_por_lote)
+    duracion = (datetime.utcnow() - inicio).total_seconds()
+    for linea, mensaje in resultado['errores']:
+        print(f"    Línea {linea}: {mensaje}")
+    print(f">>> {tipo}: {resultado['insertadas']} nuevas, {resultado['actualizadas']} actualizadas, "
+          f"{resultado['sin_cambios']} sin cambios, {len(resultado['errores'])} errores ({duracion:.1f} s).")
+
+
+@app.cli.command('worker')
+@click.option('--intervalo', type=float, default=None,
+              help='Segundos de espera cuando la cola está vacía (por defecto TRABAJOS_INTERVALO).')
+@click.option('--una-vez', is_flag=True, help='Procesa los trabajos disponibles y termina.')
+def worker_command(intervalo, una_vez):
+    """Procesa la cola de trabajos en segundo plano (tabla job)."""
+    intervalo = intervalo if intervalo is not None else app.config['TRABAJOS_INTERVALO']
+    trabajador = f"{socket.gethostname()}:{os.getpid()}"
+    limite_sentencias_largo()
+
+    # SIGTERM (deploy/reinicio): termina el trabajo en curso y sale
+    detener = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: detener.set())
+    signal.signal(signal.SIGINT, lambda *args: detener.set())
+
+    print(f">>> Worker {trabajador} esperando trabajos...")
+    proximo_mantenimiento = 0
+    while not detener.is_set():
+        if time.monotonic() >= proximo_mantenimiento:
+            mantener_cola()
+            programar_tareas()
+            proximo_mantenimiento = time.monotonic() + app.config['TRABAJOS_MANTENIMIENTO_SEGUNDOS']
+        trabajo = tomar_trabajo(trabajador)
+        if trabajo is None:
+            if una_vez:
+                break
+            detener.wait(intervalo)
+            continue
+        print(f">>> Trabajo {trabajo.id} ({trabajo.tipo}), intento {trabajo.intentos}")
+        completado = ejecutar_trabajo(trabajo)
+        print(f"    {'completado' if completado else 'falló'}")
+        # Libera el identity map (los resultados pueden ser grandes)
+        db.session.remove()
+    print(">>> Worker detenido.")
+
+
+@app.cli.command('pronosticar')
+def pronosticar_command():
+    """Recalcula el pronóstico de demanda y los puntos de reorden."""
+    limite_sentencias_largo()
+    inicio = time.perf_counter()
+    filas = calcular_pronostico()
+    reponer = PronosticoDemanda.query.filter(PronosticoDemanda.bodega_id.is_(None), PronosticoDemanda.reponer).count()
+    print(f">>> {filas} recomendaciones, {reponer} productos para reponer ({time.perf_counter() - inicio:.1f} s).")
+
+
+@app.cli.command('inventario-snapshot')
+def inventario_snapshot_command():
+    """Acumula los movimientos de inventario en saldo_snapshot (acelera las reconstrucciones)."""
+    hasta = tomar_snapshot_saldos()
+    print(f">>> Snapshot de saldos hasta el movimiento {hasta}.")
+
+
+@app.cli.command('reconstruir-saldos')
+@click.option('--verificar', is_flag=True, help='Solo compara saldo_bodega con el libro, sin escribir.')
+def reconstruir_saldos_command(verificar):
+    """Recalcula saldo_bodega y el stock de los productos desde el libro de movimientos."""
+    limite_sentencias_largo()
+    inicio = time.perf_counter()
+    if verificar:
+        diferencias = reconstruir_saldos(verificar=True)
+        for bodega_id, product_id, guardado, calculado in diferencias:
+            print(f"    bodega {bodega_id}, producto {product_id}: guardado {guardado}, libro {calculado}")
+        print(f">>> {len(diferencias)} diferencias ({time.perf_counter() - inicio:.1f} s).")
+    else:
+        filas = reconstruir_saldos()
+        print(f">>> saldo_bodega reconstruido: {filas} filas ({time.perf_counter() - inicio:.1f} s).")
+
+
 # =========================================================================
 # Ejecución de la aplicación
 # =========================================================================
 
 if __name__ == '__main__':
     with app.app_context():
-        # Crear la base de datos y el usuario admin (si no existe, usa tu script)
-        db.create_all()
+        # Crear/actualizar el esquema (el usuario admin se crea con create_db.py)
+        aplicar_migraciones()
     app.run(debug=True)
@@ -0,0 +1,659 @@
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Los benchmarks usan su propia base SQLite salvo que se indique DATABASE_URL
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'benchmark_control_productos.sqlite'))
+
+from sqlalchemy import event, insert
+
+from app import app, db, aplicar_migraciones, renderizar_qr_en_paralelo, reconstruir_consumo
+from app import bodega_por_defecto, registrar_movimiento
+from app import Escuela, Supervisor, SupervisorEscuela, Product, Solicitud, DetalleSolicitud, User
+from app import MovimientoStock, SaldoBodega
+
+# =========================================================================
+# Benchmarks de rendimiento (se ejecutan localmente, sin servidor)
+#   python benchmark.py qr --cantidad 2000 --procesos 1 2 4
+#   python benchmark.py pedidos-concurrentes --hilos 20 --envios 10
+#   python benchmark.py sesion --peticiones 2000
+#   python benchmark.py login --hilos 8 --intentos 5 --metodos pbkdf2:sha256:600000 scrypt:32768:8:1
+#   python benchmark.py sembrar --escuelas 300 --anios 2 --pedidos-por-dia 40
+#   python benchmark.py suite --peticiones 200 --guardar benchmark_base.json
+#   python benchmark.py suite --peticiones 200 --comparar benchmark_base.json
+#   python benchmark.py servidor --perfiles sync gthread gevent --clientes 50 --segundos 15
+# Con DATABASE_URL=postgresql://... la siembra y la suite corren contra Postgres.
+# =========================================================================
+
+def _preparar_escuela_de_prueba():
+    # Escuela nueva con supervisor asignado y un producto, para no mezclar con datos previos
+    aplicar_migraciones()
+    marca = time.time_ns()
+    escuela = Escuela(name=f'Escuela benchmark {marca}', qr_code_data=f'BENCH_ESCUELA:{marca}')
+    supervisor = Supervisor(name='Bench', apellido='Mark', email=f'bench{marca}@ejemplo.com',
+                            qr_code_data=f'BENCH_SUPERVISOR:{marca}')
+    producto = Product(name=f'Producto benchmark {marca}', code=f'BENCH-{marca}', stock=0)
+    db.session.add_all([escuela, supervisor, producto])
+    db.session.flush()
+    db.session.add(SupervisorEscuela(supervisor_id=supervisor.id, escuela_id=escuela.id))
+    # El stock entra por el libro de inventario, como en la aplicación
+    registrar_movimiento(bodega_por_defecto(), producto.id, 'recepcion', 1000, nota='Benchmark')
+    db.session.commit()
+    return escuela.id, producto.id
+
+def benchmark_qr(args):
+    payloads = [f"https://ejemplo.com/pedido/escuela/{i}" for i in range(args.cantidad)]
+    print(f">>> Generando {args.cantidad} códigos QR por número de procesos")
+    for procesos in args.procesos:
+        inicio = time.perf_counter()
+        total = sum(1 for _ in renderizar_qr_en_paralelo(payloads, procesos))
+        duracion = time.perf_counter() - inicio
+        print(f"    procesos={procesos:<3} {total / duracion:10.1f} códigos/s  ({duracion:.2f} s)")
+
+
+def benchmark_pedidos_concurrentes(args):
+    with app.app_context():
+        escuela_id, producto_id = _preparar_escuela_de_prueba()
+
+    url = f'/pedido/escuela/{escuela_id}'
+    aceptados = []
+    latencias = []
+    lock = threading.Lock()
+
+    def enviar():
+        cliente = app.test_client()
+        for _ in range(args.envios):
+            inicio = time.perf_counter()
+            respuesta = cliente.post(url, data={f'cantidad_{producto_id}': 1})
+            with lock:
+                latencias.append(time.perf_counter() - inicio)
+                if respuesta.status_code == 302:
+                    aceptados.append(respuesta.headers['Location'])
+
+    print(f">>> {args.hilos} hilos x {args.envios} envíos contra {url}")
+    inicio = time.perf_counter()
+    hilos = [threading.Thread(target=enviar) for _ in range(args.hilos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+
+    with app.app_context():
+        guardados = Solicitud.query.filter_by(escuela_id=escuela_id).count()
+        limite = app.config['PEDIDOS_POR_SEMANA']
+
+    latencias.sort()
+    print(f"    {len(latencias) / duracion:.1f} peticiones/s, p95 {latencias[int(len(latencias) * 0.95) - 1] * 1000:.1f} ms")
+    print(f"    aceptados={len(aceptados)} guardados={guardados} límite={limite}")
+    print("    OK: el límite se respetó" if guardados <= limite else "    ERROR: se superó el límite")
+
+
+def benchmark_sesion(args):
+    # Costo por petición autenticada (GET / solo carga el usuario y redirige)
+    with app.app_context():
+        aplicar_migraciones()
+        marca = time.time_ns()
+        user = User(username=f'bench{marca}', email=f'bench{marca}@ejemplo.com')
+        user.set_password('benchmark')
+        db.session.add(user)
+        db.session.commit()
+        username = user.username
+
+    consultas = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: consultas.append(1))
+
+    ttl_original = app.config['USUARIOS_CACHE_TTL']
+    print(f">>> {args.peticiones} peticiones autenticadas a /")
+    for nombre, ttl in (('sin caché', 0), ('con caché', ttl_original or 60)):
+        app.config['USUARIOS_CACHE_TTL'] = ttl
+        cliente = app.test_client()
+        cliente.post('/login', data={'username': username, 'password': 'benchmark'})
+        consultas.clear()
+        inicio = time.perf_counter()
+        for _ in range(args.peticiones):
+            cliente.get('/')
+        duracion = time.perf_counter() - inicio
+        print(f"    {nombre:<10} {duracion / args.peticiones * 1e6:8.1f} µs/petición, "
+              f"{len(consultas) / args.peticiones:.2f} consultas/petición")
+    app.config['USUARIOS_CACHE_TTL'] = ttl_original
+
+
+def benchmark_login(args):
+    # Inicios de sesión por segundo según método/costo del hash (POST /login completo)
+    with app.app_context():
+        aplicar_migraciones()
+
+    metodo_original = app.config['PASSWORD_HASH_METHOD']
+    print(f">>> {args.hilos} hilos x {args.intentos} inicios de sesión por método "
+          f"(LOGIN_CONCURRENCIA={app.config['LOGIN_CONCURRENCIA']})")
+    for metodo in args.metodos:
+        app.config['PASSWORD_HASH_METHOD'] = metodo
+        with app.app_context():
+            marca = time.time_ns()
+            user = User(username=f'bench{marca}', email=f'bench{marca}@ejemplo.com')
+            user.set_password('benchmark')
+            db.session.add(user)
+            db.session.commit()
+            username = user.username
+
+        latencias = []
+        rechazados = []
+        lock = threading.Lock()
+
+        def iniciar_sesiones():
+            cliente = app.test_client()
+            for _ in range(args.intentos):
+                inicio = time.perf_counter()
+                respuesta = cliente.post('/login', data={'username': username, 'password': 'benchmark'})
+                with lock:
+                    latencias.append(time.perf_counter() - inicio)
+                    if respuesta.status_code != 302:
+                        rechazados.append(respuesta.status_code)
+
+        inicio = time.perf_counter()
+        hilos = [threading.Thread(target=iniciar_sesiones) for _ in range(args.hilos)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        duracion = time.perf_counter() - inicio
+
+        latencias.sort()
+        print(f"    {metodo:<24} {len(latencias) / duracion:8.1f} logins/s, "
+              f"p95 {latencias[int(len(latencias) * 0.95) - 1] * 1000:8.1f} ms, rechazados={len(rechazados)}")
+    app.config['PASSWORD_HASH_METHOD'] = metodo_original
+
+
+# -------------------------------------------------------------------------
+# Suite de rendimiento de los flujos principales
+# -------------------------------------------------------------------------
+
+PREFIJO_SUITE = 'SUITE'
+USUARIO_SUITE = 'suite_benchmark'
+CLAVE_SUITE = 'suite_benchmark'
+
+def _insertar_por_lotes(modelo, filas, tamano=5000):
+    for inicio in range(0, len(filas), tamano):
+        db.session.execute(insert(modelo), filas[inicio:inicio + tamano])
+
+def sembrar(args):
+    """Datos sintéticos reproducibles (semilla fija) a la escala indicada. No borra datos existentes."""
+    rng = random.Random(args.semilla)
+    with app.app_context():
+        aplicar_migraciones()
+        if Product.query.filter(Product.code.like(f'{PREFIJO_SUITE}-%')).first() is not None:
+            print(">>> Los datos de la suite ya existen; no se vuelven a sembrar.")
+            return
+
+        inicio = time.perf_counter()
+        _insertar_por_lotes(Product, [
+            {'name': f'Producto {PREFIJO_SUITE} {i}', 'code': f'{PREFIJO_SUITE}-{i:05d}', 'stock': 10 ** 7}
+            for i in range(args.productos)
+        ])
+        _insertar_por_lotes(Escuela, [
+            {'name': f'Escuela {PREFIJO_SUITE} {i}', 'qr_code_data': f'{PREFIJO_SUITE}_ESCUELA:{i}'}
+            for i in range(args.escuelas)
+        ])
+        _insertar_por_lotes(Supervisor, [
+            {'name': f'Supervisor {i}', 'apellido': PREFIJO_SUITE, 'email': f'suite{i}@ejemplo.com',
+             'qr_code_data': f'{PREFIJO_SUITE}_SUPERVISOR:{i}'}
+            for i in range(args.supervisores)
+        ])
+        productos = [p for p, in db.session.query(Product.id).filter(Product.code.like(f'{PREFIJO_SUITE}-%'))]
+        # Stock inicial en el libro de inventario (las aprobaciones reservan desde saldo_bodega)
+        bodega_id = bodega_por_defecto()
+        _insertar_por_lotes(MovimientoStock, [
+            {'bodega_id': bodega_id, 'product_id': p, 'tipo': 'recepcion', 'existencia': 10 ** 7, 'reservado': 0,
+             'nota': 'Siembra', 'creado_en': datetime.utcnow()}
+            for p in productos
+        ])
+        _insertar_por_lotes(SaldoBodega, [
+            {'bodega_id': bodega_id, 'product_id': p, 'existencia': 10 ** 7, 'reservado': 0} for p in productos
+        ])
+        escuelas = [e for e, in db.session.query(Escuela.id).filter(Escuela.name.like(f'Escuela {PREFIJO_SUITE} %'))]
+        supervisores = [s for s, in db.session.query(Supervisor.id).filter(Supervisor.apellido == PREFIJO_SUITE)]
+
+        supervisor_de = {escuela_id: supervisores[i % len(supervisores)] for i, escuela_id in enumerate(escuelas)}
+        _insertar_por_lotes(SupervisorEscuela, [
+            {'supervisor_id': supervisor_id, 'escuela_id': escuela_id} for escuela_id, supervisor_id in supervisor_de.items()
+        ])
+
+        if User.query.filter_by(username=USUARIO_SUITE).first() is None:
+            user = User(username=USUARIO_SUITE, email=f'{USUARIO_SUITE}@ejemplo.com', is_admin=True)
+            user.set_password(CLAVE_SUITE)
+            db.session.add(user)
+
+        # Historial: pedidos repartidos en los últimos años; los más viejos ya aprobados
+        desde = datetime.utcnow() - timedelta(days=365 * args.anios)
+        total_pedidos = 365 * args.anios * args.pedidos_por_dia
+        siguiente_id = (db.session.query(db.func.max(Solicitud.id)).scalar() or 0) + 1
+        for bloque in range(0, total_pedidos, 10000):
+            solicitudes, detalles = [], []
+            for numero in range(bloque, min(bloque + 10000, total_pedidos)):
+                escuela_id = rng.choice(escuelas)
+                fecha = desde + timedelta(seconds=numero * 86400 / args.pedidos_por_dia)
+                aprobada = rng.random() < 0.8 and fecha < datetime.utcnow() - timedelta(days=7)
+                solicitudes.append({
+                    'id': siguiente_id, 'supervisor_id': supervisor_de[escuela_id], 'escuela_id': escuela_id,
+                    'fecha_solicitud': fecha, 'estado': 'Aprobada' if aprobada else 'Pendiente',
+                    'fecha_aprobacion': fecha + timedelta(days=1) if aprobada else None,
+                })
+                for product_id in rng.sample(productos, min(len(productos), rng.randint(1, 4))):
+                    detalles.append({'solicitud_id': siguiente_id, 'product_id': product_id,
+                                     'cantidad_solicitada': rng.randint(1, 3)})
+                siguiente_id += 1
+            _insertar_por_lotes(Solicitud, solicitudes)
+            _insertar_por_lotes(DetalleSolicitud, detalles)
+            db.session.commit()
+        db.session.commit()
+        reconstruir_consumo()
+        print(f">>> Sembrado: {args.productos} productos, {args.escuelas} escuelas, {args.supervisores} supervisores, "
+              f"{total_pedidos} pedidos ({time.perf_counter() - inicio:.1f} s)")
+
+def _percentil(valores, p):
+    # Rango más cercano sobre la lista ordenada
+    return valores[max(0, min(len(valores) - 1, int(round(p / 100 * len(valores))) - 1))]
+
+def _cliente_autenticado():
+    cliente = app.test_client()
+    cliente.post('/login', data={'username': USUARIO_SUITE, 'password': CLAVE_SUITE})
+    return cliente
+
+def _flujos(datos, semilla):
+    """Cada flujo es (nombre, necesita_sesión, función(cliente) -> respuesta)."""
+    # Un generador por flujo: las mismas elecciones aunque se corra un subconjunto de flujos
+    generadores = {}
+    def aleatorio(nombre):
+        return generadores.setdefault(nombre, random.Random(f'{semilla}-{nombre}'))
+
+    def pedido_publico(cliente):
+        rng = aleatorio('pedido_publico')
+        escuela_id = rng.choice(datos['escuelas'])
+        lineas = {f'cantidad_{p}': rng.randint(1, 3) for p in rng.sample(datos['productos'], 3)}
+        return cliente.post(f'/pedido/escuela/{escuela_id}', data=lineas)
+
+    def lista_pedidos(cliente):
+        rng = aleatorio('lista_pedidos')
+        filtro = rng.choice([{}, {'estado': 'Pendiente'}, {'escuela_id': rng.choice(datos['escuelas'])}])
+        return cliente.get('/pedidos', query_string=filtro)
+
+    def detalle_pedido(cliente):
+        rng = aleatorio('detalle_pedido')
+        return cliente.get(f"/pedidos/{rng.choice(datos['solicitudes'])}")
+
+    def aprobar(cliente):
+        rng = aleatorio('aprobar')
+        with datos['lock']:
+            solicitud_id = datos['pendientes'].pop() if datos['pendientes'] else rng.choice(datos['solicitudes'])
+        return cliente.post(f'/pedidos/aprobar/{solicitud_id}')
+
+    def qr_producto(cliente):
+        rng = aleatorio('qr_producto')
+        return cliente.get(f"/product/qr/{rng.choice(datos['codigos'])}.png")
+
+    def login(cliente):
+        return app.test_client().post('/login', data={'username': USUARIO_SUITE, 'password': CLAVE_SUITE})
+
+    def reporte_mensual(cliente):
+        return cliente.get('/reportes/mensual')
+
+    return [
+        ('pedido_publico', False, pedido_publico),
+        ('lista_pedidos', True, lista_pedidos),
+        ('detalle_pedido', True, detalle_pedido),
+        ('aprobar', True, aprobar),
+        ('qr_producto', True, qr_producto),
+        ('reporte_mensual', True, reporte_mensual),
+        ('login', False, login),
+    ]
+
+def _ejecutar_flujo(funcion, necesita_sesion, peticiones, hilos, calentamiento):
+    latencias, consultas, errores = [], [], []
+    lock = threading.Lock()
+
+    def trabajar(cantidad):
+        cliente = _cliente_autenticado() if necesita_sesion else app.test_client()
+        for _ in range(calentamiento):
+            funcion(cliente)
+        for _ in range(cantidad):
+            inicio = time.perf_counter()
+            respuesta = funcion(cliente)
+            duracion = time.perf_counter() - inicio
+            # Consultas informadas por la instrumentación en Server-Timing
+            coincidencia = re.search(r'desc="(\d+) consultas"', respuesta.headers.get('Server-Timing', ''))
+            with lock:
+                latencias.append(duracion)
+                consultas.append(int(coincidencia.group(1)) if coincidencia else 0)
+                if respuesta.status_code >= 400:
+                    errores.append(respuesta.status_code)
+
+    inicio = time.perf_counter()
+    repartidas = [peticiones // hilos + (1 if i < peticiones % hilos else 0) for i in range(hilos)]
+    trabajadores = [threading.Thread(target=trabajar, args=(cantidad,)) for cantidad in repartidas]
+    for trabajador in trabajadores:
+        trabajador.start()
+    for trabajador in trabajadores:
+        trabajador.join()
+    duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'peticiones': len(latencias),
+        'por_segundo': round(len(latencias) / duracion, 1),
+        'p50_ms': round(_percentil(latencias, 50) * 1000, 2),
+        'p95_ms': round(_percentil(latencias, 95) * 1000, 2),
+        'p99_ms': round(_percentil(latencias, 99) * 1000, 2),
+        'consultas': round(sum(consultas) / len(consultas), 2),
+        'errores': len(errores),
+    }
+
+def _comparar_con_base(resultados, base, tolerancia):
+    # Regresión: p95 peor que la base más la tolerancia (con 2 ms de margen) o más consultas
+    regresiones = []
+    for nombre, actual in resultados.items():
+        anterior = base['flujos'].get(nombre)
+        if anterior is None:
+            continue
+        if actual['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia) + 2:
+            regresiones.append(f"{nombre}: p95 {anterior['p95_ms']} -> {actual['p95_ms']} ms")
+        if actual['consultas'] > anterior['consultas'] + 0.5:
+            regresiones.append(f"{nombre}: consultas {anterior['consultas']} -> {actual['consultas']}")
+        if actual['errores'] > anterior['errores']:
+            regresiones.append(f"{nombre}: errores {anterior['errores']} -> {actual['errores']}")
+    return regresiones
+
+def suite(args):
+    sembrar(args)
+    with app.app_context():
+        datos = {
+            'escuelas': [e for e, in db.session.query(Escuela.id).filter(Escuela.name.like(f'Escuela {PREFIJO_SUITE} %'))],
+            'productos': [p for p, in db.session.query(Product.id).filter(Product.code.like(f'{PREFIJO_SUITE}-%'))],
+            'codigos': [c for c, in db.session.query(Product.code).filter(Product.code.like(f'{PREFIJO_SUITE}-%'))],
+            'solicitudes': [s for s, in db.session.query(Solicitud.id).order_by(Solicitud.id.desc()).limit(5000)],
+            'pendientes': [s for s, in db.session.query(Solicitud.id).filter_by(estado='Pendiente')
+                           .order_by(Solicitud.id).limit(args.peticiones * 2)],
+            'lock': threading.Lock(),
+        }
+        dialecto = db.engine.dialect.name
+
+    # La suite mide el costo de los flujos, no el límite de pedidos por escuela
+    app.config['PEDIDOS_POR_SEMANA'] = 10 ** 9
+    app.config['CONSULTAS_POR_PETICION_MAX'] = 0
+
+    print(f">>> Suite contra {dialecto}: {args.peticiones} peticiones por flujo, {args.hilos} hilo(s)")
+    print(f"    {'flujo':<16}{'pet/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'consultas':>11}{'errores':>9}")
+    resultados = {}
+    for nombre, necesita_sesion, funcion in _flujos(datos, args.semilla):
+        if args.flujos and nombre not in args.flujos:
+            continue
+        # login hace el hash completo: se limita para no dominar la duración de la suite
+        peticiones = min(args.peticiones, 20) if nombre == 'login' else args.peticiones
+        r = _ejecutar_flujo(funcion, necesita_sesion, peticiones, args.hilos,
+                            0 if nombre == 'login' else args.calentamiento)
+        resultados[nombre] = r
+        print(f"    {nombre:<16}{r['por_segundo']:>8}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+              f"{r['consultas']:>11}{r['errores']:>9}")
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as archivo:
+            json.dump({'dialecto': dialecto, 'hilos': args.hilos, 'flujos': resultados}, archivo, indent=2)
+        print(f">>> Línea base guardada en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as archivo:
+            base = json.load(archivo)
+        regresiones = _comparar_con_base(resultados, base, args.tolerancia)
+        if regresiones:
+            print(">>> REGRESIONES respecto de la línea base:")
+            for regresion in regresiones:
+                print(f"    {regresion}")
+            sys.exit(1)
+        print(">>> Sin regresiones respecto de la línea base.")
+
+
+# -------------------------------------------------------------------------
+# Perfiles de gunicorn (servidor real, endpoints públicos)
+# -------------------------------------------------------------------------
+# Levanta gunicorn con cada perfil de gunicorn.conf.py en un puerto libre y lo
+# carga con clientes HTTP concurrentes (conexiones keep-alive, como el proxy).
+# El generador de carga corre en este proceso: en máquinas chicas conviene
+# usar pocos workers (WEB_CONCURRENCY) para que el cliente no sea el cuello.
+
+# Módulo que necesita cada perfil además de gunicorn
+MODULOS_PERFIL = {'sync': None, 'gthread': None, 'gevent': 'gevent'}
+
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _esperar_servidor(puerto, proceso, limite=60):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        if proceso.poll() is not None:
+            return False
+        try:
+            conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=2)
+            conexion.request('GET', '/salud')
+            if conexion.getresponse().status == 200:
+                conexion.close()
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def _peticiones_publicas(escuela_id, producto_id):
+    """(nombre, función(conexión, rng) -> estado) de los endpoints públicos que usan las escuelas."""
+    etag = {}
+
+    def pedir(conexion, metodo, ruta, cuerpo=None, encabezados=None):
+        conexion.request(metodo, ruta, body=cuerpo, headers=encabezados or {})
+        respuesta = conexion.getresponse()
+        respuesta.read()
+        return respuesta
+
+    def catalogo(conexion, rng):
+        # La mitad de los clientes ya tiene el catálogo y revalida con If-None-Match
+        encabezados = {'Accept-Encoding': 'gzip'}
+        if etag.get('catalogo') and rng.random() < 0.5:
+            encabezados['If-None-Match'] = etag['catalogo']
+        respuesta = pedir(conexion, 'GET', '/api/v1/catalogo', encabezados=encabezados)
+        etag['catalogo'] = respuesta.getheader('ETag') or etag.get('catalogo')
+        return respuesta.status
+
+    def formulario(conexion, rng):
+        return pedir(conexion, 'GET', f'/pedido/escuela/{escuela_id}').status
+
+    def pedido_api(conexion, rng):
+        cuerpo = json.dumps({'lineas': [{'product_id': producto_id, 'cantidad': rng.randint(1, 3)}]})
+        return pedir(conexion, 'POST', f'/api/v1/escuelas/{escuela_id}/pedidos', cuerpo,
+                     {'Content-Type': 'application/json', 'Idempotency-Key': uuid.uuid4().hex}).status
+
+    def pedido_formulario(conexion, rng):
+        cuerpo = f'cantidad_{producto_id}={rng.randint(1, 3)}'
+        return pedir(conexion, 'POST', f'/pedido/escuela/{escuela_id}', cuerpo,
+                     {'Content-Type': 'application/x-www-form-urlencoded'}).status
+
+    # Mezcla aproximada de una mañana de escaneos: más lecturas que envíos
+    return [('catalogo', 4, catalogo), ('formulario', 3, formulario),
+            ('pedido_api', 2, pedido_api), ('pedido_formulario', 1, pedido_formulario)]
+
+def _cargar_servidor(puerto, peticiones, clientes, segundos, calentamiento, semilla):
+    nombres = [nombre for nombre, peso, _ in peticiones for _ in range(peso)]
+    funciones = {nombre: funcion for nombre, _, funcion in peticiones}
+    latencias = {nombre: [] for nombre in funciones}
+    errores = {nombre: 0 for nombre in funciones}
+    lock = threading.Lock()
+    inicio_medicion = time.monotonic() + calentamiento
+    fin = inicio_medicion + segundos
+
+    def cliente(numero):
+        rng = random.Random(f'{semilla}-{numero}')
+        conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=30)
+        while time.monotonic() < fin:
+            nombre = rng.choice(nombres)
+            inicio = time.monotonic()
+            try:
+                estado = funciones[nombre](conexion, rng)
+            except (OSError, http.client.HTTPException):
+                conexion.close()
+                conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=30)
+                estado = 599
+            if inicio < inicio_medicion:
+                continue
+            with lock:
+                latencias[nombre].append(time.monotonic() - inicio)
+                if estado >= 400:
+                    errores[nombre] += 1
+        conexion.close()
+
+    hilos = [threading.Thread(target=cliente, args=(i,)) for i in range(clientes)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    resultados = {}
+    for nombre, valores in latencias.items():
+        if not valores:
+            continue
+        valores.sort()
+        resultados[nombre] = {
+            'peticiones': len(valores),
+            'por_segundo': round(len(valores) / segundos, 1),
+            'p50_ms': round(_percentil(valores, 50) * 1000, 1),
+            'p95_ms': round(_percentil(valores, 95) * 1000, 1),
+            'p99_ms': round(_percentil(valores, 99) * 1000, 1),
+            'errores': errores[nombre],
+        }
+    return resultados
+
+def benchmark_servidor(args):
+    with app.app_context():
+        escuela_id, producto_id = _preparar_escuela_de_prueba()
+    peticiones = _peticiones_publicas(escuela_id, producto_id)
+    directorio = os.path.dirname(os.path.abspath(__file__))
+
+    print(f">>> {args.clientes} clientes concurrentes, {args.segundos} s por perfil (+{args.calentamiento} s de calentamiento)")
+    print(f"    {'perfil':<10}{'endpoint':<20}{'pet/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    todos = {}
+    for perfil in args.perfiles:
+        modulo = MODULOS_PERFIL.get(perfil)
+        if modulo and importlib.util.find_spec(modulo) is None:
+            print(f"    {perfil:<10}omitido: falta el módulo {modulo} (pip install -r requirements-gevent.txt)")
+            continue
+        puerto = _puerto_libre()
+        entorno = dict(os.environ, PORT=str(puerto), GUNICORN_PERFIL=perfil,
+                       DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'],
+                       # Se mide el servidor, no el límite semanal de pedidos por escuela
+                       PEDIDOS_POR_SEMANA=str(10 ** 9), CONSULTAS_POR_PETICION_MAX='0')
+        if args.workers:
+            entorno['WEB_CONCURRENCY'] = str(args.workers)
+        proceso = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                   cwd=directorio, env=entorno,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _esperar_servidor(puerto, proceso):
+                print(f"    {perfil:<10}omitido: gunicorn no arrancó")
+                continue
+            resultados = _cargar_servidor(puerto, peticiones, args.clientes, args.segundos,
+                                          args.calentamiento, args.semilla)
+        finally:
+            proceso.send_signal(signal.SIGTERM)
+            try:
+                proceso.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proceso.kill()
+        todos[perfil] = resultados
+        total = sum(r['peticiones'] for r in resultados.values())
+        for nombre, r in resultados.items():
+            print(f"    {perfil:<10}{nombre:<20}{r['por_segundo']:>8}{r['p50_ms']:>9}{r['p95_ms']:>9}"
+                  f"{r['p99_ms']:>9}{r['errores']:>9}")
+        print(f"    {perfil:<10}{'total':<20}{round(total / args.segundos, 1):>8}")
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as archivo:
+            json.dump({'clientes': args.clientes, 'segundos': args.segundos, 'perfiles': todos}, archivo, indent=2)
+        print(f">>> Resultados guardados en {args.guardar}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks de Control de Productos Escolares')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    qr = subparsers.add_parser('qr', help='Generación masiva de códigos QR')
+    qr.add_argument('--cantidad', type=int, default=1000)
+    qr.add_argument('--procesos', type=int, nargs='+', default=[1, 2, 4])
+    qr.set_defaults(funcion=benchmark_qr)
+
+    pedidos = subparsers.add_parser('pedidos-concurrentes', help='Envíos simultáneos desde el QR de una escuela')
+    pedidos.add_argument('--hilos', type=int, default=20)
+    pedidos.add_argument('--envios', type=int, default=10)
+    pedidos.set_defaults(funcion=benchmark_pedidos_concurrentes)
+
+    sesion = subparsers.add_parser('sesion', help='Carga del usuario en peticiones autenticadas')
+    sesion.add_argument('--peticiones', type=int, default=2000)
+    sesion.set_defaults(funcion=benchmark_sesion)
+
+    login = subparsers.add_parser('login', help='Inicios de sesión por segundo según el costo del hash')
+    login.add_argument('--hilos', type=int, default=8)
+    login.add_argument('--intentos', type=int, default=5)
+    login.add_argument('--metodos', nargs='+',
+                       default=['pbkdf2:sha256:600000', 'pbkdf2:sha256:260000', 'scrypt:32768:8:1'])
+    login.set_defaults(funcion=benchmark_login)
+
+    def opciones_siembra(subparser):
+        subparser.add_argument('--escuelas', type=int, default=200)
+        subparser.add_argument('--supervisores', type=int, default=20)
+        subparser.add_argument('--productos', type=int, default=100)
+        subparser.add_argument('--anios', type=int, default=1)
+        subparser.add_argument('--pedidos-por-dia', type=int, default=20)
+        subparser.add_argument('--semilla', type=int, default=42)
+
+    siembra = subparsers.add_parser('sembrar', help='Datos sintéticos para la suite de rendimiento')
+    opciones_siembra(siembra)
+    siembra.set_defaults(funcion=sembrar)
+
+    flujos = subparsers.add_parser('suite', help='Latencia, throughput y consultas de los flujos principales')
+    opciones_siembra(flujos)
+    flujos.add_argument('--peticiones', type=int, default=100)
+    flujos.add_argument('--hilos', type=int, default=1)
+    flujos.add_argument('--calentamiento', type=int, default=5, help='Peticiones no medidas por hilo antes de cada flujo')
+    flujos.add_argument('--flujos', nargs='+', help='Solo estos flujos (por defecto todos)')
+    flujos.add_argument('--guardar', help='Guardar los resultados como línea base (JSON)')
+    flujos.add_argument('--comparar', help='Comparar con una línea base (JSON); sale con código 1 si hay regresiones')
+    flujos.add_argument('--tolerancia', type=float, default=0.25, help='Aumento tolerado del p95 (0.25 = 25%%)')
+    flujos.set_defaults(funcion=suite)
+
+    servidor = subparsers.add_parser('servidor', help='Perfiles de gunicorn con carga concurrente en los endpoints públicos')
+    servidor.add_argument('--perfiles', nargs='+', default=['sync', 'gthread', 'gevent'], choices=sorted(MODULOS_PERFIL))
+    servidor.add_argument('--clientes', type=int, default=50, help='Conexiones concurrentes')
+    servidor.add_argument('--segundos', type=float, default=15)
+    servidor.add_argument('--calentamiento', type=float, default=3)
+    servidor.add_argument('--workers', type=int, help='Workers por perfil (por defecto los de gunicorn.conf.py)')
+    servidor.add_argument('--semilla', type=int, default=42)
+    servidor.add_argument('--guardar', help='Guardar los resultados (JSON)')
+    servidor.set_defaults(funcion=benchmark_servidor)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == '__main__':
+    main()
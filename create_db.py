@@ -1,13 +1,12 @@
 import os
-from app import app, db
-from werkzeug.security import generate_password_hash
+from app import app, db, aplicar_migraciones
 
-# Importamos TODOS los modelos definidos en app.py para que db.create_all() los vea
-from app import User, Product, Bodega, Supervisor, Escuela 
+from app import User
 
 with app.app_context():
-    # 1. Crear todas las tablas: Users, Products, Bodegas, Supervisors, Escuelas
-    db.create_all()
+    # 1. Crear/actualizar todas las tablas e índices con las migraciones versionadas
+    for version, descripcion in aplicar_migraciones():
+        print(f">>> Migración {version} aplicada: {descripcion}")
     print(">>> Base de datos y TODAS las tablas creadas/verificadas exitosamente.")
 
     # 2. Verificar y crear el usuario admin
@@ -15,14 +14,13 @@ with app.app_context():
     
     if not admin_user:
         print(">>> Creando usuario administrador...")
-        hashed_pw = generate_password_hash('admin123', method='pbkdf2:sha256')
-        
         new_admin = User(
             username='admin',
             email='admin@escuela.com',
-            password_hash=hashed_pw,
             is_admin=True
         )
+        # Usa el método/costo de PASSWORD_HASH_METHOD
+        new_admin.set_password('admin123')
         
         db.session.add(new_admin)
         db.session.commit()
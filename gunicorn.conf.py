@@ -0,0 +1,86 @@
+# =========================================================================
+# Configuración de gunicorn (gunicorn -c gunicorn.conf.py app:app)
+# =========================================================================
+# Perfiles (variable GUNICORN_PERFIL):
+#   gthread (por defecto): pocos procesos con varios hilos cada uno. Mientras un
+#       hilo espera a la base de datos, otro atiende el siguiente pedido.
+#   sync: un proceso por petición en curso (el modo anterior).
+#   gevent: miles de conexiones por proceso con greenlets. Requiere
+#       `pip install -r requirements-gevent.txt`. psycopg2 se vuelve
+#       cooperativo con psycogreen. El trabajo de CPU (hash de contraseñas,
+#       render de QR) bloquea el proceso entero, por eso no es el predeterminado.
+# WEB_CONCURRENCY, GUNICORN_HILOS y GUNICORN_CONEXIONES ajustan los valores
+# calculados a partir de los CPU disponibles. Para comparar perfiles en la
+# misma máquina: python benchmark.py servidor --perfiles sync gthread gevent
+
+import os
+
+perfil = os.environ.get('GUNICORN_PERFIL', 'gthread')
+
+if perfil == 'gevent':
+    # Antes de importar la aplicación (preload_app): sockets, hilos y sleep cooperativos
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        # psycopg 3 coopera con gevent sin parches; psycopg2 sin psycogreen bloquearía el worker
+        pass
+    # Muchas peticiones simultáneas por proceso comparten el pool: se esperan en la cola
+    # del pool (DB_POOL_TIMEOUT) en lugar de abrir una conexión por greenlet
+    os.environ.setdefault('DB_POOL_SIZE', '10')
+    os.environ.setdefault('DB_MAX_OVERFLOW', '10')
+
+try:
+    cpus = len(os.sched_getaffinity(0)) # respeta los límites de CPU del contenedor
+except AttributeError:
+    cpus = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+if perfil == 'sync':
+    worker_class = 'sync'
+    workers = int(os.environ.get('WEB_CONCURRENCY', 2 * cpus + 1))
+elif perfil == 'gevent':
+    worker_class = 'gevent'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cpus + 1))
+    worker_connections = int(os.environ.get('GUNICORN_CONEXIONES', 200))
+elif perfil == 'gthread':
+    worker_class = 'gthread'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cpus + 1))
+    # Con DB_POOL_SIZE + DB_MAX_OVERFLOW >= hilos ningún hilo espera por una conexión
+    threads = int(os.environ.get('GUNICORN_HILOS', 4))
+else:
+    raise RuntimeError(f"GUNICORN_PERFIL desconocido: {perfil} (sync, gthread o gevent)")
+
+# Conexiones persistentes: el proxy de Render y los teléfonos reutilizan la conexión TCP/TLS
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+
+# La aplicación se importa una sola vez en el proceso maestro y los workers la heredan
+# (arranque más rápido y memoria compartida). Ver post_fork para las conexiones.
+preload_app = True
+
+# Reciclar workers de a poco limita el crecimiento de memoria (cachés de QR y catálogo)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+# Latido de los workers en memoria: un disco lento no los hace parecer colgados
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESSLOG') # '-' = salida estándar
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Con preload_app el pool de la base se creó en el maestro: cada worker abre sus propias conexiones
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def when_ready(server):
+    server.log.info("Perfil %s: %s workers (%s), %d CPU", perfil, workers, worker_class, cpus)
@@ -0,0 +1,114 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from flask import g
+
+# app.py lee DATABASE_URL al importarse: la base de pruebas se fija antes
+_DIRECTORIO = tempfile.mkdtemp(prefix='control_productos_pruebas_')
+_BASE = os.path.join(_DIRECTORIO, 'pruebas.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_BASE}'
+os.environ.setdefault('QR_CACHE_DIR', os.path.join(_DIRECTORIO, 'qr_cache'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as aplicacion  # noqa: E402
+
+
+def _reiniciar_base():
+    # Archivo nuevo en cada prueba: las migraciones crean el esquema desde cero
+    aplicacion.db.session.remove()
+    aplicacion.db.engine.dispose()
+    if os.path.exists(_BASE):
+        os.remove(_BASE)
+    aplicacion.olvidar_tablas_fts()
+    aplicacion._usuarios_cache.clear()
+    aplicacion._catalogo_cache = (None, None)
+    aplicacion._catalogo_api_cache = (None, None)
+
+
+@pytest.fixture
+def base_vacia():
+    flask_app = aplicacion.app
+    flask_app.config['TESTING'] = True
+    # Turnos de login y demás archivos de instance/ fuera del repositorio
+    flask_app.instance_path = _DIRECTORIO
+    with flask_app.app_context():
+        _reiniciar_base()
+        yield flask_app
+        aplicacion.db.session.remove()
+
+
+@pytest.fixture
+def app(base_vacia):
+    aplicacion.aplicar_migraciones()
+    return base_vacia
+
+
+@pytest.fixture
+def admin(app):
+    usuario = aplicacion.User(username='admin', email='admin@example.com', is_admin=True)
+    usuario.set_password('clave')
+    aplicacion.db.session.add(usuario)
+    aplicacion.db.session.commit()
+    return usuario
+
+
+@pytest.fixture
+def nuevo_cliente(app, admin):
+    # Las peticiones del hilo principal comparten el contexto de la app de la prueba:
+    # Flask-Login guarda el usuario en g y hay que limpiarlo entre clientes
+    def crear():
+        cliente = app.test_client()
+        g.pop('_login_user', None)
+        respuesta = cliente.post('/login', data={'username': 'admin', 'password': 'clave'})
+        g.pop('_login_user', None)
+        assert respuesta.status_code == 302 and respuesta.location.endswith('/dashboard')
+        return cliente
+    return crear
+
+
+@pytest.fixture
+def cliente(nuevo_cliente):
+    return nuevo_cliente()
+
+
+@pytest.fixture
+def crear_producto(app):
+    # Producto con su stock registrado en el libro de la bodega principal
+    def crear(nombre='Cuaderno', code=None, stock=0):
+        producto = aplicacion.Product(name=nombre, code=code or nombre.upper(), stock=0)
+        aplicacion.db.session.add(producto)
+        aplicacion.db.session.flush()
+        if stock:
+            aplicacion.registrar_movimiento(aplicacion.bodega_por_defecto(), producto.id, 'recepcion', stock)
+        aplicacion.db.session.commit()
+        return producto
+    return crear
+
+
+@pytest.fixture
+def crear_solicitud(app):
+    # Supervisor y escuela nuevos por cada solicitud, salvo que se indiquen
+    contador = iter(range(1, 10**6))
+
+    def crear(productos, supervisor=None, escuela=None):
+        numero = next(contador)
+        if supervisor is None:
+            supervisor = aplicacion.Supervisor(name=f'Supervisor {numero}', apellido='Prueba',
+                                               email=f'supervisor{numero}@example.com')
+            aplicacion.db.session.add(supervisor)
+        if escuela is None:
+            escuela = aplicacion.Escuela(name=f'Escuela {numero}')
+            aplicacion.db.session.add(escuela)
+        aplicacion.db.session.flush()
+        solicitud = aplicacion.Solicitud(supervisor_id=supervisor.id, escuela_id=escuela.id)
+        aplicacion.db.session.add(solicitud)
+        aplicacion.db.session.flush()
+        for producto, cantidad in productos:
+            aplicacion.db.session.add(aplicacion.DetalleSolicitud(
+                solicitud_id=solicitud.id, product_id=producto.id, cantidad_solicitada=cantidad))
+        aplicacion.db.session.commit()
+        return solicitud
+    return crear
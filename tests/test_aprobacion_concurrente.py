@@ -0,0 +1,60 @@
+import threading
+
+from sqlalchemy import func
+
+from app import db, Product, SaldoBodega, Solicitud, MovimientoStock, ConsumoDiario
+
+STOCK = 3
+APROBACIONES = 8
+
+
+def test_aprobaciones_concurrentes_no_sobrevenden(app, nuevo_cliente, crear_producto, crear_solicitud):
+    producto = crear_producto('Borrador', stock=STOCK)
+    solicitud_ids = [crear_solicitud([(producto, 1)]).id for _ in range(APROBACIONES)]
+
+    # Un cliente con sesión propia por hilo; todos aprueban a la vez
+    clientes = [nuevo_cliente() for _ in solicitud_ids]
+    salida = threading.Barrier(len(solicitud_ids))
+    respuestas, errores = [], []
+
+    def aprobar(cliente, solicitud_id):
+        try:
+            salida.wait()
+            respuestas.append(cliente.post(f'/pedidos/aprobar/{solicitud_id}').status_code)
+        except Exception as e:  # se revisa en el hilo principal
+            errores.append(e)
+
+    hilos = [threading.Thread(target=aprobar, args=par) for par in zip(clientes, solicitud_ids)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert errores == []
+    assert respuestas == [302] * APROBACIONES
+
+    db.session.expire_all()
+    saldo = db.session.get(SaldoBodega, (1, producto.id))
+    assert Solicitud.query.filter_by(estado='Aprobada').count() == STOCK
+    assert Solicitud.query.filter_by(estado='Pendiente').count() == APROBACIONES - STOCK
+    assert saldo.existencia == STOCK and saldo.reservado == STOCK
+    assert db.session.get(Product, producto.id).stock == 0
+    assert MovimientoStock.query.filter_by(tipo='reserva').count() == STOCK
+
+
+def test_lote_rechaza_solo_las_solicitudes_sin_stock(app, cliente, crear_producto, crear_solicitud):
+    producto = crear_producto('Regla', stock=3)
+    primera, segunda, tercera = (crear_solicitud([(producto, n)]).id for n in (2, 2, 1))
+
+    respuesta = cliente.post('/pedidos/aprobar-lote', json={'solicitud_ids': [primera, segunda, tercera]})
+
+    assert respuesta.status_code == 200
+    assert respuesta.get_json() == {'aprobadas': 2, 'resultados': [
+        {'solicitud_id': primera, 'resultado': 'Aprobada'},
+        {'solicitud_id': segunda, 'resultado': 'Stock insuficiente'},
+        {'solicitud_id': tercera, 'resultado': 'Aprobada'},
+    ]}
+    db.session.expire_all()
+    assert db.session.get(Solicitud, segunda).estado == 'Pendiente'
+    assert {m.solicitud_id for m in MovimientoStock.query.filter_by(tipo='reserva')} == {primera, tercera}
+    assert db.session.get(SaldoBodega, (1, producto.id)).reservado == 3
+    assert db.session.query(func.sum(ConsumoDiario.unidades_aprobadas)).scalar() == 3
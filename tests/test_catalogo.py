@@ -0,0 +1,39 @@
+from app import db, CatalogoVersion, Product
+
+
+def _version():
+    db.session.expire_all()
+    return db.session.get(CatalogoVersion, 1).version
+
+
+def test_confirmar_cambios_de_productos_incrementa_la_version(app, crear_producto):
+    producto = crear_producto('Cuaderno', stock=5)
+    inicial = _version()
+    assert db.session.get(Product, producto.id).version_catalogo == inicial
+
+    # Edición por ORM, sin llamar a invalidar_catalogo()
+    db.session.get(Product, producto.id).name = 'Cuaderno universitario'
+    db.session.commit()
+    assert _version() == inicial + 1
+    assert db.session.get(Product, producto.id).version_catalogo == inicial + 1
+
+    # Transacciones sin cambios en product no la tocan
+    db.session.get(Product, producto.id)
+    db.session.commit()
+    assert _version() == inicial + 1
+
+
+def test_un_savepoint_revertido_no_pierde_los_cambios_anteriores(app, crear_producto):
+    primero, segundo = crear_producto('Regla'), crear_producto('Tiza')
+    inicial = _version()
+
+    db.session.get(Product, primero.id).name = 'Regla 30 cm'
+    db.session.flush()
+    with db.session.begin_nested() as punto:
+        db.session.get(Product, segundo.id).name = 'Tiza blanca'
+        db.session.flush()
+        punto.rollback()
+    db.session.commit()
+
+    assert _version() == inicial + 1
+    assert db.session.get(Product, primero.id).version_catalogo == inicial + 1
@@ -0,0 +1,45 @@
+import re
+
+import pytest
+
+from app import db, Escuela, Supervisor, SupervisorEscuela
+
+
+def _consultas(cliente, url):
+    # Cantidad informada por la instrumentación (before/after_cursor_execute) en Server-Timing.
+    # La primera petición calienta las cachés del proceso (usuario de la sesión); la sesión
+    # de SQLAlchemy se descarta para no aprovechar objetos ya cargados
+    cliente.get(url)
+    db.session.remove()
+    respuesta = cliente.get(url)
+    assert respuesta.status_code == 200
+    return int(re.search(r'desc="(\d+) consultas"', respuesta.headers['Server-Timing']).group(1))
+
+
+def _asignar(cantidad, inicio):
+    for numero in range(inicio, inicio + cantidad):
+        supervisor = Supervisor(name=f'Supervisor {numero}', apellido='Prueba', email=f's{numero}@example.com')
+        escuela = Escuela(name=f'Escuela {numero}')
+        db.session.add_all([supervisor, escuela])
+        db.session.flush()
+        db.session.add(SupervisorEscuela(supervisor_id=supervisor.id, escuela_id=escuela.id))
+    db.session.commit()
+
+
+def test_asignaciones_consultas_constantes(cliente):
+    _asignar(2, 0)
+    pocas = _consultas(cliente, '/asignaciones')
+    _asignar(20, 2)
+    assert _consultas(cliente, '/asignaciones') == pocas
+
+
+@pytest.mark.parametrize('aprobar', [False, True])
+def test_detalle_pedido_consultas_constantes(cliente, crear_producto, crear_solicitud, aprobar):
+    def consultas_con(cantidad_productos, numero):
+        productos = [crear_producto(f'Producto {numero}-{i}', stock=100) for i in range(cantidad_productos)]
+        solicitud_id = crear_solicitud([(producto, 1) for producto in productos]).id
+        if aprobar:
+            assert cliente.post(f'/pedidos/aprobar/{solicitud_id}').status_code == 302
+        return _consultas(cliente, f'/pedidos/{solicitud_id}')
+
+    assert consultas_con(1, 1) == consultas_con(12, 2)
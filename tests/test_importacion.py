@@ -0,0 +1,47 @@
+import io
+import json
+
+import app as aplicacion
+from app import db, Bodega, MovimientoStock, Product, Trabajo, importar_csv, tomar_trabajo, ejecutar_trabajo
+
+CSV = 'code,name,stock\nLAPIZ,Lápiz HB,2\nREGLA,Regla 30 cm,8\nCOMPAS,Compás,4\n'
+
+
+def test_filas_sin_saldo_no_quedan_a_medias(app, crear_producto):
+    lapiz = crear_producto('Lápiz', code='LAPIZ', stock=5)
+    regla = crear_producto('Regla', code='REGLA', stock=5)
+    # Parte del stock del lápiz está en otra bodega: la por defecto no alcanza para bajar a 2
+    otra = Bodega(name='Bodega norte')
+    db.session.add(otra)
+    db.session.flush()
+    aplicacion.registrar_movimiento(otra.id, lapiz.id, 'recepcion', 5)
+    db.session.commit()
+
+    resultado = importar_csv('productos', io.StringIO(CSV, newline=''))
+
+    assert resultado['insertadas'] == 1 and resultado['actualizadas'] == 1
+    assert [linea for linea, _ in resultado['errores']] == [2]
+    db.session.expire_all()
+    lapiz, regla = db.session.get(Product, lapiz.id), db.session.get(Product, regla.id)
+    assert (lapiz.name, lapiz.stock) == ('Lápiz', 10)
+    assert (regla.name, regla.stock) == ('Regla 30 cm', 8)
+    assert Product.query.filter_by(code='COMPAS').one().stock == 4
+    assert MovimientoStock.query.filter_by(nota='Importación CSV').count() == 2
+    assert aplicacion.reconstruir_saldos(verificar=True) == []
+
+
+def test_importacion_en_segundo_plano_guarda_solo_la_referencia(app, cliente):
+    respuesta = cliente.post('/importar', data={
+        'tipo': 'productos', 'en_segundo_plano': '1',
+        'archivo': (io.BytesIO(CSV.encode('utf-8-sig')), 'productos.csv'),
+    }, content_type='multipart/form-data')
+    assert respuesta.status_code == 302
+
+    trabajo = Trabajo.query.filter_by(tipo='importar').one()
+    assert set(json.loads(trabajo.parametros)) == {'tipo', 'archivo_id', '_base_url'}
+    trabajo = tomar_trabajo('prueba:1')
+    db.session.commit()
+    assert ejecutar_trabajo(trabajo)
+
+    assert db.session.get(Trabajo, trabajo.id).estado == 'completado'
+    assert Product.query.count() == 3
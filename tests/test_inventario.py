@@ -0,0 +1,49 @@
+import threading
+import time
+
+from sqlalchemy import insert, update
+
+import app as aplicacion
+from app import db, MovimientoStock, SaldoBodega, SaldoSnapshot
+
+
+def test_snapshot_incluye_los_movimientos_recien_confirmados(app, crear_producto):
+    producto = crear_producto('Tiza', stock=5)
+
+    hasta = aplicacion.tomar_snapshot_saldos()
+
+    assert hasta == db.session.query(MovimientoStock.id).scalar()
+    snapshot = db.session.get(SaldoSnapshot, (1, producto.id))
+    assert (snapshot.existencia, snapshot.reservado) == (5, 0)
+    assert aplicacion.reconstruir_saldos(verificar=True) == []
+
+
+def test_snapshot_espera_a_los_movimientos_sin_confirmar(app, crear_producto):
+    producto = crear_producto('Goma', stock=5)
+    # Otra transacción registra un movimiento (saldo primero, libro después) y tarda en confirmar
+    conexion = db.engine.connect()
+    transaccion = conexion.begin()
+    conexion.execute(update(SaldoBodega).where(SaldoBodega.product_id == producto.id)
+                     .values(existencia=SaldoBodega.existencia + 2))
+    movimiento_id = conexion.execute(insert(MovimientoStock).values(
+        bodega_id=1, product_id=producto.id, tipo='recepcion', existencia=2, reservado=0
+    )).inserted_primary_key[0]
+
+    resultado = []
+
+    def snapshot():
+        with app.app_context():
+            resultado.append(aplicacion.tomar_snapshot_saldos())
+            db.session.remove()
+
+    hilo = threading.Thread(target=snapshot)
+    hilo.start()
+    time.sleep(0.3)
+    assert resultado == []  # esperando el bloqueo de escritura
+    transaccion.commit()
+    conexion.close()
+    hilo.join()
+
+    assert resultado == [movimiento_id]
+    snapshot_guardado = db.session.get(SaldoSnapshot, (1, producto.id))
+    assert snapshot_guardado.existencia == 7
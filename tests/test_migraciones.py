@@ -0,0 +1,92 @@
+import time
+
+import pytest
+from sqlalchemy import inspect, text
+
+import app as aplicacion
+from app import db
+
+
+def _indices(inspector, tabla):
+    return {i['name']: tuple(i['column_names']) for i in inspector.get_indexes(tabla)}
+
+
+def test_migraciones_crean_el_esquema_de_los_modelos(app):
+    inspector = inspect(db.engine)
+    for tabla in db.metadata.sorted_tables:
+        assert inspector.has_table(tabla.name), tabla.name
+        columnas = {c['name'] for c in inspector.get_columns(tabla.name)}
+        assert columnas == {c.name for c in tabla.columns}, tabla.name
+        esperados = {i.name: tuple(c.name for c in i.columns) for i in tabla.indexes}
+        assert esperados.items() <= _indices(inspector, tabla.name).items(), tabla.name
+
+
+def test_actualiza_una_base_anterior_a_la_busqueda(base_vacia, monkeypatch):
+    # Base desplegada antes de la migración 9: product todavía no tiene version_catalogo
+    anteriores = [m for m in aplicacion.MIGRACIONES if m[0] <= 8]
+    monkeypatch.setattr(aplicacion, 'MIGRACIONES', anteriores)
+    aplicacion.aplicar_migraciones()
+    with db.engine.begin() as conexion:
+        conexion.execute(text("INSERT INTO product (name, code, stock) VALUES ('Lápiz', 'LAP', 0)"))
+    monkeypatch.undo()
+
+    nuevas = aplicacion.aplicar_migraciones()
+
+    assert [version for version, _ in nuevas] == [m[0] for m in aplicacion.MIGRACIONES if m[0] > 8]
+    inspector = inspect(db.engine)
+    assert _indices(inspector, 'product')['ix_product_version_catalogo'] == ('version_catalogo',)
+    assert db.session.execute(text("SELECT version_catalogo FROM product")).scalar() == 1
+
+
+def test_busqueda_ve_las_tablas_fts_creadas_despues_de_iniciar(base_vacia, monkeypatch):
+    # Proceso iniciado antes de la migración 9: recordó que no había tablas FTS5
+    anteriores = [m for m in aplicacion.MIGRACIONES if m[0] <= 8]
+    monkeypatch.setattr(aplicacion, 'MIGRACIONES', anteriores)
+    aplicacion.aplicar_migraciones()
+    assert aplicacion._tablas_fts() == frozenset()
+    monkeypatch.undo()
+
+    aplicacion.aplicar_migraciones()
+    presentes = aplicacion._tablas_fts()
+    if not presentes:
+        pytest.skip('SQLite compilado sin FTS5')
+    assert 'product_fts' in presentes
+
+    # Otro worker con la caché vieja la renueva al vencer BUSQUEDA_FTS_TTL
+    vencida = time.monotonic() - base_vacia.config['BUSQUEDA_FTS_TTL']
+    monkeypatch.setattr(aplicacion, '_tablas_fts_cache', (vencida, frozenset()))
+    assert aplicacion._tablas_fts() == presentes
+
+
+def test_migraciones_son_idempotentes_sobre_create_all(base_vacia):
+    # Bases creadas con db.create_all() antes de existir las migraciones
+    db.create_all()
+    aplicacion.aplicar_migraciones()
+    assert aplicacion.aplicar_migraciones() == []
+
+
+def test_carga_inicial_del_consumo_coincide_con_el_historial(base_vacia, monkeypatch):
+    monkeypatch.setattr(aplicacion, 'MIGRACIONES', [m for m in aplicacion.MIGRACIONES if m[0] <= 4])
+    aplicacion.aplicar_migraciones()
+    with db.engine.begin() as conexion:
+        for sentencia in (
+            "INSERT INTO product (id, name, code, stock) VALUES (1, 'Lápiz', 'LAP', 0), (2, 'Goma', 'GOM', 0)",
+            "INSERT INTO supervisor (id, name, apellido, email) VALUES (1, 'Ana', 'Pérez', 'ana@example.com')",
+            "INSERT INTO escuela (id, name) VALUES (1, 'Escuela 1'), (2, 'Escuela 2')",
+            "INSERT INTO solicitud (id, supervisor_id, escuela_id, fecha_solicitud, fecha_aprobacion, estado) VALUES "
+            "(1, 1, 1, '2024-03-01 10:00:00', '2024-03-02 09:00:00', 'Aprobada'), "
+            "(2, 1, 1, '2024-03-01 11:00:00', NULL, 'Pendiente'), "
+            "(3, 1, 2, '2024-03-05 08:00:00', NULL, 'Rechazada')",
+            "INSERT INTO detalle_solicitud (solicitud_id, product_id, cantidad_solicitada) VALUES "
+            "(1, 1, 5), (1, 2, 2), (2, 1, 3), (3, 2, 7)",
+        ):
+            conexion.execute(text(sentencia))
+    monkeypatch.undo()
+
+    aplicacion.aplicar_migraciones()
+
+    columnas = 'fecha, escuela_id, product_id, unidades_solicitadas, unidades_aprobadas, pedidos'
+    migradas = db.session.execute(text(f'SELECT {columnas} FROM consumo_diario ORDER BY 1, 2, 3')).all()
+    en_vivo = sorted(tuple(fila) for fila in db.session.execute(aplicacion._consulta_consumo()))
+    assert [tuple(fila) for fila in migradas] == en_vivo
+    assert len(migradas) == 5 # las aprobadas cuentan en la fecha de aprobación
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from app import db, Solicitud, DetalleSolicitud, SupervisorEscuela
+
+
+def _plan(consulta):
+    # Plan del motor para la consulta ORM, como texto (SQLite o PostgreSQL)
+    sentencia = consulta.statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    if db.engine.dialect.name == 'sqlite':
+        filas = db.session.execute(text(f'EXPLAIN QUERY PLAN {sentencia}')).all()
+        return '\n'.join(fila[-1] for fila in filas)
+    db.session.execute(text('SET LOCAL enable_seqscan = off'))
+    return '\n'.join(fila[0] for fila in db.session.execute(text(f'EXPLAIN {sentencia}')))
+
+
+CONSULTAS = {
+    # Lista de pedidos paginada (keyset)
+    'ix_solicitud_fecha_id': lambda: Solicitud.query.filter(
+        Solicitud.fecha_solicitud < datetime(2024, 1, 1)
+    ).order_by(Solicitud.fecha_solicitud.desc(), Solicitud.id.desc()).limit(50),
+    # Cupo semanal de pedidos de una escuela
+    'ix_solicitud_escuela_fecha': lambda: Solicitud.query.filter(
+        Solicitud.escuela_id == 1, Solicitud.fecha_solicitud >= datetime.utcnow() - timedelta(days=7)
+    ),
+    # Aprobación por lote de las pendientes de un supervisor, de la más antigua a la más reciente
+    'ix_solicitud_supervisor_estado_fecha': lambda: Solicitud.query.filter(
+        Solicitud.supervisor_id == 1, Solicitud.estado == 'Pendiente'
+    ).order_by(Solicitud.fecha_solicitud),
+    # Reportes por estado en un rango de fechas
+    'ix_solicitud_estado_fecha': lambda: Solicitud.query.filter(
+        Solicitud.estado == 'Aprobada', Solicitud.fecha_solicitud >= datetime(2024, 1, 1)
+    ),
+    # Detalle de una solicitud
+    'ix_detalle_solicitud_solicitud_producto': lambda: DetalleSolicitud.query.filter(
+        DetalleSolicitud.solicitud_id == 1
+    ),
+    # Supervisores asignados a una escuela
+    'ix_supervisor_escuela_escuela_id': lambda: SupervisorEscuela.query.filter(
+        SupervisorEscuela.escuela_id == 1
+    ),
+}
+
+
+@pytest.mark.parametrize('indice', sorted(CONSULTAS))
+def test_consultas_frecuentes_usan_su_indice(app, indice):
+    assert indice in _plan(CONSULTAS[indice]())
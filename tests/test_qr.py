@@ -0,0 +1,38 @@
+import os
+
+import app as aplicacion
+
+
+def _archivos(directorio):
+    return [os.path.join(raiz, nombre) for raiz, _, nombres in os.walk(directorio) for nombre in nombres]
+
+
+def test_qr_solo_de_productos_existentes(app, cliente, crear_producto, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'QR_CACHE_DIR', str(tmp_path))
+    crear_producto('Carpeta', code='CARPETA.png')
+
+    assert cliente.get('/product/qr/NO-EXISTE/imagen.png').status_code == 404
+    assert _archivos(tmp_path) == []
+
+    # Un código con ".png" es la página del producto, no su imagen
+    pagina = cliente.get('/product/qr/CARPETA.png')
+    assert pagina.status_code == 200 and b'/product/qr/CARPETA.png/imagen.png' in pagina.data
+
+    imagen = cliente.get('/product/qr/CARPETA.png/imagen.png')
+    assert imagen.status_code == 200 and imagen.mimetype == 'image/png'
+    assert len(_archivos(tmp_path)) == 1
+
+
+def test_poda_borra_los_qr_usados_hace_mas_tiempo(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'QR_CACHE_DIR', str(tmp_path))
+    monkeypatch.setitem(app.config, 'QR_CACHE_DISCO_MB', 1)
+    rutas = []
+    for numero in range(3):
+        ruta = tmp_path / f'{numero:02d}' / f'{numero}.png'
+        ruta.parent.mkdir()
+        ruta.write_bytes(b'x' * 400 * 1024)
+        os.utime(ruta, (1000 + numero, 1000 + numero))
+        rutas.append(ruta)
+
+    assert aplicacion.podar_cache_qr() == 1
+    assert [ruta.exists() for ruta in rutas] == [False, True, True]
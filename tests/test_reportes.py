@@ -0,0 +1,48 @@
+import logging
+from datetime import datetime, timedelta
+
+from app import calcular_reporte, reconstruir_consumo, verificar_consumo
+
+
+def _periodo():
+    hoy = datetime.utcnow()
+    inicio = datetime(hoy.year, hoy.month, hoy.day)
+    return inicio, inicio + timedelta(days=1)
+
+
+def _unidades(reporte):
+    return (reporte['totales']['unidades'],
+            sum(fila['unidades'] for fila in reporte['por_escuela']),
+            sum(fila.unidades for fila in reporte['por_producto']))
+
+
+def test_reporte_usa_una_sola_fuente_de_unidades(app, crear_producto, crear_solicitud, caplog):
+    cuaderno, lapiz = crear_producto('Cuaderno'), crear_producto('Lápiz')
+    crear_solicitud([(cuaderno, 3), (lapiz, 2)])
+    crear_solicitud([(lapiz, 4)])
+
+    # Pedidos cargados sin pasar por acumular_consumo: el acumulado no cubre el período
+    with caplog.at_level(logging.WARNING):
+        reporte = calcular_reporte(*_periodo())
+    assert _unidades(reporte) == (9, 9, 9)
+    assert 'consumo_diario no coincide' in caplog.text
+
+    reconstruir_consumo()
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        assert _unidades(calcular_reporte(*_periodo())) == (9, 9, 9)
+    assert 'consumo_diario no coincide' not in caplog.text
+
+
+def test_verificar_consumo_detecta_pedidos_fuera_del_acumulado(app, crear_producto, crear_solicitud):
+    cuaderno = crear_producto('Cuaderno')
+    crear_solicitud([(cuaderno, 3)])
+    hoy = datetime.utcnow().date()
+
+    assert verificar_consumo() == [(hoy, None, (3, 0, 1))]
+    salida = app.test_cli_runner().invoke(args=['reconstruir-consumo', '--verificar'])
+    assert '>>> 1 días con diferencias' in salida.output
+
+    reconstruir_consumo()
+    assert verificar_consumo() == []
+    assert verificar_consumo(hoy) == []
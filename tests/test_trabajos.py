@@ -0,0 +1,57 @@
+import time
+from datetime import datetime, timedelta
+
+import app as aplicacion
+from app import db, Trabajo, encolar_trabajo, tomar_trabajo, ejecutar_trabajo, mantener_cola
+
+
+def _en_proceso(iniciado_hace, latido_hace):
+    ahora = datetime.utcnow()
+    trabajo = Trabajo(tipo='prueba', estado='en_proceso', intentos=1,
+                      iniciado_en=ahora - timedelta(seconds=iniciado_hace),
+                      latido_en=ahora - timedelta(seconds=latido_hace))
+    db.session.add(trabajo)
+    db.session.commit()
+    return trabajo.id
+
+
+def test_mantener_cola_reintenta_solo_sin_latido(app):
+    vencido = app.config['TRABAJOS_LATIDO_VENCIDO']
+    # Más de una hora en proceso, pero el worker sigue latiendo: no se ejecuta dos veces
+    largo = _en_proceso(iniciado_hace=4 * 3600, latido_hace=5)
+    abandonado = _en_proceso(iniciado_hace=vencido + 60, latido_hace=vencido + 60)
+
+    mantener_cola()
+
+    assert db.session.get(Trabajo, largo).estado == 'en_proceso'
+    assert db.session.get(Trabajo, abandonado).estado == 'pendiente'
+
+
+def test_el_worker_late_mientras_ejecuta(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'TRABAJOS_LATIDO_SEGUNDOS', 0.05)
+    # Tarea que no informa avance (p. ej. una sola consulta larga)
+    monkeypatch.setitem(aplicacion.TAREAS, 'prueba', ('Prueba', lambda parametros, avance: (time.sleep(0.3), None)))
+    encolar_trabajo('prueba', {})
+    trabajo = tomar_trabajo('prueba:1')
+    iniciado_en = trabajo.iniciado_en
+    db.session.commit()
+
+    assert ejecutar_trabajo(trabajo)
+
+    trabajo = db.session.get(Trabajo, trabajo.id)
+    assert trabajo.estado == 'completado'
+    assert trabajo.latido_en > iniciado_en
+
+
+def test_worker_mantiene_la_cola_con_su_propio_intervalo(app, monkeypatch):
+    llamadas = []
+    monkeypatch.setattr(aplicacion, 'mantener_cola', lambda: llamadas.append(1))
+    monkeypatch.setitem(aplicacion.TAREAS, 'prueba', ('Prueba', lambda parametros, avance: ('listo', None)))
+    for _ in range(3):
+        encolar_trabajo('prueba', {})
+
+    resultado = app.test_cli_runner().invoke(args=['worker', '--una-vez'])
+
+    assert resultado.exit_code == 0, resultado.output
+    assert Trabajo.query.filter_by(tipo='prueba', estado='completado').count() == 3
+    assert llamadas == [1]